@@ -3,6 +3,8 @@ import numpy as np
 import sqlite3
 from sklearn.preprocessing import StandardScaler
 import database
+import extrema_index
+import price_cube
 
 def get_connection():
     return database.get_connection()
@@ -27,6 +29,15 @@ def clip_financial_outliers(df):
 
 # --- 1. 計算所有股票與目標股票的 K 線相關係數 ---
 def get_price_correlation(target_id, days=60):
+    # 有價格立方體時直接切 memmap，不必讀 SQL + pivot
+    cube = price_cube.load_price_cube()
+    if cube is not None and target_id in cube:
+        recent_matrix = cube.panel('close', days=days)
+        corr_series = recent_matrix.corrwith(recent_matrix[target_id])
+        corr_df = corr_series.rename_axis('stock_id').to_frame(name='trend_corr').reset_index()
+        corr_df['trend_corr'] = corr_df['trend_corr'].fillna(0)
+        return corr_df
+
     conn = get_connection()
     try:
         sql = f"""
@@ -137,12 +148,18 @@ def find_similar_stocks(target_id, weights, period='1y', industry_only=False):
     # 盤整天數取 log (避免 200 天跟 1 天差距過大拉壞權重)
     df['consolidation_log'] = np.log1p(df['consolidation_days'].fillna(0)) # ★ 處理
 
-    if period == '2y':
-        high_col, low_col = 'year_high_2y', 'year_low_2y'
+    if period in ('1y', '2y'):
+        if period == '2y':
+            high_col, low_col = 'year_high_2y', 'year_low_2y'
+        else:
+            high_col, low_col = 'year_high', 'year_low'
+
+        df['position'] = (df['close'] - df[low_col]) / (df[high_col] - df[low_col]).replace(0, np.nan)
     else:
-        high_col, low_col = 'year_high', 'year_low'
-    
-    df['position'] = (df['close'] - df[low_col]) / (df[high_col] - df[low_col]).replace(0, np.nan)
+        # 其他回看區間 (3m / 6m / 3y ...) 由高低點索引 O(1) 取得
+        df['position'] = df['stock_id'].map(extrema_index.position_for_period(period))
+    # 顯示用的位階 (下面特徵處理會補中位數、截尾，不能拿那份來顯示)
+    df_display['position'] = df['position']
     
     # --- 5. 定義特徵向量 (加入 consolidation_log) ---
     features = [
@@ -193,7 +210,6 @@ def find_similar_stocks(target_id, weights, period='1y', industry_only=False):
     similarity_scores = (1 - (distances / max_dist)) * 100
     
     df_display['similarity'] = similarity_scores
-    df_display['position'] = df['position']
     
     # --- 7. 回傳結果 ---
     result_cols = [
@@ -4,16 +4,27 @@ import sqlite3
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 import analysis
+import extrema_index
 from streamlit_option_menu import option_menu # 務必確認已安裝此套件
 import plotly.express as px # ★ 新增這一行
 import json
 import time
 import database
+import hot_db
+import query_cache
+import screener_engine
+import chart_pyramid
+import chart_cache
 import ai_agent # ★ 新增這行
 
-# --- ★★★ GitHub 版本專屬：啟動時解壓縮資料庫 ★★★ ---
+# 首次渲染時間 (time-to-first-render) 從這個 session 第一次執行腳本開始計算
+if "session_started" not in st.session_state:
+    st.session_state.session_started = time.time()
+
+# --- ★★★ GitHub 版本專屬：啟動時只解壓縮熱資料檔，完整歷史在背景還原 ★★★ ---
 try:
-    database.ensure_database()
+    hot_db.ensure_hot_database()
+    hot_db.start_cold_restore()
 except Exception as e:
     st.error(f"資料庫初始化失敗：{e}")
     st.stop()
@@ -93,26 +104,22 @@ st.markdown("""
 # ==========================================
 
 def get_connection():
+    # 讀取用：唯讀 + 同執行緒共用連線 (close() 不會真的關閉)
+    # 需要完整歷史 (K 線、月營收等)，背景還原還沒完成就在這裡等
+    if not hot_db.cold_ready():
+        with st.spinner("📦 歷史資料庫載入中..."):
+            hot_db.wait_for_cold()
+    return database.get_connection(read_only=True, reuse=True)
+
+def get_hot_connection():
+    # 只讀快照 / 大盤 / 策略：完整資料庫還沒好就先讀 stock_hot.db
+    return hot_db.get_hot_connection()
+
+def get_write_connection():
+    # 策略 / 自選股等寫入用
     return database.get_connection()
 
 
-FINANCIAL_CLIP_RANGES = {
-    'revenue_growth': (-100, 300),
-    'eps_growth': (-300, 300),
-    'gross_margin': (-100, 100),
-    'operating_margin': (-100, 100),
-    'pretax_margin': (-100, 100),
-    'net_margin': (-100, 100),
-}
-
-
-def clip_financial_outliers(df):
-    for col, (lower, upper) in FINANCIAL_CLIP_RANGES.items():
-        if col in df.columns:
-            df[col] = pd.to_numeric(df[col], errors='coerce').clip(lower, upper)
-    return df
-
-
 def table_exists(conn, table_name):
     cursor = conn.cursor()
     cursor.execute(
@@ -122,8 +129,74 @@ def table_exists(conn, table_name):
     return cursor.fetchone()[0] > 0
 
 
+# 位階回看區間：1y / 2y 用 stocks 預先算好的欄位，其餘由高低點索引 (extrema_index) 即時算
+POSITION_PERIOD_OPTIONS = {
+    "近 3 個月": '3m',
+    "近半年": '6m',
+    "近 1 年 (標準)": '1y',
+    "近 2 年 (長線)": '2y',
+    "近 3 年": '3y',
+}
+
+
+def get_position_column(period):
+    return screener_engine.position_column(period)
+
+
+# load_data 結果跨 session 共用：key = 正規化後的篩選條件 + data_versions，更新程式發佈新快照後舊結果自然失效
+LOAD_DATA_CACHE = query_cache.get_cache('load_data', max_entries=128)
+# 最近看過的個股日 K：key = (股票代號, 天數, data_versions)，在結果表格來回點選不必再查 SQLite
+STOCK_HISTORY_CACHE = query_cache.get_cache('stock_history', max_entries=48)
+# 個股 K 線圖的多層解析度 (日 / 週 / 月 / 總覽)，同一檔、同一資料版本只切一次
+CHART_PYRAMID_CACHE = query_cache.get_cache('chart_pyramid', max_entries=48)
+
+
+@st.cache_resource(max_entries=2, show_spinner=False)
+def get_screener_engine(version_token):
+    # 每個資料版本只載入一次快照，所有 session 共用同一個引擎 (舊資料庫沒有快照表時為 None)
+    conn = get_hot_connection()
+    try:
+        return screener_engine.load_screener_engine(conn, version_token, buckets=screener_buckets())
+    finally:
+        conn.close()
+
+
+def get_data_token():
+    conn = get_hot_connection()
+    try:
+        token = database.get_data_versions_token(conn)
+    finally:
+        conn.close()
+    # 資料版本變了 (還原 / 套用差異檔) 就在背景補齊本機衍生檔
+    hot_db.schedule_derived_refresh(token)
+    return token
+
+
+def index_position_lookup(period):
+    # 3m / 6m / 3y 等位階需要完整歷史的高低點索引
+    return extrema_index.position_for_period(period, get_connection())
+
+
 def load_data(filters):
-    conn = get_connection()
+    token = get_data_token()
+    key = (query_cache.freeze(filters), token)
+    engine = get_screener_engine(token)
+    if engine is not None:
+        compute = lambda: engine.screen(filters, index_position_lookup)
+    else:
+        compute = lambda: query_data(filters)
+    try:
+        df = LOAD_DATA_CACHE.get_or_compute(key, compute)
+    except Exception as e:
+        st.error(f"資料庫讀取錯誤: {e}")
+        return pd.DataFrame()
+    # 呼叫端會直接改欄位，給一份複本以免污染快取
+    return df.copy()
+
+
+def query_data(filters):
+    # SQL 版本：舊資料庫還沒有 latest_stock_snapshot 時使用 (有快照時由 screener_engine 在記憶體篩選)
+    conn = get_hot_connection()
     use_snapshot = table_exists(conn, "latest_stock_snapshot")
     price_alias = "s" if use_snapshot else "d"
     
@@ -178,20 +251,8 @@ def load_data(filters):
 
     # 3. 數值篩選 (加入 Capital, Vol MA, Streak)
     numeric_filters = [
-        ('s.pe_ratio', filters.get('pe_min'), filters.get('pe_max')),
-        ('s.yield_rate', filters.get('yield_min'), filters.get('yield_max')),
-        ('s.pb_ratio', filters.get('pb_min'), filters.get('pb_max')),
-        ('s.eps', filters.get('eps_min'), filters.get('eps_max')),
-        ('s.beta', filters.get('beta_min'), filters.get('beta_max')),
-        ('s.revenue_growth', filters.get('rev_min'), filters.get('rev_max')),
-        ('s.capital', filters.get('cap_min'), filters.get('cap_max')),
-        ('s.gross_margin', filters.get('gross_min'), filters.get('gross_max')), # ★ 新增這行
-        (f'{price_alias}.close', filters.get('price_min'), filters.get('price_max')),
-        (f'{price_alias}.change_pct', filters.get('change_min'), filters.get('change_max')),
-        (f'{price_alias}.volume', filters.get('vol_min'), filters.get('vol_max')),
-        ('s.vol_ma_5', filters.get('vol_ma_min'), filters.get('vol_ma_max')),
-        ('s.vol_ma_20', filters.get('vol_ma20_min'), filters.get('vol_ma20_max')),
-        ('s.eps_growth', filters.get('eps_growth_min'), filters.get('eps_growth_max')),
+        (f"{price_alias if col in screener_engine.PRICE_COLUMNS else 's'}.{col}", filters.get(low_key), filters.get(high_key))
+        for col, low_key, high_key in screener_engine.NUMERIC_FILTERS
     ]
 
     for col, min_val, max_val in numeric_filters:
@@ -210,7 +271,8 @@ def load_data(filters):
     # 位階篩選 (根據 period 動態選擇 position_1y 或 position_2y)
     current_period = filters.get('period', '1y')
     pos_col = "s.position_2y" if current_period == '2y' else "s.position_1y"
-    if filters.get('pos_min') is not None or filters.get('pos_max') is not None:
+    index_position = current_period not in ('1y', '2y')
+    if not index_position and (filters.get('pos_min') is not None or filters.get('pos_max') is not None):
         if filters.get('pos_min') is not None:
             conditions.append(f"{pos_col} >= ?")
             params.append(filters.get('pos_min'))
@@ -226,6 +288,19 @@ def load_data(filters):
         elif threshold == 0.2:
             conditions.append("s.consolidation_days_20 >= ?")
             params.append(days)
+        elif table_exists(conn, "consolidation_breakpoints"):
+            # 任意 ±X%：查預先算好的門檻斷點表 (門檻 <= X 的斷點中，天數達標即可)
+            conditions.append("s.stock_id IN (SELECT stock_id FROM consolidation_breakpoints WHERE threshold <= ? AND days >= ?)")
+            params.extend([threshold, days])
+        else:
+            # 舊資料庫還沒有斷點表：退回最接近的固定門檻欄位
+            conditions.append("s.consolidation_days >= ?" if threshold <= 0.15 else "s.consolidation_days_20 >= ?")
+            params.append(days)
+
+    # 快速搜尋 (代號或名稱包含輸入文字)
+    if filters.get('search'):
+        conditions.append("(instr(s.stock_id, ?) > 0 OR instr(s.name, ?) > 0)")
+        params.extend([filters['search'], filters['search']])
 
     if conditions:
         final_sql = base_sql + " AND " + " AND ".join(conditions)
@@ -238,53 +313,74 @@ def load_data(filters):
         # df['position'] = (df['close'] - df['year_low']) / (df['year_high'] - df['year_low'])
         # df['vol_spike'] = df.apply(lambda x: x['volume'] / x['vol_ma_20'] if x['vol_ma_20'] > 0 else 0, axis=1)
         
+        # 其他回看區間的位階：由高低點索引一次算出全市場，再於記憶體篩選
+        if index_position:
+            pos_col_name = get_position_column(current_period)
+            df[pos_col_name] = df['stock_id'].map(extrema_index.position_for_period(current_period, get_connection()))
+            if filters.get('pos_min') is not None:
+                df = df[df[pos_col_name] >= filters['pos_min']]
+            if filters.get('pos_max') is not None:
+                df = df[df[pos_col_name] <= filters['pos_max']]
+
         # 爆量篩選使用預先計算欄位
         if filters.get('vol_spike_min'):
             df = df[df['vol_spike'] >= filters['vol_spike_min']]
-        df = clip_financial_outliers(df)
-    except Exception as e:
-        st.error(f"資料庫讀取錯誤: {e}")
-        df = pd.DataFrame()
+        df = screener_engine.clip_financial_outliers(df)
     finally:
         conn.close()
     return df
 
-def load_stock_history(stock_id, days=1800): # 改成 1800 (約5年)
+def query_stock_history(stock_id, days):
     conn = get_connection()
-    sql = """
-    SELECT date, open, high, low, close, volume, ma_5, ma_20, ma_60
-    FROM daily_prices
-    WHERE stock_id = ?
-    ORDER BY date ASC
-    """
-    df = pd.read_sql(sql, conn, params=(stock_id,))
-    conn.close()
-    
-    # 這裡原本是 df.tail(days)，現在 days 變大，就能回傳完整資料
-    return df.tail(days)
+    try:
+        return chart_pyramid.read_daily_history(conn, stock_id, days)
+    finally:
+        conn.close()
+
+
+def load_stock_history(stock_id, days=chart_pyramid.HISTORY_DAYS): # 1800 (約5年)
+    key = (stock_id, days, get_data_token())
+    # 呼叫端會改欄位 (例如畫圖時轉日期)，回傳副本避免汙染快取
+    return STOCK_HISTORY_CACHE.get_or_compute(key, lambda: query_stock_history(stock_id, days)).copy()
 
 
 def resample_to_weekly(df):
     df['date'] = pd.to_datetime(df['date'])
-    # 定義轉換邏輯：開盤取第一天，收盤取最後一天，高取最高，低取最低，量取總和
-    logic = {
-        'open': 'first',
-        'high': 'max',
-        'low': 'min',
-        'close': 'last',
-        'volume': 'sum'
-    }
-    # 'W-FRI' 代表每週五結算一根 K 棒
-    df_weekly = df.resample('W-FRI', on='date').agg(logic).dropna().reset_index()
-    
-    # 重算週均線
-    df_weekly['ma_5'] = df_weekly['close'].rolling(5).mean()
-    df_weekly['ma_20'] = df_weekly['close'].rolling(20).mean()
-    
-    return df_weekly
+    # 'W-FRI' 代表每週五結算一根 K 棒 (並重算週均線)
+    return chart_pyramid.resample_bars(df, 'W-FRI')
 
-def get_all_stocks_list():
+def load_weekly_history(stock_id, hist=None):
+    """
+    讀取預先算好的週 K (weekly_prices)；資料庫還沒有這張表或沒有這檔時，退回即時 resample
+    """
     conn = get_connection()
+    try:
+        df = chart_pyramid.read_weekly_history(conn, stock_id)
+    finally:
+        conn.close()
+
+    if df.empty and hist is not None:
+        return resample_to_weekly(hist)
+    return df
+
+def load_chart_pyramid(stock_id):
+    """{週期: DataFrame}，畫圖端唯讀使用 (不要改欄位)；沒有歷史資料時為空 dict"""
+    def build():
+        hist = load_stock_history(stock_id)
+        if hist.empty:
+            return {}
+        return chart_pyramid.build_pyramid(hist, load_weekly_history(stock_id, hist))
+    return CHART_PYRAMID_CACHE.get_or_compute((stock_id, get_data_token()), build)
+
+def get_stock_chart(stock_id, name, period_type):
+    """個股 K 線圖：先讀磁碟圖表快取 (資料版本改變後在背景預熱)，沒有才切層畫圖並寫回；沒有歷史資料時回傳 None"""
+    def build():
+        pyramid = load_chart_pyramid(stock_id)
+        return chart_pyramid.plot_stock_chart(pyramid, stock_id, name, period_type) if pyramid else None
+    return chart_cache.get_or_build(stock_id, period_type, get_data_token(), build)
+
+def get_all_stocks_list():
+    conn = get_hot_connection()
     try:
         df = pd.read_sql("SELECT stock_id, name FROM stocks", conn)
         stock_options = [f"{row['stock_id']} {row['name']}" for index, row in df.iterrows()]
@@ -293,92 +389,6 @@ def get_all_stocks_list():
     conn.close()
     return stock_options
 
-def plot_candlestick(df, stock_id, name, period_type="日線"):
-    title_text = f'{stock_id} {name} - {period_type}走勢'
-
-    # 1. 資料處理：確保日期是「真實的 Datetime 格式」(不要轉成字串)
-    df['date'] = pd.to_datetime(df['date'])
-    
-    # 2. 建立子圖
-    fig = make_subplots(
-        rows=2, cols=1, 
-        shared_xaxes=True,
-        vertical_spacing=0.05,   # 稍微拉近一點上下圖的距離
-        subplot_titles=(title_text, '成交量'),
-        row_heights=[0.7, 0.3]
-    )
-    
-    # 3. K線圖 (上圖) - 注意：x 改用 df['date']
-    fig.add_trace(go.Candlestick(
-        x=df['date'], 
-        open=df['open'], high=df['high'], low=df['low'], close=df['close'], 
-        name='K線',
-        increasing_line_color='#FF4B4B', decreasing_line_color='#00FF7F',
-        showlegend=False
-    ), row=1, col=1)
-    
-    # 4. 均線 (上圖)
-    fig.add_trace(go.Scatter(x=df['date'], y=df['ma_5'], mode='lines', name='MA5', line=dict(color='orange', width=1.5)), row=1, col=1)
-    fig.add_trace(go.Scatter(x=df['date'], y=df['ma_20'], mode='lines', name='MA20', line=dict(color='#BA55D3', width=1.5)), row=1, col=1)
-    
-    # 5. 成交量 (下圖)
-    vol_colors = ['#FF4B4B' if c >= o else '#00FF7F' for c, o in zip(df['close'], df['open'])]
-    fig.add_trace(go.Bar(
-        x=df['date'], 
-        y=df['volume'], 
-        marker_color=vol_colors, 
-        name='成交量',
-        showlegend=False
-    ), row=2, col=1)
-    
-    # ==========================================
-    # ★★★ 終極優化區：時間軸 (Date Axis) 縮放設定 ★★★
-    # ==========================================
-    
-    # 取得歷史資料的「最老日期」與「最新日期」
-    min_date = df['date'].min()
-    max_date = df['date'].max() + pd.Timedelta(days=5) # 保留右邊 5 天的呼吸空間
-
-    # A. 計算預設顯示範圍 (約 120 根 K 棒 = 半年)
-    if len(df) > 120:
-        start_date = df['date'].iloc[-120]
-        initial_range = [start_date, max_date]
-        
-        # 成交量 Y 軸上限：只看這半年的最大量
-        recent_vol = df['volume'].tail(120)
-        vol_max = recent_vol.max() * 1.1 
-    else:
-        initial_range = None
-        vol_max = df['volume'].max() * 1.1 if not df.empty else 1000
-
-    # B. 全局 Layout 設定
-    fig.update_layout(
-        height=600,
-        template="plotly_dark",
-        margin=dict(l=50, r=20, t=50, b=20), 
-        xaxis_rangeslider_visible=False,     
-        dragmode='pan',                      
-        hovermode="x unified",               
-        yaxis2=dict(range=[0, vol_max], showgrid=False),
-        yaxis=dict(showgrid=True, gridcolor='rgba(255,255,255,0.1)')
-    )
-    
-    # C. X 軸終極設定 (套用至所有子圖)
-    fig.update_xaxes(
-        type="date",                         
-        range=initial_range,                 
-        minallowed=min_date,                 # ★ 關鍵：鎖定左邊界 (禁止拉到比第一筆資料更早)
-        maxallowed=max_date,                 # ★ 關鍵：鎖定右邊界 (禁止拉到遙遠的未來)
-        rangebreaks=[
-            dict(bounds=["sat", "mon"])      
-        ],
-        showgrid=True,
-        gridcolor='rgba(255,255,255,0.05)',
-        nticks=8                             
-    )
-    
-    return fig
-
 # ==========================================
 # 2. UI 輔助函數 (下拉選單邏輯)
 # ==========================================
@@ -389,91 +399,121 @@ def plot_candlestick(df, stock_id, name, period_type="日線"):
 # ==========================================
 
 
+# --- 篩選選項 → 數值區間 (selectbox 的每個選項就是一個桶，選股引擎會預先為每個桶建好 bitmap) ---
+PE_RANGES = {"不拘": (None, None), "10 倍以下 (低估)": (None, 10), "15 倍以下 (合理)": (None, 15), "20 倍以下 (正常)": (None, 20), "25 倍以上 (成長)": (25, None)}
+YIELD_RANGES = {"不拘": (None, None), "3% 以上 (及格)": (3, None), "5% 以上 (高股息)": (5, None), "7% 以上 (超高配)": (7, None), "1% 以下 (成長)": (0, 1)}
+EPS_RANGES = {
+    "不拘": (None, None), 
+    "0 元以上 (賺錢)": (0, None), 
+    "1.5 元以上 (及格)": (1.5, None),  # ★ NEW ★ 
+    "3 元以上 (穩健)": (3, None), 
+    "5 元以上 (高獲利)": (5, None), 
+    "10 元以上 (股王)": (10, None)
+}
+PRICE_RANGES = {
+    "不拘": (None, None), 
+    "100 元以上": (100, None), 
+    "30 ~ 100 元": (30, 100), 
+    "20 ~ 100 元": (20, 100),  # ★ NEW ★ 
+    "30 元以下": (0, 30)
+}
+CHANGE_RANGES = {"不拘": (None, None), "上漲 (> 0%)": (0, None), "強勢 (> 3%)": (3, None), "漲停 (> 9%)": (9, None), "下跌 (< 0%)": (None, 0), "跌深 (<-3%)": (None, -3)}
+VOLUME_RANGES = {"不拘": (None, None), "500 張以上": (500*1000, None), "1000 張以上": (1000*1000, None), "5000 張以上": (5000*1000, None), "10000 張以上": (10000*1000, None)}
+BETA_RANGES = {"不拘": (None, None), "大於 1 (活潑)": (1, None), "大於 1.5 (攻擊)": (1.5, None), "小於 1 (穩健)": (None, 1), "小於 0.5 (牛皮)": (None, 0.5)}
+# 營收成長率 YoY (%)
+REVENUE_RANGES = {"成長 (> 0%)": (0, None), "高成長 (> 20%)": (20, None), "爆發 (> 50%)": (50, None), "衰退 (< 0%)": (None, 0)}
+EPS_GROWTH_RANGES = {"成長 (> 0%)": (0, None), "高成長 (> 20%)": (20, None), "翻倍 (> 100%)": (100, None), "衰退 (< 0%)": (None, 0)}
+# 位階 (0.0 ~ 1.0)
+POSITION_RANGES = {
+    "不拘": (None, None),
+    "低基期 (0 ~ 0.4)": (0, 0.4),   # ★★★ 幫家人新增的這個專屬區間 ★★★
+    "底部 (0 ~ 0.2)": (0, 0.2), 
+    "低檔 (0.2 ~ 0.4)": (0.2, 0.4), 
+    "中階 (0.4 ~ 0.6)": (0.4, 0.6), 
+    "高檔 (0.6 ~ 0.8)": (0.6, 0.8), 
+    "頭部 (0.8 ~ 1.0)": (0.8, 1.0)
+}
+CAPITAL_RANGES = {
+    "不拘": (None, None),
+    "小型股 (< 10億)": (0, 10),
+    "中型股 (10億 ~ 50億)": (10, 50),
+    "中大型股 (10億 ~ 70億)": (10, 70),  # ★ NEW ★ 
+    "大型股 (> 50億)": (50, None),
+    "超大型權值股 (> 200億)": (200, None)
+}
+# 營收連續成長 (年/季)
+STREAK_OPTIONS = {
+    "不拘": None,
+    "連增 1 年以上": 1,
+    "連增 2 年以上": 2,
+    "連增 3 年以上": 3,
+    "連增 5 年以上": 5
+}
+VOL_SPIKE_OPTIONS = {"不拘": None, "大於 1.5 倍": 1.5, "大於 2 倍 (倍增)": 2.0, "大於 3 倍 (爆量)": 3.0, "大於 5 倍 (天量)": 5.0}
+# 毛利率 (%)
+GROSS_MARGIN_RANGES = {
+    "不拘": (None, None), 
+    "正毛利 (> 0%)": (0, None), 
+    "中毛利 (> 10%)": (10, None),
+    "高毛利 (> 20%)": (20, None), 
+    "超高毛利 (> 40%)": (40, None), 
+    "頂級毛利 (> 60%)": (60, None)
+}
+# 盤整天數
+CONSOLIDATION_OPTIONS = {
+    "不拘": None,
+    "盤整 1 個月 (> 20天, ±10%)": (20, 0.1),
+    "盤整 3 個月 (> 60天, ±10%)": (60, 0.1),
+    "盤整半年 (> 120天, ±10%)": (120, 0.1),
+    "大箱型 3 個月 (> 60天, ±20%)": (60, 0.2), 
+    "大箱型半年 (> 120天, ±20%)": (120, 0.2),
+    "自訂天數 / 區間": None,  # 由 custom 參數決定
+}
+
 def get_pe_range(option):
-    mapping = {"不拘": (None, None), "10 倍以下 (低估)": (None, 10), "15 倍以下 (合理)": (None, 15), "20 倍以下 (正常)": (None, 20), "25 倍以上 (成長)": (25, None)}
-    return mapping.get(option, (None, None))
+    return PE_RANGES.get(option, (None, None))
 
 def get_yield_range(option):
-    mapping = {"不拘": (None, None), "3% 以上 (及格)": (3, None), "5% 以上 (高股息)": (5, None), "7% 以上 (超高配)": (7, None), "1% 以下 (成長)": (0, 1)}
-    return mapping.get(option, (None, None))
+    return YIELD_RANGES.get(option, (None, None))
 
 def get_eps_range(option):
-    mapping = {
-        "不拘": (None, None), 
-        "0 元以上 (賺錢)": (0, None), 
-        "1.5 元以上 (及格)": (1.5, None),  # ★ NEW ★ 
-        "3 元以上 (穩健)": (3, None), 
-        "5 元以上 (高獲利)": (5, None), 
-        "10 元以上 (股王)": (10, None)
-    }
-    return mapping.get(option, (None, None))
+    return EPS_RANGES.get(option, (None, None))
 
 def get_price_range(option):
-    mapping = {
-        "不拘": (None, None), 
-        "100 元以上": (100, None), 
-        "30 ~ 100 元": (30, 100), 
-        "20 ~ 100 元": (20, 100),  # ★ NEW ★ 
-        "30 元以下": (0, 30)
-    }
-    return mapping.get(option, (None, None))
+    return PRICE_RANGES.get(option, (None, None))
 
 def get_change_range(option):
-    mapping = {"不拘": (None, None), "上漲 (> 0%)": (0, None), "強勢 (> 3%)": (3, None), "漲停 (> 9%)": (9, None), "下跌 (< 0%)": (None, 0), "跌深 (<-3%)": (None, -3)}
-    return mapping.get(option, (None, None))
+    return CHANGE_RANGES.get(option, (None, None))
 
 def get_volume_range(option):
-    mapping = {"不拘": (None, None), "500 張以上": (500*1000, None), "1000 張以上": (1000*1000, None), "5000 張以上": (5000*1000, None), "10000 張以上": (10000*1000, None)}
-    return mapping.get(option, (None, None))
+    return VOLUME_RANGES.get(option, (None, None))
 
 def get_beta_range(option):
-    mapping = {"不拘": (None, None), "大於 1 (活潑)": (1, None), "大於 1.5 (攻擊)": (1.5, None), "小於 1 (穩健)": (None, 1), "小於 0.5 (牛皮)": (None, 0.5)}
-    return mapping.get(option, (None, None))
+    return BETA_RANGES.get(option, (None, None))
 
 # --- 新增：營收與位階的選項邏輯 ---
 def get_revenue_range(option):
-    # 營收成長率 YoY (%)
-    return {"成長 (> 0%)": (0, None), "高成長 (> 20%)": (20, None), "爆發 (> 50%)": (50, None), "衰退 (< 0%)": (None, 0)}.get(option, (None, None))
+    return REVENUE_RANGES.get(option, (None, None))
+
+def get_eps_growth_range(option):
+    return EPS_GROWTH_RANGES.get(option, (None, None))
 
 def get_position_range(option):
-    # 位階 (0.0 ~ 1.0)
-    mapping = {
-        "不拘": (None, None),
-        "低基期 (0 ~ 0.4)": (0, 0.4),   # ★★★ 幫家人新增的這個專屬區間 ★★★
-        "底部 (0 ~ 0.2)": (0, 0.2), 
-        "低檔 (0.2 ~ 0.4)": (0.2, 0.4), 
-        "中階 (0.4 ~ 0.6)": (0.4, 0.6), 
-        "高檔 (0.6 ~ 0.8)": (0.6, 0.8), 
-        "頭部 (0.8 ~ 1.0)": (0.8, 1.0)
-    }
-    return mapping.get(option, (None, None))
+    return POSITION_RANGES.get(option, (None, None))
 
 # --- 新增：股本與營收連增的選項邏輯 ---
 def get_capital_range(option):
-    mapping = {
-        "不拘": (None, None),
-        "小型股 (< 10億)": (0, 10),
-        "中型股 (10億 ~ 50億)": (10, 50),
-        "中大型股 (10億 ~ 70億)": (10, 70),  # ★ NEW ★ 
-        "大型股 (> 50億)": (50, None),
-        "超大型權值股 (> 200億)": (200, None)
-    }
-    return mapping.get(option, (None, None))
+    return CAPITAL_RANGES.get(option, (None, None))
 
 def get_streak_range(option):
-    # 營收連續成長 (年/季)
-    mapping = {
-        "不拘": None,
-        "連增 1 年以上": 1,
-        "連增 2 年以上": 2,
-        "連增 3 年以上": 3,
-        "連增 5 年以上": 5
-    }
-    return mapping.get(option, None)
+    return STREAK_OPTIONS.get(option, None)
+
+def get_vol_spike_min(option):
+    return VOL_SPIKE_OPTIONS.get(option)
 
 # --- 策略管理函數 ---
 def save_user_preset(name, settings):
-    conn = get_connection()
+    conn = get_write_connection()
     try:
         # 將設定字典轉成 JSON 字串存入
         settings_json = json.dumps(settings, ensure_ascii=False)
@@ -487,7 +527,8 @@ def save_user_preset(name, settings):
         conn.close()
 
 def get_user_presets():
-    conn = get_connection()
+    # 策略是在 App 內寫進 stock_data.db 的；更新主機上唯讀連線讀的是發佈快照，改由寫入端讀，存完馬上看得到
+    conn = get_write_connection() if hot_db.cold_ready() else get_hot_connection()
     try:
         df = pd.read_sql("SELECT name, settings FROM user_presets", conn)
         return df.set_index('name')['settings'].to_dict()
@@ -497,33 +538,75 @@ def get_user_presets():
         conn.close()
 
 def get_gross_margin_range(option):
-    # 毛利率 (%)
-    mapping = {
-        "不拘": (None, None), 
-        "正毛利 (> 0%)": (0, None), 
-        "中毛利 (> 10%)": (10, None),
-        "高毛利 (> 20%)": (20, None), 
-        "超高毛利 (> 40%)": (40, None), 
-        "頂級毛利 (> 60%)": (60, None)
-    }
-    return mapping.get(option, (None, None))
-
-def get_consolidation_range(option):
-    # 盤整天數
-    mapping = {
-        "不拘": None,
-        "盤整 1 個月 (> 20天, ±10%)": (20, 0.1),
-        "盤整 3 個月 (> 60天, ±10%)": (60, 0.1),
-        "盤整半年 (> 120天, ±10%)": (120, 0.1),
-        "大箱型 3 個月 (> 60天, ±20%)": (60, 0.2), 
-        "大箱型半年 (> 120天, ±20%)": (120, 0.2)
+    return GROSS_MARGIN_RANGES.get(option, (None, None))
+
+def get_consolidation_range(option, custom=None):
+    if option == "自訂天數 / 區間" and custom:
+        days, pct = custom
+        return (days, pct / 100)
+
+    return CONSOLIDATION_OPTIONS.get(option, None)
+
+
+# 策略設定 (user_presets / default_strategies 的 key) → (區間對照表, 下限 key, 上限 key)
+STRATEGY_RANGE_FILTERS = {
+    'pe': (PE_RANGES, 'pe_min', 'pe_max'),
+    'price': (PRICE_RANGES, 'price_min', 'price_max'),
+    'yield': (YIELD_RANGES, 'yield_min', 'yield_max'),
+    'eps': (EPS_RANGES, 'eps_min', 'eps_max'),
+    'change': (CHANGE_RANGES, 'change_min', 'change_max'),
+    'beta': (BETA_RANGES, 'beta_min', 'beta_max'),
+    'revenue': (REVENUE_RANGES, 'rev_min', 'rev_max'),
+    'position': (POSITION_RANGES, 'pos_min', 'pos_max'),
+    'capital': (CAPITAL_RANGES, 'cap_min', 'cap_max'),
+    'vol5': (VOLUME_RANGES, 'vol_ma_min', 'vol_ma_max'),
+    'vol20': (VOLUME_RANGES, 'vol_ma20_min', 'vol_ma20_max'),
+    'eps_growth': (EPS_GROWTH_RANGES, 'eps_growth_min', 'eps_growth_max'),
+    'gross': (GROSS_MARGIN_RANGES, 'gross_min', 'gross_max'),
+}
+
+
+def settings_to_filters(settings, period='1y', consolidation_custom=None):
+    """把篩選畫面 / 策略的選項文字轉成 load_data 的 filters"""
+    industry = settings.get('industry') or []
+    filters = {
+        'industry': industry if "全部" not in industry else None,
+        'period': period,
+        'pb_min': None, 'pb_max': None,
+        'streak_min': get_streak_range(settings.get('streak')),
+        'vol_spike_min': get_vol_spike_min(settings.get('vol_spike')),
+        'consolidation_days': get_consolidation_range(settings.get('consolidation'), consolidation_custom),
     }
-    
-    return mapping.get(option, None)
+    for key, (ranges, low_key, high_key) in STRATEGY_RANGE_FILTERS.items():
+        filters[low_key], filters[high_key] = ranges.get(settings.get(key), (None, None))
+    return filters
+
+
+def count_strategy_matches(strategies, period='1y'):
+    # 所有策略一次用 bitmap 算出目前各符合幾檔 (舊資料庫沒有快照時回傳空 dict；
+    # 沒有高低點索引時 extrema_index 回傳空索引，3m / 6m / 3y 條件就是 0 檔，不必另外攔例外)
+    engine = get_screener_engine(get_data_token())
+    if engine is None:
+        return {}
+    filters_by_name = {name: settings_to_filters(settings, period) for name, settings in strategies.items()}
+    return engine.count_strategies(filters_by_name, index_position_lookup)
+
+
+def screener_buckets():
+    """選股引擎要預先建 bitmap 的桶：[(欄位, 下限, 上限)] 與盤整 [(天數, 門檻)]"""
+    column_of = {low: col for col, low, _ in screener_engine.NUMERIC_FILTERS}
+    ranges = []
+    for key, (options, low_key, _) in STRATEGY_RANGE_FILTERS.items():
+        columns = ['position_1y', 'position_2y'] if key == 'position' else [column_of[low_key]]
+        ranges += [(col, low, high) for col in columns for low, high in options.values()]
+    ranges += [('revenue_streak', n, None) for n in STREAK_OPTIONS.values()]
+    ranges += [('vol_spike', x, None) for x in VOL_SPIKE_OPTIONS.values()]
+    consolidation = [v for v in CONSOLIDATION_OPTIONS.values() if v]
+    return ranges, consolidation
 
 
 def delete_user_preset(name):
-    conn = get_connection()
+    conn = get_write_connection()
     conn.execute("DELETE FROM user_presets WHERE name=?", (name,))
     conn.commit()
     conn.close()
@@ -630,6 +713,41 @@ def render_family_overview():
 # 3. 主程式
 # ==========================================
 
+def record_first_render():
+    # 第一次完整跑完腳本的時間 (每個 session 只記一次)，並標示當時讀的是熱資料檔還是完整資料庫
+    if "time_to_first_render" not in st.session_state:
+        source = "完整資料庫" if hot_db.cold_ready() else "熱資料庫"
+        st.session_state.time_to_first_render = (time.time() - st.session_state.session_started, source)
+        print(f"⏱️ 首次渲染 {st.session_state.time_to_first_render[0]:.2f} 秒 ({source})")
+
+    seconds, source = st.session_state.time_to_first_render
+    status, cold_seconds = hot_db.cold_status()
+    cold_text = {
+        'ready': f"歷史資料已就緒 ({cold_seconds:.1f} 秒)" if cold_seconds is not None else "歷史資料已就緒",
+        'loading': "歷史資料背景載入中...",
+        'failed': "歷史資料載入失敗",
+    }[status]
+    st.sidebar.caption(f"⏱️ 首次渲染 {seconds:.2f} 秒 ({source})｜{cold_text}")
+
+
+def render_cache_debug_panel():
+    # 除錯面板：各共用快取的命中率與平均延遲
+    with st.sidebar.expander("🐞 快取統計", expanded=False):
+        stats = query_cache.all_stats()
+        if not stats:
+            st.caption("尚無快取紀錄")
+            return
+        st.dataframe(pd.DataFrame([{
+            '快取': s['name'],
+            '筆數': f"{s['entries']}/{s['max_entries']}",
+            '命中率': f"{s['hit_rate']:.0%}",
+            '命中': s['hits'],
+            '未命中': s['misses'],
+            '命中 ms': round(s['avg_hit_ms'], 2),
+            '未命中 ms': round(s['avg_miss_ms'], 1),
+        } for s in stats]), hide_index=True, width='stretch')
+
+
 def main():
     # --- 1. 初始化 Session State ---
     if "messages" not in st.session_state:  # ★ AI 聊天記錄
@@ -710,8 +828,8 @@ def main():
                 st.subheader("⚙️ 參數設定")
                 
                 # 1. 位階基準
-                period_mode = st.radio("位階計算基準", ["近 1 年 (標準)", "近 2 年 (長線)"], horizontal=True, key="period_radio_sidebar")
-                period_val = '2y' if "2" in period_mode else '1y'
+                period_mode = st.radio("位階計算基準", list(POSITION_PERIOD_OPTIONS), index=2, horizontal=True, key="period_radio_sidebar")
+                period_val = POSITION_PERIOD_OPTIONS[period_mode]
                 st.session_state['period_val'] = period_val
 
                 # 2. ★★★ 關鍵修正：把策略定義搬到這裡 (按鈕外面) ★★★
@@ -826,7 +944,11 @@ def main():
                     except: pass
                 
                 st.write("") 
-                selected_strat_name = st.selectbox("📂 載入策略", ["-- 請選擇 --"] + list(all_strategies.keys()), key="load_preset_sidebar")
+                strategy_counts = count_strategy_matches(all_strategies, period_val)
+                selected_strat_name = st.selectbox(
+                    "📂 載入策略", ["-- 請選擇 --"] + list(all_strategies.keys()), key="load_preset_sidebar",
+                    format_func=lambda n: f"{n} ({strategy_counts[n]} 檔)" if n in strategy_counts else n,
+                )
                 
                 if st.button("📥 套用此策略", width='stretch', key="apply_preset_btn"):
                     if selected_strat_name != "-- 請選擇 --":
@@ -971,7 +1093,7 @@ def main():
     elif st.session_state.current_main_page == "條件篩選 (Screener)":
         st.title("🎯 智慧選股儀表板")
         
-        conn = get_connection()
+        conn = get_hot_connection()
         
         # 1. 抓大盤健康度
         try:
@@ -1072,7 +1194,15 @@ def main():
                     current_period = st.session_state.get('period_val', '1y')
                     # ★★★ 關鍵修改：在陣列裡面補上 "低基期 (0 ~ 0.4)" ★★★
                     position_opt = st.selectbox(f"位階高低 ({current_period.upper()})", ["不拘", "低基期 (0 ~ 0.4)", "底部 (0 ~ 0.2)", "低檔 (0.2 ~ 0.4)", "中階 (0.4 ~ 0.6)", "高檔 (0.6 ~ 0.8)", "頭部 (0.8 ~ 1.0)"], key='sel_pos')
-                    consolidation_opt = st.selectbox("盤整型態", ["不拘", "盤整 1 個月 (> 20天, ±10%)", "盤整 3 個月 (> 60天, ±10%)", "盤整半年 (> 120天, ±10%)","大箱型 3 個月 (> 60天, ±20%)", "大箱型半年 (> 120天, ±20%)"], key='sel_consolidation')
+                    consolidation_opt = st.selectbox("盤整型態", ["不拘", "盤整 1 個月 (> 20天, ±10%)", "盤整 3 個月 (> 60天, ±10%)", "盤整半年 (> 120天, ±10%)","大箱型 3 個月 (> 60天, ±20%)", "大箱型半年 (> 120天, ±20%)", "自訂天數 / 區間"], key='sel_consolidation')
+                    consolidation_custom = None
+                    if consolidation_opt == "自訂天數 / 區間":
+                        cc1, cc2 = st.columns(2)
+                        with cc1:
+                            custom_days = st.number_input("盤整天數 ≥", min_value=1, max_value=400, value=60, step=5, key='sel_consolidation_days')
+                        with cc2:
+                            custom_pct = st.number_input("區間 ±%", min_value=1.0, max_value=50.0, value=15.0, step=1.0, key='sel_consolidation_pct')
+                        consolidation_custom = (custom_days, custom_pct)
                 with c2:
                     vol_ma5_opt = st.selectbox("5日均量 (週量)", ["不拘", "500 張以上", "1000 張以上", "5000 張以上", "10000 張以上"], key='sel_vol5')
                     vol_ma20_opt = st.selectbox("20日均量 (月量)", ["不拘", "500 張以上", "1000 張以上", "5000 張以上", "10000 張以上"], key='sel_vol20')
@@ -1098,56 +1228,22 @@ def main():
                 with c2:
                     yield_opt = st.selectbox("殖利率 (%)", ["不拘", "3% 以上 (及格)", "5% 以上 (高股息)", "7% 以上 (超高配)"], key='sel_yield')
 
-            # --- 邏輯轉換維持原樣 (不用改) ---
-            vol_map = {"不拘": None, "大於 1.5 倍": 1.5, "大於 2 倍 (倍增)": 2.0, "大於 3 倍 (爆量)": 3.0, "大於 5 倍 (天量)": 5.0}
-            vol_spike_min = vol_map.get(vol_spike_opt)
-            eps_map = {"成長 (> 0%)": (0, None), "高成長 (> 20%)": (20, None), "翻倍 (> 100%)": (100, None), "衰退 (< 0%)": (None, 0)}
-            eps_growth_min, eps_growth_max = eps_map.get(eps_growth_opt, (None, None))
-            pe_min, pe_max = get_pe_range(pe_opt)
-            price_min, price_max = get_price_range(price_opt)
-            yield_min, yield_max = get_yield_range(yield_opt)
-            eps_min, eps_max = get_eps_range(eps_opt)
-            change_min, change_max = get_change_range(change_opt)
-            beta_min, beta_max = get_beta_range(beta_opt)
-            rev_min, rev_max = get_revenue_range(revenue_opt)
-            pos_min, pos_max = get_position_range(position_opt)
-            cap_min, cap_max = get_capital_range(capital_opt)
-            streak_min = get_streak_range(streak_opt)
-            vol_ma5_min, vol_ma5_max = get_volume_range(vol_ma5_opt)
-            vol_ma20_min, vol_ma20_max = get_volume_range(vol_ma20_opt)
-            gross_min, gross_max = get_gross_margin_range(gross_opt)
-            consolidation_min = get_consolidation_range(consolidation_opt)
-
-
-            filters = {
-                'industry': selected_industry if "全部" not in selected_industry else None,
-                'period': st.session_state.get('period_val', '1y'),
-                'pe_min': pe_min, 'pe_max': pe_max, 'price_min': price_min, 'price_max': price_max,
-                'yield_min': yield_min, 'yield_max': yield_max, 'eps_min': eps_min, 'eps_max': eps_max,
-                'change_min': change_min, 'change_max': change_max, 
-                'beta_min': beta_min, 'beta_max': beta_max,
-                'rev_min': rev_min, 'rev_max': rev_max,
-                'streak_min': streak_min,
-                'cap_min': cap_min, 'cap_max': cap_max,
-                'pos_min': pos_min, 'pos_max': pos_max,
-                'pb_min': None, 'pb_max': None,
-                'vol_ma_min': vol_ma5_min, 'vol_ma_max': vol_ma5_max,
-                'vol_ma20_min': vol_ma20_min, 'vol_ma20_max': vol_ma20_max,
-                'vol_spike_min': vol_spike_min,
-                'eps_growth_min': eps_growth_min, 'eps_growth_max': eps_growth_max,
-                'gross_min': gross_min, 'gross_max': gross_max, 'consolidation_days': get_consolidation_range(consolidation_opt),
+            # --- 選項文字 → 篩選條件 (與套用策略共用同一套轉換) ---
+            screener_settings = {
+                "industry": selected_industry,
+                "price": price_opt, "capital": capital_opt, "change": change_opt,
+                "position": position_opt, "consolidation": consolidation_opt,
+                "vol5": vol_ma5_opt, "vol20": vol_ma20_opt, "vol_spike": vol_spike_opt, "beta": beta_opt,
+                "revenue": revenue_opt, "streak": streak_opt, "eps_growth": eps_growth_opt, "eps": eps_opt,
+                "gross": gross_opt, "pe": pe_opt, "yield": yield_opt,
             }
+            filters = settings_to_filters(screener_settings, st.session_state.get('period_val', '1y'), consolidation_custom)
+            filters['search'] = search_txt or None
 
         # --- 執行篩選 ---
         # ★★★ 修改 load_data: 必須要在 load_data SQL 裡加入 operating_margin, pretax_margin, net_margin ★★★
         # 請確保您在上面的 def load_data(filters) 裡面已經加入了這些欄位 (我會在下面提供修改後的 load_data)
         df_result = load_data(filters)
-        
-        if search_txt:
-            df_result = df_result[
-                df_result['stock_id'].astype(str).str.contains(search_txt) | 
-                df_result['name'].str.contains(search_txt)
-            ]
 
         st.markdown("---")
         
@@ -1190,7 +1286,7 @@ def main():
                 
                 # ★★★ 動態位階映射：根據 period 選擇 position_1y 或 position_2y ★★★
                 current_period = st.session_state.get('period_val', '1y')
-                pos_source = 'position_2y' if current_period == '2y' else 'position_1y'
+                pos_source = get_position_column(current_period)
                 df_show['position'] = df_show[pos_source] if pos_source in df_show.columns else 0
 
                 # 2. 補齊欄位 (加入週/月均量)
@@ -1354,23 +1450,13 @@ def main():
 
                         # 4. K 線圖
                         st.write("") 
-                        hist = load_stock_history(selected_stock_id)
-                        
-                        if not hist.empty:
-                            for c in ['open', 'high', 'low', 'close', 'ma_5', 'ma_20', 'volume']:
-                                hist[c] = pd.to_numeric(hist[c], errors='coerce')
-                            
-                            c_chart, c_blank = st.columns([1, 3])
-                            with c_chart:
-                                chart_type = st.radio("週期", ["日線", "週線"], horizontal=True, label_visibility="collapsed", key='chart_period_screener')
+                        c_chart, c_blank = st.columns([1, 2])
+                        with c_chart:
+                            chart_type = st.radio("週期", list(chart_pyramid.LEVELS), horizontal=True, label_visibility="collapsed", key='chart_period_screener')
 
-                            if chart_type == "週線":
-                                plot_data = resample_to_weekly(hist)
-                            else:
-                                plot_data = hist
-                                
-                            fig = plot_candlestick(plot_data, selected_stock_id, row['name'], chart_type)
-                            
+                        fig = get_stock_chart(selected_stock_id, row['name'], chart_type)
+                        
+                        if fig is not None:
                             # ★★★ 關鍵修正：config 設定 ★★★
                             st.plotly_chart(
                                 fig, 
@@ -1419,8 +1505,8 @@ def main():
 
                     col_opt1, col_opt2 = st.columns(2)
                     with col_opt1:
-                        period_mode = st.radio("位階基準", ["近 1 年", "近 2 年"], horizontal=True)
-                        period_val = '2y' if "2" in period_mode else '1y'
+                        period_mode = st.radio("位階基準", list(POSITION_PERIOD_OPTIONS), index=2, horizontal=True)
+                        period_val = POSITION_PERIOD_OPTIONS[period_mode]
                     with col_opt2:
                         st.write("") 
                         st.write("") 
@@ -1493,10 +1579,7 @@ def main():
                                 sim_show['vol_ma_5'] = pd.to_numeric(sim_show['vol_ma_5'], errors='coerce').fillna(0) / 1000
                                 sim_show['vol_ma_20'] = pd.to_numeric(sim_show['vol_ma_20'], errors='coerce').fillna(0) / 1000
 
-                                # ★★★ 動態位階映射：根據 period 選擇 position_1y 或 position_2y ★★★
-                                period_val = st.session_state.get('period_val', '1y')
-                                pos_source = 'position_2y' if period_val == '2y' else 'position_1y'
-                                sim_show['position'] = sim_show[pos_source] if pos_source in sim_show.columns else 0
+                                # position 由 find_similar_stocks 依本頁選的位階基準算好 (與相似度權重用的是同一個區間)
 
                                 # 補齊欄位
                                 all_cols = [
@@ -1626,22 +1709,12 @@ def main():
                                         st.write("") # 空行
 
                                         # 3. K 線圖區塊
-                                        chart_type_ai = st.radio("K 線週期", ["日線", "週線"], horizontal=True, key='chart_period_ai', label_visibility="collapsed")
+                                        chart_type_ai = st.radio("K 線週期", list(chart_pyramid.LEVELS), horizontal=True, key='chart_period_ai', label_visibility="collapsed")
 
-                                        hist = load_stock_history(target_stock['stock_id'])
+                                        # 繪圖 (圖表快取優先)
+                                        fig = get_stock_chart(target_stock['stock_id'], target_stock['name'], chart_type_ai)
                                         
-                                        if not hist.empty:
-                                            for c in ['open', 'high', 'low', 'close', 'ma_5', 'ma_20', 'volume']:
-                                                hist[c] = pd.to_numeric(hist[c], errors='coerce')
-                                            
-                                            if chart_type_ai == "週線":
-                                                plot_data = resample_to_weekly(hist)
-                                            else:
-                                                plot_data = hist
-                                            
-                                            # 繪圖
-                                            fig = plot_candlestick(plot_data, target_stock['stock_id'], target_stock['name'], chart_type_ai)
-                                            
+                                        if fig is not None:
                                             # ★★★ 關鍵修正：套用跟 Page 1 完全一樣的 Chart Config ★★★
                                             st.plotly_chart(
                                                 fig, 
@@ -1692,3 +1765,5 @@ def main():
 
 if __name__ == "__main__":
     main()
+    record_first_render()
+    render_cache_debug_panel()
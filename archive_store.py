@@ -0,0 +1,124 @@
+# archive_store.py - 過期日 K / 週 K 分年封存 (取代 DELETE + 全檔 VACUUM)
+# 主資料庫只保留近 5 年；更舊的列依年份搬到 archive/{表名}_{年}.db，
+# 每天只搬移剛滑出保留期的那一兩天，釋放的頁面由 auto_vacuum=INCREMENTAL 分批歸還。
+# 封存檔可隨時 ATTACH 回來做長期分析 (見 open_long_history)。
+# ⚠️ archive/ 只存在更新程式所在的主機，不隨資料庫發佈 (也不進 git)：
+#    Streamlit Cloud 與差異檔套用端仍只有近 5 年；GitHub Actions 手動備援執行時搬出的列會隨 runner 一起消失。
+#
+# 用法:
+#   python archive_store.py                 列出封存檔
+#   python archive_store.py --archive       立即把超過保留期的資料搬進封存檔
+
+import sys
+import time
+import sqlite3
+import database
+
+ARCHIVE_DIR = database.PROJECT_DIR / "archive"
+ARCHIVE_TABLES = ('daily_prices', 'weekly_prices')
+RETENTION = '-5 years'
+
+
+def archive_path(table, year):
+    return ARCHIVE_DIR / f"{table}_{year}.db"
+
+
+def _table_exists(conn, table):
+    return conn.execute(
+        "SELECT COUNT(*) FROM main.sqlite_master WHERE type IN ('table', 'view') AND name = ?", (table,)
+    ).fetchone()[0] > 0
+
+
+# 以 (stock_id, date) 主鍵逐檔跳躍 (loose index scan)：只碰每檔的最舊幾列，不必掃整張表
+EXPIRED_SQL = '''
+    WITH RECURSIVE ids(sid) AS (
+        SELECT MIN(stock_id) FROM main.{table}
+        UNION ALL
+        SELECT (SELECT MIN(stock_id) FROM main.{table} WHERE stock_id > sid) FROM ids WHERE sid IS NOT NULL
+    )
+    SELECT substr(d.date, 1, 4) AS year, d.stock_id
+    FROM ids JOIN main.{table} d ON d.stock_id = ids.sid AND d.date < ?
+    GROUP BY year, d.stock_id
+'''
+
+
+def _archive_year(conn, table, year, stock_ids, before):
+    """把 stock_ids 在 year 年且早於 before 的列搬進該年封存檔，回傳筆數"""
+    ARCHIVE_DIR.mkdir(exist_ok=True)
+    conn.execute("ATTACH DATABASE ? AS arch", (str(archive_path(table, year)),))
+    try:
+        # 欄位跟著主表走 (含精簡格式的 VIEW)，(stock_id, date) 唯一，重複封存會覆蓋
+        conn.execute(f"CREATE TABLE IF NOT EXISTS arch.{table} AS SELECT * FROM main.{table} WHERE 0")
+        conn.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS arch.idx_{table}_stock_date ON {table} (stock_id, date)")
+        where = f"stock_id IN ({', '.join(['?'] * len(stock_ids))}) AND date >= ? AND date < ?"
+        params = list(stock_ids) + [f"{year}-01-01", min(before, f"{int(year) + 1}-01-01")]
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(f"INSERT OR REPLACE INTO arch.{table} SELECT * FROM main.{table} WHERE {where}", params)
+            moved = conn.execute(f"DELETE FROM main.{table} WHERE {where}", params).rowcount
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    finally:
+        conn.execute("DETACH DATABASE arch")
+    return moved
+
+
+def archive_expired_rows(conn, before=None):
+    """
+    把早於 before (預設為 5 年前) 的 ARCHIVE_TABLES 資料搬進分年封存檔
+    conn 需為 isolation_level=None (ATTACH 不能在交易中執行)；回傳 {表名: 筆數}
+    """
+    if before is None:
+        before = conn.execute("SELECT date('now', ?)", (RETENTION,)).fetchone()[0]
+    started = time.time()
+    moved = {}
+    for table in ARCHIVE_TABLES:
+        if not _table_exists(conn, table):
+            continue
+        by_year = {}
+        for year, stock_id in conn.execute(EXPIRED_SQL.format(table=table), (before,)).fetchall():
+            by_year.setdefault(year, []).append(stock_id)
+        moved[table] = sum(_archive_year(conn, table, year, ids, before) for year, ids in sorted(by_year.items()))
+    if any(moved.values()):
+        print(f"🗄️ 封存早於 {before} 的資料：" + "，".join(f"{t} {n} 筆" for t, n in moved.items())
+              + f"，耗時 {time.time() - started:.2f} 秒")
+    return moved
+
+
+def list_archives(table='daily_prices'):
+    """[(年份, 路徑), ...] 依年份排序"""
+    return sorted((path.stem.rsplit('_', 1)[1], path) for path in ARCHIVE_DIR.glob(f"{table}_*.db"))
+
+
+def open_long_history(conn, table='daily_prices', years=None):
+    """
+    把封存檔 ATTACH 到 conn，建立 TEMP VIEW {table}_all = 主表 UNION ALL 各年封存
+    years 可限定年份；回傳 VIEW 名稱 (SQLite 預設最多同時 ATTACH 10 個檔案)
+    """
+    selects = [f"SELECT * FROM main.{table}"]
+    attached = {row[1] for row in conn.execute("PRAGMA database_list").fetchall()}
+    for year, path in list_archives(table):
+        if years is not None and year not in {str(y) for y in years}:
+            continue
+        alias = f"arch_{table}_{year}"
+        if alias not in attached:
+            conn.execute(f"ATTACH DATABASE ? AS {alias}", (str(path),))
+        selects.append(f"SELECT * FROM {alias}.{table}")
+    view = f"{table}_all"
+    conn.execute(f"DROP VIEW IF EXISTS temp.{view}")
+    conn.execute(f"CREATE TEMP VIEW {view} AS " + " UNION ALL ".join(selects))
+    return view
+
+
+if __name__ == "__main__":
+    if '--archive' in sys.argv:
+        conn = sqlite3.connect(database.DB_NAME, isolation_level=None)
+        archive_expired_rows(conn)
+        database.incremental_vacuum(conn)
+        conn.close()
+    for table in ARCHIVE_TABLES:
+        for year, path in list_archives(table):
+            count = sqlite3.connect(path).execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+            print(f"   {path.name:<28}{count:>10} 筆{path.stat().st_size / 1024 / 1024:>10.1f} MB")
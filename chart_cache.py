@@ -0,0 +1,160 @@
+# chart_cache.py - 個股 K 線圖的磁碟快取 (序列化的 Plotly figure JSON)
+# 同一檔股票在篩選器、AI 相似股頁面被反覆點開，每次都要 pandas 切資料 + make_subplots 重建一樣的圖。
+# 改為 key = (股票代號, 週期, data_versions) 存成 chart_cache/*.json，畫面顯示只需讀檔；
+# 資料版本一變舊檔就不會再被命中，由總大小上限 + LRU (以檔案修改時間當最近使用時間) 淘汰。
+# 快取目錄不隨資料庫發佈：App 還原 / 套用差異檔、資料版本改變後，在背景執行緒預熱自選股與今日爆量前幾名
+# (見 hot_db.schedule_derived_refresh)，家人第一次點開也不必等。
+#
+# 用法:
+#   python chart_cache.py              顯示快取資訊
+#   python chart_cache.py --prewarm    依目前資料版本預熱
+#   python chart_cache.py --clear      清空快取
+
+import os
+import sys
+import time
+import json
+import hashlib
+import database
+import chart_pyramid
+
+CACHE_DIR = database.PROJECT_DIR / "chart_cache"
+MAX_BYTES = 64 * 1024 * 1024
+PREWARM_TOP = 50
+# 背景預熱跟使用者搶同一個行程的 CPU，只預熱預設顯示的日線；其他週期第一次點開時才建
+PREWARM_PERIODS = chart_pyramid.LEVELS[:1]
+
+
+def cache_path(stock_id, period, version):
+    digest = hashlib.sha1(repr((period, version)).encode('utf-8')).hexdigest()[:16]
+    return CACHE_DIR / f"{stock_id}_{digest}.json"
+
+
+def get_figure(stock_id, period, version):
+    """
+    命中回傳 figure dict (可直接交給 st.plotly_chart) 並更新最近使用時間；沒有快取 (或剛好被淘汰) 回傳 None
+    不再轉回 go.Figure：st.plotly_chart 本身會驗證一次，這裡再建一次物件只是重工
+    """
+    path = cache_path(stock_id, period, version)
+    try:
+        text = path.read_text(encoding='utf-8')
+    except OSError:
+        return None
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+    return json.loads(text)
+
+
+def put_figure(stock_id, period, version, fig):
+    """寫入暫存檔再 os.replace (同時讀取的 session 不會讀到一半)，寫完檢查總大小"""
+    CACHE_DIR.mkdir(exist_ok=True)
+    path = cache_path(stock_id, period, version)
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    tmp_path.write_text(fig.to_json(), encoding='utf-8')
+    os.replace(tmp_path, path)
+    evict()
+    return path
+
+
+def get_or_build(stock_id, period, version, build):
+    """快取優先 (回傳 dict)；沒有才呼叫 build() 建圖並存檔，回傳新建的 go.Figure (build 回傳 None 代表沒有資料，不存)"""
+    fig = get_figure(stock_id, period, version)
+    if fig is None:
+        fig = build()
+        if fig is not None:
+            put_figure(stock_id, period, version, fig)
+    return fig
+
+
+def _entries():
+    entries = []
+    for path in CACHE_DIR.glob("*.json"):
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+    return entries
+
+
+def evict(max_bytes=MAX_BYTES):
+    """總大小超過上限時，從最久沒用到的檔案開始刪，回傳刪除數量"""
+    entries = _entries()
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        path.unlink(missing_ok=True)
+        total -= size
+        removed += 1
+    return removed
+
+
+def clear():
+    for _, _, path in _entries():
+        path.unlink(missing_ok=True)
+
+
+def prewarm_stock_ids(conn, top=PREWARM_TOP):
+    """自選股 + 今日爆量前 top 名 (篩選器最常被點開的一群)"""
+    stock_ids = []
+    queries = [
+        ("SELECT stock_id FROM watchlist ORDER BY added_date", ()),
+        ("SELECT stock_id FROM latest_stock_snapshot WHERE vol_spike IS NOT NULL ORDER BY vol_spike DESC LIMIT ?", (top,)),
+    ]
+    for sql, params in queries:
+        try:
+            rows = conn.execute(sql, params).fetchall()
+        except Exception:
+            rows = []   # 舊資料庫沒有這張表
+        for (stock_id,) in rows:
+            if stock_id not in stock_ids:
+                stock_ids.append(stock_id)
+    return stock_ids
+
+
+def prewarm(conn=None, stock_ids=None, periods=PREWARM_PERIODS):
+    """依目前資料版本預先建好 stock_ids (預設見 prewarm_stock_ids) 各週期的圖，回傳新建的張數"""
+    should_close = False
+    if conn is None:
+        conn = database.get_connection(read_only=True)
+        should_close = True
+
+    started = time.time()
+    built = 0
+    try:
+        version = database.get_data_versions_token(conn)
+        if stock_ids is None:
+            stock_ids = prewarm_stock_ids(conn)
+        names = dict(conn.execute("SELECT stock_id, name FROM stocks").fetchall())
+        for stock_id in stock_ids:
+            if all(cache_path(stock_id, period, version).exists() for period in periods):
+                continue
+            pyramid = chart_pyramid.load_pyramid(conn, stock_id)
+            if not pyramid:
+                continue
+            for period in periods:
+                if not cache_path(stock_id, period, version).exists():
+                    put_figure(stock_id, period, version,
+                               chart_pyramid.plot_stock_chart(pyramid, stock_id, names.get(stock_id, ''), period))
+                    built += 1
+    finally:
+        if should_close:
+            conn.close()
+
+    print(f"🖼️ 圖表快取預熱：{len(stock_ids)} 檔、新建 {built} 張，耗時 {time.time() - started:.1f} 秒")
+    return built
+
+
+if __name__ == "__main__":
+    if '--clear' in sys.argv:
+        clear()
+    if '--prewarm' in sys.argv:
+        database.ensure_database()
+        prewarm()
+    entries = _entries()
+    print(f"🖼️ chart_cache/：{len(entries)} 張圖，{sum(size for _, size, _ in entries) / 1024 / 1024:.1f} MB "
+          f"(上限 {MAX_BYTES / 1024 / 1024:.0f} MB)")
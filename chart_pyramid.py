@@ -0,0 +1,219 @@
+# chart_pyramid.py - K 線圖多層解析度 (日 K / 週 K / 月 K / 長期總覽) 的讀取、切層與繪圖
+# 不依賴 Streamlit：App 與背景的圖表快取預熱 (chart_cache.py) 共用同一套畫法
+# 原本每次畫圖都把 1800 根日 K + 均線 + 成交量整包送到瀏覽器，手機 / 平板畫起來很吃力。
+# 改為每檔股票先切好幾層，畫面依選擇的週期只送那一層：
+#   日線  最近 DAILY_BARS 根 (約一年，預設畫面只看最近 120 根)
+#   週線 / 月線  涵蓋完整歷史，根數少
+#   總覽  全部日收盤以 LTTB (Largest-Triangle-Three-Buckets) 降到 OVERVIEW_POINTS 點，保留高低轉折的形狀
+
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
+from plotly.subplots import make_subplots
+
+LEVELS = ('日線', '週線', '月線', '總覽')
+HISTORY_DAYS = 1800
+HISTORY_DTYPES = {c: 'float64' for c in ('open', 'high', 'low', 'close', 'volume', 'ma_5', 'ma_20', 'ma_60')}
+DAILY_BARS = 250
+OVERVIEW_POINTS = 400
+
+# 開盤取第一天，收盤取最後一天，高取最高，低取最低，量取總和
+OHLCV_LOGIC = {'open': 'first', 'high': 'max', 'low': 'min', 'close': 'last', 'volume': 'sum'}
+
+
+def read_daily_history(conn, stock_id, days=HISTORY_DAYS):
+    """最近 days 根日 K (由舊到新)，日期與數值欄位在讀取時就轉好型別"""
+    # 由新到舊取 (走 (stock_id, date) 主鍵，不讀整段歷史)，再翻回由舊到新
+    df = pd.read_sql("""
+        SELECT date, open, high, low, close, volume, ma_5, ma_20, ma_60
+        FROM daily_prices
+        WHERE stock_id = ?
+        ORDER BY date DESC
+        LIMIT ?
+    """, conn, params=(stock_id, days), dtype=HISTORY_DTYPES, parse_dates=['date'])
+    return df.iloc[::-1].reset_index(drop=True)
+
+
+def read_weekly_history(conn, stock_id):
+    """預先算好的週 K (weekly_prices)；資料庫還沒有這張表時回傳空 DataFrame"""
+    try:
+        df = pd.read_sql("""
+            SELECT date, open, high, low, close, volume, ma_5, ma_20
+            FROM weekly_prices
+            WHERE stock_id = ?
+            ORDER BY date ASC
+        """, conn, params=(stock_id,))
+        df['date'] = pd.to_datetime(df['date'])
+    except Exception:
+        df = pd.DataFrame()
+    return df
+
+
+def resample_bars(daily, rule):
+    """日 K → 週 K ('W-FRI') / 月 K ('ME')，缺值的區間剔除，並重算 MA5 / MA20"""
+    bars = daily.resample(rule, on='date').agg(OHLCV_LOGIC).dropna().reset_index()
+    bars['ma_5'] = bars['close'].rolling(5).mean()
+    bars['ma_20'] = bars['close'].rolling(20).mean()
+    return bars
+
+
+def lttb_indices(x, y, threshold):
+    """
+    LTTB 降採樣：回傳要保留的索引 (一定包含頭尾)
+    中間的點平均分成 threshold - 2 桶，每桶挑與「前一個選中點、下一桶平均點」圍出三角形面積最大的那一點
+    """
+    n = len(y)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+    a = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        next_start, next_end = (edges[i + 1], edges[i + 2]) if i + 2 < len(edges) else (n - 1, n)
+        avg_x = x[next_start:next_end].mean()
+        avg_y = y[next_start:next_end].mean()
+        area = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(np.argmax(area))
+        selected[i + 1] = a
+    return selected
+
+
+def build_pyramid(daily, weekly=None):
+    """
+    daily: 由舊到新的日 K (date 為 datetime)；weekly: 預先算好的週 K (weekly_prices)，沒有就由日 K 重算
+    回傳 {層級: DataFrame}，沒有資料時為空 dict
+    """
+    if daily.empty:
+        return {}
+    closes = daily.dropna(subset=['close']).reset_index(drop=True)
+    keep = lttb_indices(np.arange(len(closes), dtype=np.float64), closes['close'].to_numpy(dtype=np.float64), OVERVIEW_POINTS)
+    return {
+        '日線': daily.tail(DAILY_BARS).reset_index(drop=True),
+        '週線': weekly if weekly is not None and not weekly.empty else resample_bars(daily, 'W-FRI'),
+        '月線': resample_bars(daily, 'ME'),
+        '總覽': closes.loc[keep, ['date', 'close']].reset_index(drop=True),
+    }
+
+
+def load_pyramid(conn, stock_id):
+    """直接由資料庫讀取並切層 (App 以外的地方使用；App 走自己的 LRU)"""
+    daily = read_daily_history(conn, stock_id)
+    return build_pyramid(daily, read_weekly_history(conn, stock_id))
+
+
+def plot_candlestick(df, stock_id, name, period_type="日線"):
+    title_text = f'{stock_id} {name} - {period_type}走勢'
+
+    # 1. 資料處理：確保日期是「真實的 Datetime 格式」(不要轉成字串)；df 可能來自快取，不直接改欄位
+    dates = pd.to_datetime(df['date'])
+    # 只有日線需要跳過週末；WebGL 線條不支援 rangebreaks，所以日線的均線維持 SVG
+    daily = period_type == "日線"
+    line_trace = go.Scatter if daily else go.Scattergl
+    
+    # 2. 建立子圖
+    fig = make_subplots(
+        rows=2, cols=1, 
+        shared_xaxes=True,
+        vertical_spacing=0.05,   # 稍微拉近一點上下圖的距離
+        subplot_titles=(title_text, '成交量'),
+        row_heights=[0.7, 0.3]
+    )
+    
+    # 3. K線圖 (上圖) - 注意：x 改用 df['date']
+    fig.add_trace(go.Candlestick(
+        x=dates, 
+        open=df['open'], high=df['high'], low=df['low'], close=df['close'], 
+        name='K線',
+        increasing_line_color='#FF4B4B', decreasing_line_color='#00FF7F',
+        showlegend=False
+    ), row=1, col=1)
+    
+    # 4. 均線 (上圖)
+    fig.add_trace(line_trace(x=dates, y=df['ma_5'], mode='lines', name='MA5', line=dict(color='orange', width=1.5)), row=1, col=1)
+    fig.add_trace(line_trace(x=dates, y=df['ma_20'], mode='lines', name='MA20', line=dict(color='#BA55D3', width=1.5)), row=1, col=1)
+    
+    # 5. 成交量 (下圖)
+    vol_colors = np.where(df['close'].to_numpy() >= df['open'].to_numpy(), '#FF4B4B', '#00FF7F')
+    fig.add_trace(go.Bar(
+        x=dates, 
+        y=df['volume'], 
+        marker_color=vol_colors, 
+        name='成交量',
+        showlegend=False
+    ), row=2, col=1)
+    
+    # ==========================================
+    # ★★★ 終極優化區：時間軸 (Date Axis) 縮放設定 ★★★
+    # ==========================================
+    
+    # 取得歷史資料的「最老日期」與「最新日期」
+    min_date = dates.min()
+    max_date = dates.max() + pd.Timedelta(days=5) # 保留右邊 5 天的呼吸空間
+
+    # A. 計算預設顯示範圍 (約 120 根 K 棒 = 半年)
+    if len(df) > 120:
+        start_date = dates.iloc[-120]
+        initial_range = [start_date, max_date]
+        
+        # 成交量 Y 軸上限：只看這半年的最大量
+        recent_vol = df['volume'].tail(120)
+        vol_max = recent_vol.max() * 1.1 
+    else:
+        initial_range = None
+        vol_max = df['volume'].max() * 1.1 if not df.empty else 1000
+
+    # B. 全局 Layout 設定
+    fig.update_layout(
+        height=600,
+        template="plotly_dark",
+        margin=dict(l=50, r=20, t=50, b=20), 
+        xaxis_rangeslider_visible=False,     
+        dragmode='pan',                      
+        hovermode="x unified",               
+        yaxis2=dict(range=[0, vol_max], showgrid=False),
+        yaxis=dict(showgrid=True, gridcolor='rgba(255,255,255,0.1)')
+    )
+    
+    # C. X 軸終極設定 (套用至所有子圖)
+    fig.update_xaxes(
+        type="date",                         
+        range=initial_range,                 
+        minallowed=min_date,                 # ★ 關鍵：鎖定左邊界 (禁止拉到比第一筆資料更早)
+        maxallowed=max_date,                 # ★ 關鍵：鎖定右邊界 (禁止拉到遙遠的未來)
+        rangebreaks=[
+            dict(bounds=["sat", "mon"])      
+        ] if daily else None,
+        showgrid=True,
+        gridcolor='rgba(255,255,255,0.05)',
+        nticks=8                             
+    )
+    
+    return fig
+
+
+def plot_overview(df, stock_id, name):
+    # 長期總覽：LTTB 降採樣後的收盤價折線 (WebGL)，一次看完整段歷史
+    fig = go.Figure(go.Scattergl(
+        x=pd.to_datetime(df['date']), y=df['close'], mode='lines', name='收盤價',
+        line=dict(color='#FF4B4B', width=1.5)
+    ))
+    fig.update_layout(
+        title=f'{stock_id} {name} - 長期總覽',
+        height=600,
+        template="plotly_dark",
+        margin=dict(l=50, r=20, t=50, b=20),
+        dragmode='pan',
+        hovermode="x unified",
+        yaxis=dict(showgrid=True, gridcolor='rgba(255,255,255,0.1)')
+    )
+    fig.update_xaxes(type="date", showgrid=True, gridcolor='rgba(255,255,255,0.05)', nticks=8)
+    return fig
+
+
+def plot_stock_chart(pyramid, stock_id, name, period_type="日線"):
+    # 只送選定週期那一層的資料到瀏覽器
+    if period_type == "總覽":
+        return plot_overview(pyramid[period_type], stock_id, name)
+    return plot_candlestick(pyramid[period_type], stock_id, name, period_type)
@@ -0,0 +1,311 @@
+# compact_prices.py - daily_prices 精簡儲存格式 (整數日期 + 價格 x100 整數 + WITHOUT ROWID)
+# 實體表 daily_prices_compact 以 (stock_id, day) 為叢集主鍵，day = 1970-01-01 起算的天數；
+# 價格若剛好是兩位小數就存成 x100 的整數 (無損)，否則保留原始 REAL。
+# 原本的 daily_prices 改為同名 VIEW (欄位名稱與型態不變)，INSTEAD OF 觸發器讓既有的
+# INSERT OR REPLACE / DELETE / UPDATE 照常運作，其他程式不用修改。
+# 注意：透過 VIEW 以 date 篩選 / 取 MAX(date) 時無法用到主鍵索引 (date 是換算出來的)，
+# 這類查詢會變慢；是否轉換請先用 --report 看實際數字。
+#
+# 用法:
+#   python compact_prices.py --report    在暫存目錄建立兩種格式比較：檔案大小、xz 大小、區間查詢延遲 (不動正式資料庫)
+#   python compact_prices.py --migrate   把正式資料庫轉成精簡格式
+#   python compact_prices.py --revert    轉回原本的 daily_prices 實體表
+
+import os
+import sys
+import time
+import lzma
+import sqlite3
+import tempfile
+from datetime import datetime, timedelta
+from pathlib import Path
+import database
+
+COMPACT_TABLE = 'daily_prices_compact'
+PRICE_COLUMNS = ('open', 'high', 'low', 'close')
+OTHER_COLUMNS = (('volume', 'INTEGER'), ('change_pct', 'REAL'), ('ma_5', 'REAL'), ('ma_20', 'REAL'), ('ma_60', 'REAL'))
+EPOCH_JULIAN_DAY = 2440587.5    # julianday('1970-01-01')
+
+
+def _legacy_table_sql(other_columns=OTHER_COLUMNS):
+    other_ddl = ', '.join(f"{name} {col_type}" for name, col_type in other_columns)
+    return f'''
+        CREATE TABLE IF NOT EXISTS daily_prices (
+            stock_id TEXT, date TEXT,
+            open REAL, high REAL, low REAL, close REAL,
+            {other_ddl},
+            FOREIGN KEY(stock_id) REFERENCES stocks(stock_id),
+            PRIMARY KEY (stock_id, date)
+        )
+    '''
+
+
+def _encode_day(expr):
+    return f"CAST(julianday({expr}) - {EPOCH_JULIAN_DAY} AS INTEGER)"
+
+
+def _decode_day(expr):
+    return f"date({expr} + {EPOCH_JULIAN_DAY})"
+
+
+def _encode_price(expr):
+    # 兩位小數的價格 → 整數 (分)；其他值 (例如還原權值後的價格) 原樣保留為 REAL，確保無損
+    return f"CASE WHEN round({expr} * 100) / 100.0 = {expr} THEN CAST(round({expr} * 100) AS INTEGER) ELSE {expr} END"
+
+
+def _decode_price(expr):
+    return f"CASE WHEN typeof({expr}) = 'integer' THEN {expr} / 100.0 ELSE {expr} END"
+
+
+def get_other_columns(conn, table='daily_prices'):
+    """
+    daily_prices 除了主鍵與 OHLC 以外的欄位 [(名稱, 型態)]，依表內順序
+    舊資料庫可能還有 weekly_ma_5 / weekly_ma_20 等欄位，轉換時一併保留
+    """
+    columns = [(row[1], row[2] or 'REAL') for row in conn.execute(f"PRAGMA table_info({table})").fetchall()]
+    others = [(name, col_type) for name, col_type in columns if name not in ('stock_id', 'date', 'day') + PRICE_COLUMNS]
+    return others or list(OTHER_COLUMNS)
+
+
+def _encoded_values(prefix, other_columns=OTHER_COLUMNS):
+    """INSERT 用的欄位運算式：prefix 為 'NEW.' 或來源表別名"""
+    return ', '.join(
+        [f"{prefix}stock_id", _encode_day(f"{prefix}date")]
+        + [_encode_price(f"{prefix}{c}") for c in PRICE_COLUMNS]
+        + [f"{prefix}{name}" for name, _ in other_columns]
+    )
+
+
+def _compact_columns(other_columns):
+    return ', '.join(('stock_id', 'day') + PRICE_COLUMNS + tuple(name for name, _ in other_columns))
+
+
+def create_compact_schema(cursor, other_columns=OTHER_COLUMNS):
+    """建立精簡實體表 + daily_prices 相容 VIEW + 寫入用觸發器 (daily_prices 名稱必須尚未被使用)"""
+    other_ddl = ', '.join(f"{name} {col_type}" for name, col_type in other_columns)
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS {COMPACT_TABLE} (
+            stock_id TEXT NOT NULL,
+            day INTEGER NOT NULL,          -- 1970-01-01 起算的天數
+            open INTEGER, high INTEGER, low INTEGER, close INTEGER,   -- x100 整數，無法無損轉換時為 REAL
+            {other_ddl},
+            PRIMARY KEY (stock_id, day)
+        ) WITHOUT ROWID
+    ''')
+    columns = ', '.join(
+        ['stock_id', f"{_decode_day('day')} AS date"]
+        + [f"{_decode_price(c)} AS {c}" for c in PRICE_COLUMNS]
+        + [name for name, _ in other_columns]
+    )
+    cursor.execute(f"CREATE VIEW daily_prices AS SELECT {columns} FROM {COMPACT_TABLE}")
+
+    all_columns = _compact_columns(other_columns)
+    key_filter = f"stock_id = OLD.stock_id AND day = {_encode_day('OLD.date')}"
+    # 外層敘述的 OR REPLACE / OR IGNORE 會套用到觸發器內的 INSERT
+    cursor.execute(f'''
+        CREATE TRIGGER daily_prices_insert INSTEAD OF INSERT ON daily_prices
+        BEGIN
+            INSERT INTO {COMPACT_TABLE} ({all_columns}) VALUES ({_encoded_values('NEW.', other_columns)});
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER daily_prices_delete INSTEAD OF DELETE ON daily_prices
+        BEGIN
+            DELETE FROM {COMPACT_TABLE} WHERE {key_filter};
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER daily_prices_update INSTEAD OF UPDATE ON daily_prices
+        BEGIN
+            DELETE FROM {COMPACT_TABLE} WHERE {key_filter};
+            INSERT OR REPLACE INTO {COMPACT_TABLE} ({all_columns}) VALUES ({_encoded_values('NEW.', other_columns)});
+        END
+    ''')
+
+
+def is_compact(conn):
+    row = conn.execute("SELECT type FROM sqlite_master WHERE name = 'daily_prices'").fetchone()
+    return row is not None and row[0] == 'view'
+
+
+def _vacuum(db_path):
+    vacuum_conn = sqlite3.connect(db_path, isolation_level=None)
+    vacuum_conn.execute("VACUUM")
+    vacuum_conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    vacuum_conn.close()
+
+
+def migrate_to_compact(conn=None, vacuum=True):
+    """把 daily_prices 實體表轉成精簡格式 (單一交易)，回傳搬移筆數"""
+    should_close = False
+    if conn is None:
+        conn = database.get_connection()
+        should_close = True
+
+    if is_compact(conn):
+        print("✅ daily_prices 已是精簡格式")
+        if should_close:
+            conn.close()
+        return 0
+
+    started = time.time()
+    other_columns = get_other_columns(conn)
+    cursor = conn.cursor()
+    conn.commit()
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        cursor.execute("ALTER TABLE daily_prices RENAME TO daily_prices_legacy")
+        create_compact_schema(cursor, other_columns)
+        cursor.execute(f'''
+            INSERT INTO {COMPACT_TABLE} ({_compact_columns(other_columns)})
+            SELECT {_encoded_values('', other_columns)} FROM daily_prices_legacy ORDER BY stock_id, date
+        ''')
+        moved = cursor.rowcount
+        cursor.execute("DROP TABLE daily_prices_legacy")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        if should_close:
+            conn.close()
+
+    if vacuum:
+        _vacuum(database.DB_NAME)
+    print(f"✅ daily_prices 已轉為精簡格式：{moved:,} 筆，耗時 {time.time() - started:.1f} 秒")
+    return moved
+
+
+def revert_to_legacy(conn=None, vacuum=True):
+    """精簡格式轉回原本的 daily_prices 實體表"""
+    should_close = False
+    if conn is None:
+        conn = database.get_connection()
+        should_close = True
+
+    if not is_compact(conn):
+        print("✅ daily_prices 已是原本的實體表")
+        if should_close:
+            conn.close()
+        return 0
+
+    other_columns = get_other_columns(conn, COMPACT_TABLE)
+    cursor = conn.cursor()
+    conn.commit()
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        rows = cursor.execute("SELECT * FROM daily_prices ORDER BY stock_id, date").fetchall()
+        cursor.execute("DROP VIEW daily_prices")     # 觸發器隨 VIEW 一併刪除
+        cursor.execute(_legacy_table_sql(other_columns))
+        cursor.executemany(f"INSERT INTO daily_prices VALUES ({', '.join(['?'] * (6 + len(other_columns)))})", rows)
+        cursor.execute(f"DROP TABLE {COMPACT_TABLE}")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        if should_close:
+            conn.close()
+
+    if vacuum:
+        _vacuum(database.DB_NAME)
+    print(f"✅ daily_prices 已轉回實體表：{len(rows):,} 筆")
+    return len(rows)
+
+
+def _xz_size(path, preset=9):
+    compressor = lzma.LZMACompressor(preset=preset)
+    size = 0
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            size += len(compressor.compress(chunk))
+    return size + len(compressor.flush())
+
+
+def _time_query(conn, sql, params_list, repeat=3):
+    """回傳每次查詢的平均毫秒數 (先跑一輪暖快取)"""
+    for params in params_list:
+        conn.execute(sql, params).fetchall()
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for params in params_list:
+            conn.execute(sql, params).fetchall()
+    return (time.perf_counter() - started) * 1000 / (repeat * len(params_list))
+
+
+def compare_layouts(sample_size=20, preset=9):
+    """
+    把目前的 daily_prices 分別以原格式與精簡格式複製到暫存資料庫 (只含 daily_prices)，
+    比較檔案大小、xz 壓縮後大小與常見查詢延遲
+    """
+    source = database.get_connection(read_only=True)
+    other_columns = get_other_columns(source, COMPACT_TABLE if is_compact(source) else 'daily_prices')
+    rows = source.execute("SELECT * FROM daily_prices ORDER BY stock_id, date").fetchall()
+    sample = [r[0] for r in source.execute(
+        "SELECT stock_id FROM stocks ORDER BY random() LIMIT ?", (sample_size,)).fetchall()]
+    latest = source.execute("SELECT MAX(date) FROM daily_prices").fetchone()[0]
+    source.close()
+    if not rows:
+        print("⚠️ daily_prices 無資料")
+        return
+
+    recent = (datetime.strptime(latest, '%Y-%m-%d') - timedelta(days=365)).strftime('%Y-%m-%d')
+    queries = {
+        '單檔全歷史': ("SELECT date, open, high, low, close, volume FROM daily_prices WHERE stock_id = ? ORDER BY date",
+                  [(sid,) for sid in sample]),
+        '單檔近一年': ("SELECT date, close FROM daily_prices WHERE stock_id = ? AND date >= ? ORDER BY date",
+                  [(sid, recent) for sid in sample]),
+        '各檔最新日期': ("SELECT stock_id, MAX(date) FROM daily_prices GROUP BY stock_id", [()]),
+        '單日橫斷面': ("SELECT stock_id, close FROM daily_prices WHERE date = ?", [(latest,)]),
+    }
+    direct_query = (f"SELECT day, close FROM {COMPACT_TABLE} WHERE stock_id = ? AND day >= {_encode_day('?')} ORDER BY day",
+                    [(sid, recent) for sid in sample])
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for layout in ('原格式', '精簡格式'):
+            db_path = str(Path(tmp_dir) / f"{'legacy' if layout == '原格式' else 'compact'}.db")
+            conn = sqlite3.connect(db_path)
+            cursor = conn.cursor()
+            if layout == '原格式':
+                cursor.execute(_legacy_table_sql(other_columns))
+            else:
+                create_compact_schema(cursor, other_columns)
+            cursor.executemany(f"INSERT INTO daily_prices VALUES ({', '.join(['?'] * (6 + len(other_columns)))})", rows)
+            conn.commit()
+            conn.close()
+            _vacuum(db_path)
+
+            conn = sqlite3.connect(db_path)
+            timings = {name: _time_query(conn, sql, params) for name, (sql, params) in queries.items()}
+            if layout == '精簡格式':
+                timings['單檔近一年 (直接查實體表)'] = _time_query(conn, *direct_query)
+                # 抽查：透過 VIEW 讀回的資料必須與原始資料完全相同
+                round_trip = conn.execute("SELECT * FROM daily_prices ORDER BY stock_id, date").fetchall()
+                lossless = round_trip == rows
+            conn.close()
+            results[layout] = {'size': os.path.getsize(db_path), 'xz': _xz_size(db_path, preset), 'timings': timings}
+
+    legacy, compact = results['原格式'], results['精簡格式']
+    print(f"📏 daily_prices {len(rows):,} 筆，抽樣 {len(sample)} 檔，xz preset={preset}")
+    print(f"{'項目':<24}{'原格式':>14}{'精簡格式':>14}{'比例':>10}")
+    for label, key in (('資料庫大小 (MB)', 'size'), ('xz 壓縮後 (MB)', 'xz')):
+        print(f"{label:<24}{legacy[key] / 1024 / 1024:>14.2f}{compact[key] / 1024 / 1024:>14.2f}{compact[key] / legacy[key]:>10.0%}")
+    for name, ms in compact['timings'].items():
+        base = legacy['timings'].get(name)
+        base_text = f"{base:>14.3f}" if base is not None else f"{'-':>14}"
+        ratio = f"{ms / base:>10.2f}x" if base else f"{'':>10}"
+        print(f"{name + ' (ms)':<24}{base_text}{ms:>14.3f}{ratio}")
+    print(f"🔍 VIEW 讀回與原始資料{'完全一致' if lossless else '不一致 ⚠️'}")
+    return results
+
+
+if __name__ == "__main__":
+    if '--report' in sys.argv:
+        compare_layouts()
+    elif '--migrate' in sys.argv:
+        migrate_to_compact()
+    elif '--revert' in sys.argv:
+        revert_to_legacy()
+    else:
+        print("使用方式: python compact_prices.py --report | --migrate | --revert")
@@ -0,0 +1,177 @@
+# consolidation.py - 全市場盤整天數向量化引擎 + 門檻斷點
+# 一次把全部股票排成矩陣計算，並預存「盤整天數在哪些 ±X% 門檻會改變」，
+# 選股時任意 X 都能直接查表，不必重掃歷史
+#
+# 用法:
+#   python consolidation.py            重算全市場盤整天數與斷點
+#   python consolidation.py --verify   與逐筆迴圈版本比對
+
+import sys
+import time
+import numpy as np
+import database
+from price_store import load_price_history_store
+
+CONSOLIDATION_LOOKBACK = 400    # 與原本 calculate_consolidation_days 相同：往回最多看 400 天
+MIN_HISTORY = 5                 # 不足 5 筆一律視為 0 天
+
+
+def init_consolidation_table(cursor):
+    # 每列代表：門檻放寬到 threshold (含) 時，盤整天數變成 days
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS consolidation_breakpoints (
+            stock_id TEXT,
+            threshold REAL,
+            days INTEGER,
+            PRIMARY KEY (stock_id, threshold)
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_consolidation_bp_days ON consolidation_breakpoints(days, threshold)")
+
+
+def running_max_deviation(current, past):
+    """
+    current: (N,) 今日收盤；past: (N, L) 往回的收盤 (第 0 欄為前一天，NaN 代表沒有資料)
+    回傳 (N, L) 的「到第 k 天為止最大偏離 |p / current - 1|」，遇到無效值之後一律為 inf
+    盤整天數(X) = 這一列中 <= X 的個數
+    """
+    current = np.asarray(current, dtype=np.float64)[:, None]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        deviation = np.abs(past - current) / current
+    deviation[~np.isfinite(deviation) | ~(current > 0)] = np.inf
+    return np.maximum.accumulate(deviation, axis=1)
+
+
+def days_at_threshold(max_dev, threshold):
+    """(N, L) 累積最大偏離 → 每檔在 ±threshold 內的盤整天數"""
+    return (max_dev <= threshold).sum(axis=1)
+
+
+def consolidation_days(closes, threshold=0.10):
+    """單一序列版本 (舊 → 新)，結果與 compute_consolidation 的矩陣版本相同"""
+    closes = np.asarray(closes, dtype=np.float64)
+    if len(closes) < MIN_HISTORY:
+        return 0
+    past = closes[:-1][-CONSOLIDATION_LOOKBACK:][::-1]
+    return int(days_at_threshold(running_max_deviation(closes[-1:], past[None, :]), threshold)[0])
+
+
+def build_window_matrix(store, lookback=CONSOLIDATION_LOOKBACK):
+    """
+    由 PriceHistoryStore 組出 (今日收盤, 往回 lookback 天的矩陣, 有效筆數)
+    矩陣每列由新到舊，資料不足的位置補 NaN
+    """
+    starts = store.offsets[:-1]
+    ends = store.offsets[1:]
+    lengths = np.minimum(ends - starts, lookback + 1)
+
+    steps = np.arange(lookback + 1)
+    idx = ends[:, None] - 1 - steps[None, :]
+    valid = steps[None, :] < lengths[:, None]
+    window = np.where(valid, store.close[np.where(valid, idx, 0)], np.nan)
+    return window[:, 0], window[:, 1:], lengths
+
+
+def extract_breakpoints(stock_ids, max_dev, eligible):
+    """
+    累積最大偏離每次變大的位置就是斷點：門檻到達該值時盤整天數跳成 (位置 + 1)
+    回傳 [(stock_id, threshold, days), ...]
+    """
+    finite = np.isfinite(max_dev)
+    changes = np.ones_like(finite)
+    changes[:, :-1] = max_dev[:, :-1] != max_dev[:, 1:]
+    rows, cols = np.nonzero(changes & finite & eligible[:, None])
+    return [(stock_ids[r], float(max_dev[r, c]), int(c + 1)) for r, c in zip(rows, cols)]
+
+
+def compute_consolidation(store, thresholds=(0.10, 0.20)):
+    """
+    全市場一次計算：回傳 ({threshold: days 陣列}, 斷點列表)
+    """
+    current, past, lengths = build_window_matrix(store)
+    max_dev = running_max_deviation(current, past)
+    eligible = lengths >= MIN_HISTORY
+
+    days = {t: np.where(eligible, days_at_threshold(max_dev, t), 0) for t in thresholds}
+    breakpoints = extract_breakpoints(store.stock_ids, max_dev, eligible)
+    return days, breakpoints
+
+
+def refresh_consolidation(conn=None, stock_ids=None):
+    """
+    重算盤整天數 (±10% / ±20%) 寫回 stocks，並重建門檻斷點表
+    stock_ids 有指定時只重算這些股票 (本次有新 K 棒的股票)，否則全市場
+    """
+    should_close = False
+    if conn is None:
+        conn = database.get_connection()
+        should_close = True
+
+    print(f"\n📦 盤整天數 (向量化，{'全市場' if stock_ids is None else f'{len(stock_ids)} 檔'})...")
+    started = time.time()
+    store = load_price_history_store(conn, days=CONSOLIDATION_LOOKBACK + 1, stock_ids=stock_ids)
+    if not len(store):
+        print("⚠️ daily_prices 無資料，跳過盤整計算")
+        if should_close:
+            conn.close()
+        return 0
+
+    days, breakpoints = compute_consolidation(store)
+
+    cursor = conn.cursor()
+    init_consolidation_table(cursor)
+    cursor.executemany(
+        "UPDATE stocks SET consolidation_days = ?, consolidation_days_20 = ? WHERE stock_id = ?",
+        [(int(d10), int(d20), sid) for sid, d10, d20 in zip(store.stock_ids, days[0.10], days[0.20])]
+    )
+    if stock_ids is None:
+        cursor.execute("DELETE FROM consolidation_breakpoints")
+    else:
+        cursor.executemany("DELETE FROM consolidation_breakpoints WHERE stock_id = ?", [(sid,) for sid in store.stock_ids])
+    cursor.executemany(
+        "INSERT INTO consolidation_breakpoints (stock_id, threshold, days) VALUES (?, ?, ?)",
+        breakpoints
+    )
+    conn.commit()
+
+    if should_close:
+        conn.close()
+    print(f"✅ 盤整天數完成：{len(store)} 檔，斷點 {len(breakpoints):,} 筆，耗時 {time.time() - started:.2f} 秒")
+    return len(store)
+
+
+def verify_consolidation(conn=None, thresholds=(0.05, 0.10, 0.15, 0.20, 0.30)):
+    """與逐筆迴圈版本比對：矩陣結果與斷點查表結果都要一致"""
+    store = load_price_history_store(conn, days=CONSOLIDATION_LOOKBACK + 1)
+    days, breakpoints = compute_consolidation(store, thresholds)
+
+    by_stock = {}
+    for sid, threshold, d in breakpoints:
+        by_stock.setdefault(sid, []).append((threshold, d))
+
+    mismatched = 0
+    for i, sid in enumerate(store.stock_ids):
+        closes = store.get_arrays(sid)[1]
+        for t in thresholds:
+            # 逐筆迴圈 (原始寫法)
+            expected = 0
+            if len(closes) >= MIN_HISTORY:
+                current = closes[-1]
+                for price in closes[:-1][-CONSOLIDATION_LOOKBACK:][::-1]:
+                    if abs(price - current) / current <= t:
+                        expected += 1
+                    else:
+                        break
+            from_table = max([d for bt, d in by_stock.get(sid, []) if bt <= t], default=0)
+            if days[t][i] != expected or from_table != expected:
+                mismatched += 1
+                print(f"   ⚠️ {sid} ±{t:.0%}: 迴圈 {expected} / 矩陣 {days[t][i]} / 斷點 {from_table}")
+
+    print(f"🔍 驗證 {len(store)} 檔 x {len(thresholds)} 種門檻，{mismatched} 筆不一致")
+    return mismatched
+
+
+if __name__ == "__main__":
+    if '--verify' in sys.argv:
+        sys.exit(1 if verify_consolidation() else 0)
+    refresh_consolidation()
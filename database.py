@@ -1,32 +1,287 @@
 # database.py
-import lzma
-import shutil
+import os
 import sqlite3
+import threading
 from pathlib import Path
+import xz_blocks
+import db_delta
 
 PROJECT_DIR = Path(__file__).resolve().parent
 DB_PATH = PROJECT_DIR / "stock_data.db"
 DB_XZ_PATH = PROJECT_DIR / "stock_data.db.xz"
 DB_NAME = str(DB_PATH)
+# 更新主機才有：通過健康檢查的發佈快照 (db_snapshot.py)，唯讀連線優先讀它，更新程式寫 stock_data.db 時 App 不受影響
+SNAPSHOT_PATH = PROJECT_DIR / "stock_data.snapshot.db"
 
 
-def ensure_database():
-    """Restore the runtime SQLite DB from the GitHub-friendly compressed copy."""
-    if DB_PATH.exists():
-        return
-
+def restore_base_database():
+    """由 stock_data.db.xz (base) 還原資料庫，完成後讓共用連線改連新檔"""
     if not DB_XZ_PATH.exists():
         raise FileNotFoundError(f"找不到資料庫：{DB_PATH} 或 {DB_XZ_PATH}")
 
     print("正在解壓縮資料庫 (LZMA)...")
-    with lzma.open(DB_XZ_PATH, "rb") as f_in:
-        with DB_PATH.open("wb") as f_out:
-            shutil.copyfileobj(f_in, f_out)
-    print("解壓縮完成！")
+    # 多區塊 .xz 會平行解壓縮；舊的單一 stream 檔案照原本方式串流解壓
+    # 先解壓到暫存檔，換檔前才動到正在使用中的 stock_data.db
+    restore_path = DB_PATH.with_name(DB_PATH.name + '.restore')
+    streams = xz_blocks.decompress_file(DB_XZ_PATH, restore_path)
+    # 舊檔的 -wal / -shm 留著的話，新檔會被當成它們的主檔而讀到舊頁面 (甚至寫壞)：
+    # 先讓共用連線失效，刪掉舊的 WAL 檔，最後才 rename
+    # (其他執行緒手上的舊連線仍開著舊檔的 inode，查詢照常完成，下次 get_connection 時才自行重連)
+    close_cached_connections()
+    remove_wal_files()
+    os.replace(restore_path, DB_PATH)
+    print(f"解壓縮完成！({streams} 個區塊)")
+
+
+def remove_wal_files(path=DB_PATH):
+    for suffix in ('-wal', '-shm'):
+        Path(f"{path}{suffix}").unlink(missing_ok=True)
+
+
+_restore_lock = threading.Lock()
+
+
+def ensure_database():
+    """Restore the runtime SQLite DB from the GitHub-friendly compressed copy, then replay daily deltas."""
+    if not DB_PATH.exists():
+        # 背景還原與前景請求可能同時進來，只讓一條執行緒解壓縮
+        with _restore_lock:
+            if not DB_PATH.exists():
+                restore_base_database()
+    # deltas/manifest.json 沒變動時只是一次 stat
+    db_delta.apply_pending_deltas(DB_NAME, restore_base=restore_base_database)
+
+# 每條連線都會套用的 PRAGMA：WAL 讓讀寫互不阻塞、NORMAL 在 WAL 下仍保證一致性，
+# mmap / cache 讓重複讀取直接走記憶體，暫存表與排序也放在記憶體
+CONNECTION_PRAGMAS = {
+    'synchronous': 'NORMAL',
+    'mmap_size': 256 * 1024 * 1024,     # 256 MB
+    'cache_size': -64 * 1024,           # 負值單位為 KiB → 64 MB
+    'temp_store': 'MEMORY',
+}
+
+_local = threading.local()
+_connection_generation = 0
+
+
+class ReusableConnection(sqlite3.Connection):
+    """reuse 模式的共用連線：呼叫端照舊 close() 也不會真的關閉，由 close_cached_connections() 統一處理"""
+
+    def close(self):
+        pass
+
+    def really_close(self):
+        super().close()
 
-def get_connection():
+
+def _apply_pragmas(conn, read_only=False):
+    if not read_only:
+        # auto_vacuum 必須在切換 WAL / 建表之前設定才會對新資料庫生效；舊資料庫要 VACUUM 一次才轉換 (見 incremental_vacuum)
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        # journal_mode 會寫進資料庫檔頭，只要設定一次，之後所有連線 (含唯讀) 都是 WAL
+        conn.execute("PRAGMA journal_mode=WAL")
+    for name, value in CONNECTION_PRAGMAS.items():
+        conn.execute(f"PRAGMA {name}={value}")
+    return conn
+
+
+def _open_connection(read_only=False, factory=sqlite3.Connection, path=DB_PATH):
+    if read_only:
+        conn = sqlite3.connect(f"{Path(path).as_uri()}?mode=ro", uri=True, timeout=30, factory=factory)
+    else:
+        conn = sqlite3.connect(str(path), timeout=30, factory=factory)
+    return _apply_pragmas(conn, read_only)
+
+
+def reader_path():
+    """唯讀連線要開的檔案：有發佈快照就讀快照 (更新主機)，否則讀 stock_data.db"""
+    return SNAPSHOT_PATH if SNAPSHOT_PATH.exists() else DB_PATH
+
+
+def get_connection(read_only=False, reuse=False):
+    """
+    read_only: 以 mode=ro 開啟 (UI 讀取用，不會誤寫也不會搶寫入鎖)；更新主機上讀的是發佈快照 (見 reader_path)
+    reuse: 同一個執行緒共用一條連線 (Streamlit 每次 rerun 不必重新連線、重新暖 cache)
+    """
     ensure_database()
-    return sqlite3.connect(DB_NAME, timeout=30)
+    path = reader_path() if read_only else DB_PATH
+    if not reuse:
+        return _open_connection(read_only, path=path)
+
+    key = 'ro' if read_only else 'rw'
+    cached = getattr(_local, key, None)
+    identity = _file_identity(path)
+    if cached is not None and cached[0] == _connection_generation and cached[1] == identity:
+        return cached[2]
+    if cached is not None:
+        if cached[1] != identity:
+            # 其他行程換上了新的資料庫檔 (更新腳本重新還原、發佈新快照)，舊連線還指著舊檔
+            print("🔄 偵測到新版資料庫檔案，重新連線")
+        cached[2].really_close()
+    conn = _open_connection(read_only, factory=ReusableConnection, path=path)
+    setattr(_local, key, (_connection_generation, identity, conn))
+    return conn
+
+
+def _file_identity(path=DB_PATH):
+    # 檔案被 os.replace / 刪除重建時 inode 會改變；一次 stat 的成本
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_dev, stat.st_ino
+
+
+def close_cached_connections():
+    """
+    讓所有執行緒的共用連線失效 (例如資料庫檔要被替換時)
+    只關閉呼叫端自己的連線；其他執行緒 (別的 Streamlit session) 可能正在查詢，
+    它們下次 get_connection 看到版本號改變時才自行關閉、重新連線
+    """
+    global _connection_generation
+    _connection_generation += 1
+    for key in ('ro', 'rw'):
+        cached = getattr(_local, key, None)
+        if cached is not None:
+            cached[2].really_close()
+            setattr(_local, key, None)
+
+
+# 每次維護最多歸還的空頁數 (4096 bytes × 2048 = 8 MB)，成本只跟當天刪除量有關，不必重寫整個檔案
+INCREMENTAL_VACUUM_PAGES = 2048
+
+
+def incremental_vacuum(conn, max_pages=INCREMENTAL_VACUUM_PAGES):
+    """
+    分批歸還空頁 (max_pages=None 表示全部歸還)，回傳 (歸還頁數, 剩餘空頁數)
+    舊資料庫尚未啟用 auto_vacuum=INCREMENTAL 時，先做一次完整 VACUUM 轉換 (之後就不再需要)
+    conn 需為 isolation_level=None (VACUUM 不能在交易中執行)
+    """
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        print("🧹 資料庫啟用 auto_vacuum=INCREMENTAL (一次性完整 VACUUM)...")
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("VACUUM")
+        return 0, conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+    before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    # 每 step 只歸還一頁，Python 的 execute 對無結果欄位的 PRAGMA 只 step 一次，改用 executescript 跑到完
+    conn.executescript("PRAGMA incremental_vacuum" if max_pages is None else f"PRAGMA incremental_vacuum({int(max_pages)})")
+    remaining = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    return before - remaining, remaining
+
+
+def benchmark_connections(iterations=200):
+    """比較連線 + 讀取延遲：原本的預設連線 vs 調校後每次新開 vs 調校後共用"""
+    import time
+    ensure_database()
+    conn = get_connection()     # 確保已切換成 WAL
+    stock_id = (conn.execute("SELECT stock_id FROM stocks LIMIT 1").fetchone() or ('',))[0]
+    conn.close()
+
+    queries = {
+        '連線+單筆': ("SELECT name FROM stocks WHERE stock_id = ?", (stock_id,)),
+        '個股歷史': ("SELECT date, open, high, low, close, volume FROM daily_prices WHERE stock_id = ? ORDER BY date", (stock_id,)),
+        '全市場表': ("SELECT * FROM stocks", ()),
+    }
+    modes = {
+        '預設 connect': lambda: sqlite3.connect(DB_NAME, timeout=30),
+        '調校 (每次新開)': lambda: get_connection(read_only=True),
+        '調校 + 共用': lambda: get_connection(read_only=True, reuse=True),
+    }
+
+    print(f"⏱️ 連線 / 讀取延遲 (平均 ms，{iterations} 次，股票 {stock_id})")
+    print(f"{'模式':<16}" + ''.join(f"{name:>12}" for name in queries))
+    for mode_name, connect in modes.items():
+        cells = []
+        for sql, params in queries.values():
+            started = time.perf_counter()
+            for _ in range(iterations):
+                c = connect()
+                c.execute(sql, params).fetchall()
+                c.close()
+            cells.append((time.perf_counter() - started) * 1000 / iterations)
+        print(f"{mode_name:<16}" + ''.join(f"{ms:>12.3f}" for ms in cells))
+    close_cached_connections()
+
+
+def init_data_versions_table(cursor):
+    # 各種衍生資料 (快照等) 的版本號，每次刷新 +1，讀取端可據此判斷是否需要重新載入
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS data_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER,
+            updated_at TEXT
+        )
+    ''')
+
+
+def bump_data_version(cursor, name):
+    """版本號 +1 並回傳新版本 (請在同一個交易內與資料異動一起提交)"""
+    from datetime import datetime
+    init_data_versions_table(cursor)
+    cursor.execute('''
+        INSERT INTO data_versions (name, version, updated_at) VALUES (?, 1, ?)
+        ON CONFLICT(name) DO UPDATE SET version = version + 1, updated_at = excluded.updated_at
+    ''', (name, datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+    cursor.execute("SELECT version FROM data_versions WHERE name = ?", (name,))
+    return cursor.fetchone()[0]
+
+
+def get_data_version(conn, name):
+    """取得目前版本號，尚未記錄時回傳 0"""
+    try:
+        row = conn.execute("SELECT version FROM data_versions WHERE name = ?", (name,)).fetchone()
+    except sqlite3.OperationalError:
+        return 0
+    return row[0] if row else 0
+
+
+def get_data_versions_token(conn):
+    """所有 data_versions 的 (名稱, 版本)，作為快取 key 的一部分；更新程式發佈新資料時就會改變"""
+    try:
+        return tuple(conn.execute("SELECT name, version FROM data_versions ORDER BY name").fetchall())
+    except sqlite3.OperationalError:
+        return ()
+
+def init_change_log_table(cursor):
+    # 每次更新 (run_id) 有哪些股票出現異動：prices = 有新 K 棒、fundamentals = 基本面變動、revenue = 新月營收
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stock_change_log (
+            run_id TEXT,
+            stock_id TEXT,
+            kind TEXT,
+            changed_at TEXT,
+            PRIMARY KEY (run_id, stock_id, kind)
+        )
+    ''')
+
+
+def record_stock_changes(cursor, run_id, stock_ids, kind):
+    from datetime import datetime
+    init_change_log_table(cursor)
+    now_str = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    cursor.executemany(
+        "INSERT OR IGNORE INTO stock_change_log (run_id, stock_id, kind, changed_at) VALUES (?, ?, ?, ?)",
+        [(run_id, sid, kind, now_str) for sid in stock_ids]
+    )
+
+
+def get_changed_stocks(conn, run_id, kinds=None):
+    """取得某次更新的異動股票集合，kinds 可限定異動種類"""
+    sql = "SELECT DISTINCT stock_id FROM stock_change_log WHERE run_id = ?"
+    params = [run_id]
+    if kinds:
+        sql += f" AND kind IN ({', '.join(['?'] * len(kinds))})"
+        params += list(kinds)
+    try:
+        return {row[0] for row in conn.execute(sql, params).fetchall()}
+    except sqlite3.OperationalError:
+        return set()
+
+
+def prune_change_log(cursor, keep_days=30):
+    init_change_log_table(cursor)
+    cursor.execute("DELETE FROM stock_change_log WHERE changed_at < datetime('now', 'localtime', ?)", (f'-{keep_days} days',))
 
 def init_db():
     conn = get_connection()
@@ -89,4 +344,8 @@ def init_db():
     print("資料庫結構初始化完成 (含 Market Stats)！")
 
 if __name__ == "__main__":
-    init_db()
+    import sys
+    if '--benchmark' in sys.argv:
+        benchmark_connections()
+    else:
+        init_db()
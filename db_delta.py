@@ -0,0 +1,349 @@
+# db_delta.py - 每日差異檔發佈與套用
+# 平常只發佈「本次異動的資料列」(小型 SQLite 檔，xz 壓縮) 到 deltas/，定期才重新發佈完整的 stock_data.db.xz (base)。
+# 還原時 database.ensure_database 先解壓 base，再依 manifest 順序套用尚未套用過的差異檔。
+#
+# deltas/manifest.json:
+#   {"base": {"id", "created_at", "size", "schema"}, "deltas": [{"name", "file", "created_at", "size"}, ...]}
+#
+# 用法:
+#   python db_delta.py            顯示 manifest 與本機資料庫的套用狀態
+#   python db_delta.py --apply    套用尚未套用的差異檔
+
+import os
+import sys
+import json
+import hashlib
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+import xz_blocks
+
+PROJECT_DIR = Path(__file__).resolve().parent
+DELTA_DIR = PROJECT_DIR / "deltas"
+MANIFEST_PATH = DELTA_DIR / "manifest.json"
+
+FULL_BASE_EVERY_DAYS = 7        # base 超過 7 天就重新發佈完整資料庫
+MAX_DELTA_RATIO = 0.5           # 差異檔總大小超過 base 的一半也重新發佈
+
+# (資料表, 篩選方式, 是否依股票整批取代)
+# 整批取代：先刪掉這些股票在本機的全部資料列再寫入 (適用沒有主鍵或會整批重建的表)
+DELTA_TABLES = (
+    ('stocks', 'dirty', False),
+    ('daily_prices', 'prices_since', False),
+    ('monthly_revenue', 'updated_since_run', False),
+    ('market_stats', 'updated_since_run', False),
+    # 衍生表也一併帶上，套用後不必在 Streamlit 端重算
+    ('latest_stock_snapshot', 'dirty', True),
+    ('weekly_prices', 'prices_since', False),
+    ('consolidation_breakpoints', 'prices', True),
+    ('extrema_index', 'prices', False),
+    ('indicator_state', 'prices', False),
+    ('data_versions', 'all', False),
+)
+DELTA_FILTERS = {
+    'dirty': "stock_id IN (SELECT stock_id FROM temp.delta_dirty)",
+    'prices': "stock_id IN (SELECT stock_id FROM temp.delta_prices)",
+    'prices_since': "stock_id IN (SELECT stock_id FROM temp.delta_prices) AND date >= :since",
+    'updated_since_run': "updated_at >= :run_id",
+    'all': "1",
+}
+PRUNE_TABLES = ('daily_prices', 'weekly_prices')
+
+
+def init_applied_deltas_table(cursor):
+    # 本機資料庫已包含哪些 base / 差異檔 (發佈端產生時即視為已套用)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS applied_deltas (
+            name TEXT PRIMARY KEY,
+            kind TEXT,              -- base / delta
+            applied_at TEXT
+        )
+    ''')
+
+
+def _mark_applied(cursor, name, kind):
+    init_applied_deltas_table(cursor)
+    cursor.execute(
+        "INSERT OR REPLACE INTO applied_deltas (name, kind, applied_at) VALUES (?, ?, ?)",
+        (name, kind, datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+    )
+
+
+def _applied_names(conn):
+    try:
+        return {row[0] for row in conn.execute("SELECT name FROM applied_deltas").fetchall()}
+    except sqlite3.OperationalError:
+        return set()
+
+
+def read_manifest():
+    try:
+        with MANIFEST_PATH.open('r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def _write_manifest(manifest):
+    DELTA_DIR.mkdir(exist_ok=True)
+    tmp_path = MANIFEST_PATH.with_suffix('.json.tmp')
+    with tmp_path.open('w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, MANIFEST_PATH)
+
+
+def schema_signature(conn):
+    """資料表結構的雜湊：結構一變就必須發佈新的 base (差異檔只搬資料列)"""
+    rows = conn.execute(
+        "SELECT type, name, sql FROM sqlite_master WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%' ORDER BY type, name"
+    ).fetchall()
+    return hashlib.sha1(json.dumps(rows).encode('utf-8')).hexdigest()
+
+
+# ==========================================
+# 發佈端
+# ==========================================
+
+def needs_full_base(conn, manifest=None):
+    """回傳 (是否需要完整 base, 原因)"""
+    manifest = manifest if manifest is not None else read_manifest()
+    if manifest is None or not manifest.get('base'):
+        return True, '尚未有 base'
+    base = manifest['base']
+    if base['id'] not in _applied_names(conn):
+        return True, '本機資料庫不是由目前的 base 還原'
+    if datetime.now() - datetime.strptime(base['created_at'], '%Y-%m-%d %H:%M:%S') >= timedelta(days=FULL_BASE_EVERY_DAYS):
+        return True, f'base 已超過 {FULL_BASE_EVERY_DAYS} 天'
+    if sum(d['size'] for d in manifest.get('deltas', [])) > base['size'] * MAX_DELTA_RATIO:
+        return True, '差異檔累積過大'
+    if schema_signature(conn) != base.get('schema'):
+        return True, '資料表結構有變動'
+    return False, ''
+
+
+def export_delta(conn, run_id, dirty_ids, price_ids, since=None, prune_before=None):
+    """
+    把本次異動的資料列寫成差異檔並加入 manifest，回傳差異檔路徑
+    conn 必須是 autocommit 連線 (isolation_level=None)，ATTACH 不能在交易中執行
+    """
+    manifest = read_manifest()
+    name = datetime.strptime(run_id, '%Y-%m-%d %H:%M:%S').strftime('delta_%Y%m%d_%H%M%S')
+    DELTA_DIR.mkdir(exist_ok=True)
+    xz_path = DELTA_DIR / f"{name}.db.xz"
+
+    cursor = conn.cursor()
+    cursor.execute("CREATE TEMP TABLE IF NOT EXISTS delta_dirty (stock_id TEXT PRIMARY KEY)")
+    cursor.execute("CREATE TEMP TABLE IF NOT EXISTS delta_prices (stock_id TEXT PRIMARY KEY)")
+    cursor.execute("DELETE FROM temp.delta_dirty")
+    cursor.execute("DELETE FROM temp.delta_prices")
+    cursor.executemany("INSERT OR IGNORE INTO temp.delta_dirty VALUES (?)", [(sid,) for sid in dirty_ids])
+    cursor.executemany("INSERT OR IGNORE INTO temp.delta_prices VALUES (?)", [(sid,) for sid in price_ids])
+    params = {'run_id': run_id, 'since': since or '0000-00-00'}
+
+    counts = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        delta_db = Path(tmp_dir) / f"{name}.db"
+        cursor.execute("ATTACH DATABASE ? AS delta", (str(delta_db),))
+        try:
+            cursor.execute("CREATE TABLE delta.delta_meta (key TEXT PRIMARY KEY, value TEXT)")
+            cursor.execute("CREATE TABLE delta.delta_replace (table_name TEXT, stock_id TEXT)")
+            meta = {'name': name, 'run_id': run_id, 'base': manifest['base']['id'] if manifest else ''}
+            for table in PRUNE_TABLES:
+                if prune_before:
+                    meta[f'prune:{table}'] = prune_before
+            cursor.executemany("INSERT INTO delta.delta_meta VALUES (?, ?)", list(meta.items()))
+
+            for table, mode, replace in DELTA_TABLES:
+                try:
+                    cursor.execute(f"CREATE TABLE delta.{table} AS SELECT * FROM main.{table} WHERE {DELTA_FILTERS[mode]}", params)
+                except sqlite3.OperationalError:
+                    continue    # 發佈端沒有這張表
+                counts[table] = cursor.execute(f"SELECT COUNT(*) FROM delta.{table}").fetchone()[0]
+                if replace:
+                    source = 'temp.delta_dirty' if mode == 'dirty' else 'temp.delta_prices'
+                    cursor.execute(f"INSERT INTO delta.delta_replace SELECT ?, stock_id FROM {source}", (table,))
+        finally:
+            cursor.execute("DETACH DATABASE delta")
+        xz_blocks.compress_file(delta_db, xz_path)
+
+    # 發佈端本身已包含這些異動
+    _mark_applied(cursor, name, 'delta')
+
+    size = xz_path.stat().st_size
+    manifest = manifest or {'base': None, 'deltas': []}
+    manifest['deltas'] = [d for d in manifest['deltas'] if d['name'] != name] + [{
+        'name': name,
+        'file': f"deltas/{xz_path.name}",
+        'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'size': size,
+    }]
+    _write_manifest(manifest)
+    summary = '、'.join(f"{t} {n}" for t, n in counts.items() if n)
+    print(f"🩹 差異檔 {xz_path.name}：{size / 1024:.1f} KB ({summary or '無資料列'})")
+    return xz_path
+
+
+def new_base_id():
+    return datetime.now().strftime('base_%Y%m%d_%H%M%S')
+
+
+def mark_base(cursor, base_id):
+    """把 base id 記進資料庫，還原後就能判斷本機資料庫屬於哪一版 base"""
+    _mark_applied(cursor, base_id, 'base')
+
+
+def finish_full_base(conn, base_id, xz_path):
+    """
+    完整 base 發佈完成 (快照已通過檢查並壓縮好)：發佈端本機資料庫也記上 base id，
+    manifest 換成新的 base 並清除舊差異檔
+    """
+    mark_base(conn.cursor(), base_id)
+    conn.commit()
+    _write_manifest({
+        'base': {
+            'id': base_id,
+            'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'size': Path(xz_path).stat().st_size,
+            'schema': schema_signature(conn),
+        },
+        'deltas': [],
+    })
+    for path in DELTA_DIR.glob("delta_*.db.xz"):
+        path.unlink()
+    print(f"🧱 已發佈完整 base {base_id}，舊差異檔已清除")
+
+
+# ==========================================
+# 套用端
+# ==========================================
+
+def apply_delta(db_path, xz_path):
+    """把單一差異檔套用到 db_path (單一交易，失敗會整筆回滾)"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        delta_db = Path(tmp_dir) / "delta.db"
+        xz_blocks.decompress_file(xz_path, delta_db)
+
+        conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+        cursor = conn.cursor()
+        cursor.execute("ATTACH DATABASE ? AS delta", (str(delta_db),))
+        try:
+            meta = dict(cursor.execute("SELECT key, value FROM delta.delta_meta").fetchall())
+            tables = [row[0] for row in cursor.execute(
+                "SELECT name FROM delta.sqlite_master WHERE type = 'table' AND name NOT IN ('delta_meta', 'delta_replace')"
+            ).fetchall()]
+            order = {table: i for i, (table, _, _) in enumerate(DELTA_TABLES)}
+            tables.sort(key=lambda t: order.get(t, len(order)))
+
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                for table in tables:
+                    columns = ', '.join(row[1] for row in cursor.execute(f"PRAGMA delta.table_info({table})").fetchall())
+                    if cursor.execute("SELECT 1 FROM delta.delta_replace WHERE table_name = ? LIMIT 1", (table,)).fetchone():
+                        cursor.execute(f'''
+                            DELETE FROM main.{table} WHERE stock_id IN (
+                                SELECT stock_id FROM delta.delta_replace WHERE table_name = ?
+                            )
+                        ''', (table,))
+                    cursor.execute(f"INSERT OR REPLACE INTO main.{table} ({columns}) SELECT {columns} FROM delta.{table}")
+                for table in PRUNE_TABLES:
+                    cutoff = meta.get(f'prune:{table}')
+                    if cutoff:
+                        try:
+                            cursor.execute(f"DELETE FROM main.{table} WHERE date < ?", (cutoff,))
+                        except sqlite3.OperationalError:
+                            pass
+                _mark_applied(cursor, meta['name'], 'delta')
+                cursor.execute("COMMIT")
+            except Exception:
+                cursor.execute("ROLLBACK")
+                raise
+        finally:
+            cursor.execute("DETACH DATABASE delta")
+            conn.close()
+    return meta['name']
+
+
+_apply_lock = threading.Lock()
+_checked_manifest = None
+# 套用失敗 (例如 database is locked) 後隔一段時間才重試，避免每次取連線都卡在 30 秒的鎖等待
+APPLY_RETRY_SECONDS = 60
+_retry_after = 0.0
+
+
+def pending_deltas(db_path, manifest=None):
+    """回傳 (本機是否屬於目前 base, 尚未套用的差異檔列表)"""
+    manifest = manifest if manifest is not None else read_manifest()
+    if manifest is None:
+        return True, []
+    conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        applied = _applied_names(conn)
+    finally:
+        conn.close()
+    base = manifest.get('base')
+    on_base = base is None or base['id'] in applied
+    return on_base, [d for d in manifest.get('deltas', []) if d['name'] not in applied]
+
+
+def apply_pending_deltas(db_path, restore_base=None):
+    """
+    依 manifest 套用尚未套用的差異檔；manifest 沒變動時直接返回 (每次取連線都會呼叫，必須很便宜)
+    本機資料庫屬於舊的 base 時呼叫 restore_base() 重新還原後再套用
+    回傳本次套用的差異檔數
+    """
+    global _checked_manifest, _retry_after
+    try:
+        stamp = MANIFEST_PATH.stat().st_mtime_ns
+    except FileNotFoundError:
+        return 0
+    if stamp == _checked_manifest or time.monotonic() < _retry_after:
+        return 0
+
+    with _apply_lock:
+        if stamp == _checked_manifest or time.monotonic() < _retry_after:
+            return 0
+        manifest = read_manifest()
+        on_base, pending = pending_deltas(db_path, manifest)
+        if not on_base and restore_base is not None:
+            print("🧱 資料庫 base 已更新，重新還原...")
+            restore_base()
+            on_base, pending = pending_deltas(db_path, manifest)
+
+        applied = 0
+        failed = False
+        for delta in pending:
+            try:
+                apply_delta(db_path, PROJECT_DIR / delta['file'])
+                applied += 1
+            except Exception as e:
+                # 停在最後一個成功的差異檔，資料仍是一致的 (只是比較舊)
+                print(f"⚠️ 差異檔 {delta['name']} 套用失敗，{APPLY_RETRY_SECONDS} 秒後重試: {e}")
+                failed = True
+                break
+        if applied:
+            print(f"🩹 已套用 {applied} 個差異檔")
+        if failed:
+            # 不記錄 manifest：之後的 get_connection 會再試，直到全部套用
+            _retry_after = time.monotonic() + APPLY_RETRY_SECONDS
+        else:
+            _checked_manifest = stamp
+    return applied
+
+
+if __name__ == "__main__":
+    import database
+    if '--apply' in sys.argv:
+        database.ensure_database()
+    manifest = read_manifest()
+    if manifest is None:
+        print("⚠️ 尚未有 deltas/manifest.json")
+    else:
+        base = manifest.get('base') or {}
+        print(f"🧱 base {base.get('id')} ({base.get('created_at')}，{base.get('size', 0) / 1024 / 1024:.1f} MB)")
+        print(f"🩹 差異檔 {len(manifest['deltas'])} 個，共 {sum(d['size'] for d in manifest['deltas']) / 1024:.1f} KB")
+        if database.DB_PATH.exists():
+            on_base, pending = pending_deltas(database.DB_NAME, manifest)
+            print(f"💾 本機資料庫：{'屬於目前 base' if on_base else '屬於舊 base'}，待套用 {len(pending)} 個")
@@ -77,19 +77,20 @@ def twse_has_today_data(today):
     return '"stat":"OK"' in body or '"stat": "OK"' in body
 
 
-def check_database():
-    if not DB_PATH.exists():
-        return fail("找不到 stock_data.db")
+def check_database(db_path=DB_PATH):
+    db_path = Path(db_path)
+    if not db_path.exists():
+        return fail(f"找不到 {db_path.name}")
 
     checks = []
-    conn = sqlite3.connect(DB_PATH, timeout=30)
+    conn = sqlite3.connect(db_path, timeout=30)
     try:
         cursor = conn.cursor()
 
         for table in ("stocks", "daily_prices"):
             exists = fetch_one(
                 cursor,
-                "SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name=?",
+                "SELECT COUNT(*) FROM sqlite_master WHERE type IN ('table', 'view') AND name=?",
                 (table,),
             )
             checks.append(ok(f"{table} 表存在") if exists else fail(f"{table} 表不存在"))
@@ -160,9 +161,9 @@ def check_database():
     return all(checks)
 
 
-def main():
+def main(db_path=DB_PATH):
     print("🔍 開始 DB 健康檢查...")
-    passed = check_database() and check_compressed_db()
+    passed = check_database(db_path) and check_compressed_db()
     if passed:
         print("🎉 DB 健康檢查通過，可以推送")
         return 0
@@ -172,4 +173,4 @@ def main():
 
 
 if __name__ == "__main__":
-    sys.exit(main())
+    sys.exit(main(sys.argv[1] if len(sys.argv) > 1 else DB_PATH))
@@ -0,0 +1,72 @@
+# db_snapshot.py - 以 SQLite 線上備份 API 產生一致的資料庫快照，作為發佈 (.xz) 與本機 App 讀取的來源
+# 更新程式與本機 Streamlit 原本都在用 stock_data.db，直接壓縮這個檔案可能讀到寫到一半的頁面 (或還在 -wal 裡的頁面)。
+# 改為：backup API 複製成暫存檔 → 健康檢查 → os.replace 原子換上 stock_data.snapshot.db。
+# 壓縮與熱資料檔一律從快照讀取；本機 App 的唯讀連線也讀快照 (database.reader_path)，
+# 更新程式寫 stock_data.db 的整段期間看到的都是上一版，換檔後下次取連線時由檔案識別 (inode) 發現並重新連線。
+# 快照只存在更新主機，不發佈；App 端沒有快照時照常讀 stock_data.db。
+#
+# 用法:
+#   python db_snapshot.py                    產生快照並做健康檢查
+#   python db_snapshot.py --skip-check       只產生快照
+
+import os
+import sys
+import time
+import sqlite3
+import database
+import db_delta
+import db_health_check
+
+SNAPSHOT_PATH = database.SNAPSHOT_PATH
+# -1 = 一次複製全部頁面 (單一讀取交易，得到同一時間點的影像；WAL 模式下不會擋住寫入)
+BACKUP_PAGES_PER_STEP = -1
+
+
+def create_snapshot(dst_path=SNAPSHOT_PATH, check=True, base_id=None):
+    """
+    備份 stock_data.db 到 dst_path，健康檢查通過才原子替換；回傳快照路徑
+    base_id: 要發佈成完整 base 時，通過檢查後才把 base id 記進快照 (stock_data.db 等壓縮完成才記，見 db_delta.finish_full_base)
+    檢查失敗時刪除暫存檔並拋出 RuntimeError (原本的快照維持不動)
+    """
+    started = time.time()
+    tmp_path = dst_path.with_name(dst_path.name + '.tmp')
+    tmp_path.unlink(missing_ok=True)
+
+    src = sqlite3.connect(database.DB_NAME, timeout=30)
+    dst = sqlite3.connect(tmp_path)
+    try:
+        src.backup(dst, pages=BACKUP_PAGES_PER_STEP)
+        # 快照是單一檔案：改回 rollback journal，還原 / 壓縮時不需要也不會誤用 -wal
+        dst.execute("PRAGMA journal_mode=DELETE")
+        integrity = dst.execute("PRAGMA quick_check").fetchone()[0]
+    finally:
+        dst.close()
+        src.close()
+
+    if integrity != 'ok':
+        tmp_path.unlink(missing_ok=True)
+        raise RuntimeError(f"快照完整性檢查失敗：{integrity}")
+    if check and not db_health_check.check_database(tmp_path):
+        tmp_path.unlink(missing_ok=True)
+        raise RuntimeError("快照健康檢查失敗，取消發佈")
+
+    if base_id:
+        conn = sqlite3.connect(tmp_path)
+        try:
+            db_delta.mark_base(conn.cursor(), base_id)
+            conn.commit()
+        finally:
+            conn.close()
+
+    os.replace(tmp_path, dst_path)
+    print(f"📸 資料庫快照 {dst_path.name}：{dst_path.stat().st_size / 1024 / 1024:.1f} MB，耗時 {time.time() - started:.2f} 秒")
+    return dst_path
+
+
+if __name__ == "__main__":
+    database.ensure_database()
+    try:
+        create_snapshot(check='--skip-check' not in sys.argv)
+    except RuntimeError as e:
+        print(f"🛑 {e}")
+        sys.exit(1)
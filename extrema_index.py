@@ -0,0 +1,235 @@
+# extrema_index.py - 滾動高低點索引 (任意回看天數的位階 O(1) 查詢)
+# 每檔股票保存「由最新一天往回累積的最高 / 最低收盤」：第 k 格 = 最近 k+1 個交易日的高低點
+# 位階只會以最新一天為終點查詢，所以這就是以今天為錨點的 sparse table，記憶體 O(N) 而非 O(N log N)
+#
+# 用法:
+#   python extrema_index.py --rebuild     由 daily_prices 全量重建索引
+#   python extrema_index.py --benchmark   全市場任意回看天數查詢耗時 (與 SQL 直接計算比較)
+
+import sys
+import time
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import database
+from price_store import load_price_history_store
+
+MAX_LOOKBACK = 750          # 約 3 年交易日
+LOOKBACK_DAYS = {           # 常用回看區間 (交易日)
+    '3m': 60,
+    '6m': 120,
+    '1y': 250,
+    '2y': 500,
+    '3y': 750,
+}
+
+
+def init_extrema_index_table(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS extrema_index (
+            stock_id TEXT PRIMARY KEY,
+            last_date TEXT,
+            close REAL,
+            length INTEGER,        -- 有效交易日數 (最多 MAX_LOOKBACK)
+            suffix_max BLOB,       -- float32，第 k 格 = 最近 k+1 日最高收盤
+            suffix_min BLOB,
+            updated_at TEXT
+        )
+    ''')
+
+
+class ExtremaIndex:
+    """
+    全市場索引：suffix_max / suffix_min 為 (股票數, MAX_LOOKBACK) 矩陣，不足的位置沿用最後一格
+    """
+
+    def __init__(self, stock_ids, close, lengths, suffix_max, suffix_min, version=0):
+        self.stock_ids = stock_ids
+        self.close = close
+        self.lengths = lengths
+        self.suffix_max = suffix_max
+        self.suffix_min = suffix_min
+        self.version = version
+
+    def __len__(self):
+        return len(self.stock_ids)
+
+    def extremes(self, lookback):
+        """回傳 (high, low) 陣列：每檔最近 lookback 個交易日 (資料不足就用全部)"""
+        if not len(self):
+            return np.empty(0), np.empty(0)
+        col = min(max(int(lookback), 1), self.suffix_max.shape[1]) - 1
+        return self.suffix_max[:, col], self.suffix_min[:, col]
+
+    def position(self, lookback):
+        """(收盤 - 區間低) / (區間高 - 區間低)，高低相同時為 0.5 (同 precompute_position)"""
+        high, low = self.extremes(lookback)
+        span = high - low
+        with np.errstate(invalid='ignore', divide='ignore'):
+            pos = np.where(span > 0, (self.close - low) / span, 0.5)
+        pos = np.where(np.isfinite(high), pos, np.nan)
+        return pd.Series(pos, index=self.stock_ids, name='position')
+
+
+def build_suffix_extrema(store, max_lookback=MAX_LOOKBACK):
+    """由 PriceHistoryStore 一次算出全市場的累積高低點矩陣 (新 → 舊)"""
+    starts = store.offsets[:-1]
+    ends = store.offsets[1:]
+    lengths = np.minimum(ends - starts, max_lookback)
+
+    steps = np.arange(max_lookback)
+    valid = steps[None, :] < lengths[:, None]
+    idx = np.where(valid, ends[:, None] - 1 - steps[None, :], 0)
+    closes = store.close[idx]
+
+    # 無效位置先填成不影響結果的值，累積後再把資料不足的尾端沿用最後一格
+    suffix_max = np.maximum.accumulate(np.where(valid & ~np.isnan(closes), closes, -np.inf), axis=1)
+    suffix_min = np.minimum.accumulate(np.where(valid & ~np.isnan(closes), closes, np.inf), axis=1)
+    suffix_max[~np.isfinite(suffix_max)] = np.nan
+    suffix_min[~np.isfinite(suffix_min)] = np.nan
+    return closes[:, 0], lengths, suffix_max.astype(np.float32), suffix_min.astype(np.float32)
+
+
+def refresh_extrema_index(conn=None, stock_ids=None):
+    """重建索引；stock_ids 有指定時只更新這些股票 (本次有新 K 棒)"""
+    should_close = False
+    if conn is None:
+        conn = database.get_connection()
+        should_close = True
+
+    started = time.time()
+    store = load_price_history_store(conn, days=MAX_LOOKBACK, stock_ids=stock_ids)
+    cursor = conn.cursor()
+    init_extrema_index_table(cursor)
+    if stock_ids is None:
+        cursor.execute("DELETE FROM extrema_index")
+
+    if len(store):
+        close, lengths, suffix_max, suffix_min = build_suffix_extrema(store)
+        now_str = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        last_dates = pd.to_datetime(store.dates[store.offsets[1:] - 1]).strftime('%Y-%m-%d')
+        cursor.executemany('''
+            INSERT OR REPLACE INTO extrema_index
+            (stock_id, last_date, close, length, suffix_max, suffix_min, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', [
+            (sid, last_dates[i], float(close[i]), int(lengths[i]),
+             suffix_max[i, :lengths[i]].tobytes(), suffix_min[i, :lengths[i]].tobytes(), now_str)
+            for i, sid in enumerate(store.stock_ids)
+        ])
+    database.bump_data_version(cursor, 'extrema')
+    conn.commit()
+
+    if should_close:
+        conn.close()
+    print(f"📈 高低點索引更新 {len(store)} 檔，耗時 {time.time() - started:.2f} 秒")
+    return len(store)
+
+
+def load_extrema_index(conn=None):
+    """讀回全部股票的索引並組成矩陣"""
+    should_close = False
+    if conn is None:
+        conn = database.get_connection()
+        should_close = True
+    try:
+        version = database.get_data_version(conn, 'extrema')
+        rows = conn.execute("SELECT stock_id, close, length, suffix_max, suffix_min FROM extrema_index").fetchall()
+    except Exception:
+        version, rows = 0, []
+    finally:
+        if should_close:
+            conn.close()
+
+    suffix_max = np.full((len(rows), MAX_LOOKBACK), np.nan, dtype=np.float32)
+    suffix_min = np.full((len(rows), MAX_LOOKBACK), np.nan, dtype=np.float32)
+    lengths = np.zeros(len(rows), dtype=np.int64)
+    for i, (_, _, length, bmax, bmin) in enumerate(rows):
+        n = min(length or 0, MAX_LOOKBACK)
+        if n:
+            suffix_max[i, :n] = np.frombuffer(bmax, dtype=np.float32)[:n]
+            suffix_min[i, :n] = np.frombuffer(bmin, dtype=np.float32)[:n]
+            # 資料不足 MAX_LOOKBACK 的股票，更長的回看就等於全部歷史
+            suffix_max[i, n:] = suffix_max[i, n - 1]
+            suffix_min[i, n:] = suffix_min[i, n - 1]
+        lengths[i] = n
+
+    return ExtremaIndex(
+        stock_ids=[r[0] for r in rows],
+        close=np.array([r[1] if r[1] is not None else np.nan for r in rows], dtype=np.float64),
+        lengths=lengths,
+        suffix_max=suffix_max,
+        suffix_min=suffix_min,
+        version=version,
+    )
+
+
+_cached_index = None
+
+
+def get_extrema_index(conn=None):
+    """行程內共用的索引，data_versions['extrema'] 變動時才重新讀取"""
+    global _cached_index
+    should_close = False
+    if conn is None:
+        conn = database.get_connection()
+        should_close = True
+    try:
+        version = database.get_data_version(conn, 'extrema')
+        if _cached_index is None or _cached_index.version != version:
+            _cached_index = load_extrema_index(conn)
+    finally:
+        if should_close:
+            conn.close()
+    return _cached_index
+
+
+def position_for_period(period, conn=None):
+    """period 為 LOOKBACK_DAYS 的鍵 (例如 '6m') 或交易日數，回傳 stock_id → 位階"""
+    lookback = LOOKBACK_DAYS.get(period, period)
+    return get_extrema_index(conn).position(int(lookback))
+
+
+def benchmark_extrema_index(lookbacks=(20, 60, 120, 250, 500, 750)):
+    """比較：索引查詢 vs 每次用 SQL 視窗函數重算"""
+    conn = database.get_connection()
+    started = time.time()
+    index = load_extrema_index(conn)
+    load_seconds = time.time() - started
+    print(f"📈 索引載入：{len(index)} 檔，{(index.suffix_max.nbytes + index.suffix_min.nbytes) / 1024 / 1024:.1f} MB，耗時 {load_seconds:.3f} 秒")
+
+    print(f"{'回看天數':>8} | {'索引 (ms)':>10} | {'SQL (ms)':>10} | 最大差異")
+    for lookback in lookbacks:
+        started = time.time()
+        pos = index.position(lookback)
+        index_ms = (time.time() - started) * 1000
+
+        started = time.time()
+        df = pd.read_sql('''
+            SELECT stock_id,
+                   MAX(CASE WHEN rn = 1 THEN close END) AS close,
+                   MAX(close) AS high, MIN(close) AS low
+            FROM (
+                SELECT stock_id, close,
+                       ROW_NUMBER() OVER (PARTITION BY stock_id ORDER BY date DESC) AS rn
+                FROM daily_prices
+            )
+            WHERE rn <= ?
+            GROUP BY stock_id
+        ''', conn, params=(lookback,))
+        span = df['high'] - df['low']
+        sql_pos = pd.Series(np.where(span > 0, (df['close'] - df['low']) / span.where(span > 0, 1), 0.5), index=df['stock_id'])
+        sql_ms = (time.time() - started) * 1000
+
+        diff = (pos - sql_pos.reindex(pos.index)).abs().max()
+        print(f"{lookback:>8} | {index_ms:>10.2f} | {sql_ms:>10.1f} | {diff:.2e}")
+    conn.close()
+
+
+if __name__ == "__main__":
+    if '--rebuild' in sys.argv:
+        refresh_extrema_index()
+    if '--benchmark' in sys.argv:
+        benchmark_extrema_index()
+    if '--rebuild' not in sys.argv and '--benchmark' not in sys.argv:
+        print("使用方式: python extrema_index.py --rebuild | --benchmark")
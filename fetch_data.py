@@ -3,23 +3,32 @@ import yfinance as yf
 import pandas as pd
 import sqlite3
 import time
+import queue
+import threading
 import requests
 import random
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
 from io import StringIO
 import database
 import numpy as np
+from price_store import load_price_history_store
+import indicator_state
+import consolidation
+import market_stats
+import extrema_index
+import xz_blocks
+import db_delta
+import hot_db
+import archive_store
+import db_snapshot
 
 # ★★★ 匯入預先計算模組 ★★★
 try:
     from fetch_precompute import (
-        get_connection as pc_get_connection,
-        precompute_position,
-        precompute_bias,
-        precompute_vol_spike,
-        precompute_consolidation_log,
         update_precomputed_metrics,
-        update_weekly_ma
+        update_weekly_ma,
+        refresh_latest_stock_snapshot
     )
     PRECOMPUTE_AVAILABLE = True
 except ImportError:
@@ -42,75 +51,30 @@ except ImportError:
     FINMIND_FUNDAMENTAL_AVAILABLE = False
     print("⚠️  fetch_fundamentals_finmind.py 未找到,基本面抓取 fallback 至 yfinance")
 
-# ★★★ 單一股票預先計算函數 (供每日更新時呼叫) ★★★
-def calculate_precompute_for_stock(cursor, stock_id):
-    """
-    為單一股票執行預先計算指標更新
-    """
-    try:
-        # 使用外部連線，不建立新連線（避免 SQLite 鎖衝突）
-        conn = cursor.connection
-
-        # 計算位階
-        position_1y, position_2y = precompute_position(stock_id, conn)
-
-        # 計算乖離率
-        bias_20, bias_60 = precompute_bias(stock_id, conn)
-
-        # 計算爆量倍數
-        vol_spike = precompute_vol_spike(stock_id, conn)
-
-        # 計算盤整對數
-        consolidation_log = precompute_consolidation_log(stock_id, conn)
-
-        # 更新 stocks 表
-        cursor.execute('''
-            UPDATE stocks SET
-                position_1y = ?,
-                position_2y = ?,
-                bias_20 = ?,
-                bias_60 = ?,
-                vol_spike = ?,
-                consolidation_log = ?,
-                last_updated = ?
-            WHERE stock_id = ?
-        ''', (
-            position_1y if position_1y is not None else 0,
-            position_2y if position_2y is not None else 0,
-            bias_20 if bias_20 is not None else 0,
-            bias_60 if bias_60 is not None else 0,
-            vol_spike if vol_spike is not None else 0,
-            consolidation_log if consolidation_log is not None else 0,
-            datetime.now().strftime('%Y-%m-%d'),
-            stock_id
-        ))
-
-        return True
-
-    except Exception as e:
-        print(f"⚠️ {stock_id} 預先計算失敗: {e}")
-        return False
-
-
 # ★★★ 批次預先計算 (供每日更新結束後呼叫) ★★★
-def run_batch_precompute(stock_ids=None):
+def run_batch_precompute(stock_ids=None, price_ids=None):
     """
     批次更新預先計算指標
     參數:
-        stock_ids: 指定更新哪些股票，None 則更新全部
+        stock_ids: 有異動的股票 (預先指標 / 營收 YOY / 快照只處理這些)，None 則更新全部
+        price_ids: 其中有新 K 棒的股票 (週線只處理這些)，None 則同 stock_ids
     """
     if PRECOMPUTE_AVAILABLE:
         print("\n🚀 開始批次預先計算...")
-        if stock_ids:
-            print(f"   指定更新 {len(stock_ids)} 檔股票")
-            for sid in stock_ids:
-                try:
-                    # 使用現有的 calculate_precompute_for_stock 函數
-                    # 但需要資料庫連線，這裡簡化處理
-                    pass
-                except Exception as e:
-                    print(f"   ⚠️ {sid} 預先計算失敗: {e}")
-            update_weekly_ma()
+        if stock_ids is not None:
+            if price_ids is None:
+                price_ids = stock_ids
+            if not stock_ids:
+                print("⏭️ 本次沒有任何股票異動，跳過預先計算")
+                return
+            print(f"   指定更新 {len(stock_ids)} 檔股票 (新 K 棒 {len(price_ids)} 檔)")
+            try:
+                update_precomputed_metrics(stock_ids=stock_ids)
+                if price_ids:
+                    update_weekly_ma(stock_ids=price_ids, refresh_snapshot=False)
+                refresh_latest_stock_snapshot(stock_ids=stock_ids)
+            except Exception as e:
+                print(f"   ⚠️ 批次預先計算失敗: {e}")
         else:
             update_precomputed_metrics()
             update_weekly_ma()
@@ -228,27 +192,6 @@ def calculate_revenue_streak(ticker):
         return streak
     except: return 0
 
-# --- 4. 盤整天數計算函式 (支援 threshold) ---
-def calculate_consolidation_days(hist_data, threshold=0.10):
-    if hist_data.empty or len(hist_data) < 5:
-        return 0
-    try:
-        current_price = hist_data.iloc[-1]
-        upper_bound = current_price * (1 + threshold)
-        lower_bound = current_price * (1 - threshold)
-
-        days = 0
-        recent_data = hist_data.iloc[:-1].tail(400).iloc[::-1]
-
-        for price in recent_data:
-            if lower_bound <= price <= upper_bound:
-                days += 1
-            else:
-                break
-        return days
-    except:
-        return 0
-
 # --- 5. 取得歷史資料函數 ---
 def get_db_history_data(stock_id, days=600):
     # 使用獨立連線，避免關閉主連線
@@ -263,10 +206,599 @@ def get_db_history_data(stock_id, days=600):
     finally:
         conn.close()
 
+# --- 5-1. 股價下載 (逐檔 / 批次) ---
+BATCH_CHUNK_SIZE = 100      # 每次 yf.download 最多帶幾檔
+BATCH_CHUNK_SLEEP = 1.0     # 批次之間的間隔，避免被 Yahoo 限流
+
+def get_stock_symbol(stock):
+    # 股票清單已經包含正確上市/上櫃後綴，避免每檔都多打一輪 Yahoo 測試請求。
+    stock_id = stock['id']
+    return stock.get("symbol") or (f"{stock_id}.TWO" if stock.get("market") == "otc" else f"{stock_id}.TW")
+
+def get_price_start_arg(last_date_str):
+    """依資料庫最後日期決定抓取起點 (往前多抓 5 天重疊)，新股回傳 None 代表抓 10 年"""
+    if not last_date_str:
+        return None
+    last_dt = datetime.strptime(last_date_str, '%Y-%m-%d')
+    return (last_dt - timedelta(days=5)).strftime('%Y-%m-%d')
+
+def fetch_price_history(symbol, last_date_str):
+    """逐檔抓股價 (原本的路徑，也是批次失敗時的備援)"""
+    try:
+        ticker = yf.Ticker(symbol)
+        start_arg = get_price_start_arg(last_date_str)
+        if start_arg:
+            return ticker.history(start=start_arg, auto_adjust=False)
+        return ticker.history(period="10y", auto_adjust=False)
+    except:
+        return pd.DataFrame()
+
+def group_symbols_by_start(stocks, db_dates, chunk_size=BATCH_CHUNK_SIZE):
+    """
+    把起始日相同的股票分成同一組，再切成每組最多 chunk_size 檔
+    回傳: [(start_arg, [symbol, ...]), ...]
+    """
+    groups = {}
+    for stock in stocks:
+        start_arg = get_price_start_arg(db_dates.get(stock['id']))
+        groups.setdefault(start_arg, []).append(get_stock_symbol(stock))
+
+    chunks = []
+    for start_arg, symbols in groups.items():
+        for i in range(0, len(symbols), chunk_size):
+            chunks.append((start_arg, symbols[i:i + chunk_size]))
+    return chunks
+
+def split_price_frame(raw, symbols):
+    """
+    把 yf.download 的多檔寬表拆回每檔一張，欄位與 ticker.history 相同
+    缺少或整欄 NaN 的代號不放進結果：yf.download 會把個別 ticker 的暫時失敗吞成這樣，
+    留給主迴圈逐檔重抓 (真的沒有新 K 棒時逐檔抓取也只會拿到空表)
+    """
+    frames = {}
+    if raw is None or raw.empty:
+        return frames
+
+    multi = isinstance(raw.columns, pd.MultiIndex)
+    available = set(raw.columns.get_level_values(0)) if multi else set()
+
+    for symbol in symbols:
+        if multi:
+            if symbol not in available:
+                continue
+            df = raw[symbol].copy()
+        elif len(symbols) == 1:
+            df = raw.copy()
+        else:
+            continue
+
+        # 多檔對齊日期後，沒交易的日子會是整列 NaN，逐檔抓取時不會有這些列
+        if 'Close' in df.columns:
+            df = df[df['Close'].notna()]
+        if df.empty:
+            continue
+        df.columns.name = None
+        frames[symbol] = df
+    return frames
+
+def download_price_chunk(symbols, start_arg):
+    """一次請求抓一整組股票；整組失敗時丟出例外，由呼叫端改走逐檔"""
+    kwargs = {
+        'tickers': symbols, 'group_by': 'ticker', 'auto_adjust': False,
+        'actions': True, 'threads': True, 'progress': False,
+    }
+    if start_arg:
+        kwargs['start'] = start_arg
+    else:
+        kwargs['period'] = '10y'
+    raw = yf.download(**kwargs)
+    return split_price_frame(raw, symbols)
+
+def prefetch_price_history(stocks, db_dates, chunk_size=BATCH_CHUNK_SIZE):
+    """
+    批次下載模式：依起始日分組、每組一次請求，回傳 {symbol: DataFrame}
+    下載失敗的組別、以及組內沒有資料的個股不會出現在結果裡，主迴圈會自動改用逐檔抓取。
+    """
+    chunks = group_symbols_by_start(stocks, db_dates, chunk_size)
+    print(f"📦 [批次下載] {len(stocks)} 檔分成 {len(chunks)} 組下載...")
+    started = time.time()
+    prefetched = {}
+
+    for n, (start_arg, symbols) in enumerate(chunks):
+        try:
+            prefetched.update(download_price_chunk(symbols, start_arg))
+        except Exception as e:
+            print(f"\n⚠️ 第 {n+1} 組批次下載失敗 ({e})，改用逐檔抓取")
+        if n < len(chunks) - 1:
+            time.sleep(BATCH_CHUNK_SLEEP)
+
+    print(f"✅ [批次下載] 完成 {len(prefetched)} 檔，耗時 {time.time() - started:.1f} 秒")
+    return prefetched
+
+def benchmark_download_modes(sample_size=50, fixture_dir=None):
+    """
+    比較逐檔 vs 批次下載：耗時與每檔資料是否一致
+    fixture_dir 不存在時會把兩條路徑抓到的資料錄成 CSV；已存在時改為離線重播比對。
+    """
+    import json
+    from pathlib import Path
+
+    fixture_path = Path(fixture_dir) if fixture_dir else None
+    manifest_file = fixture_path / "manifest.json" if fixture_path else None
+
+    if manifest_file and manifest_file.exists():
+        manifest = json.loads(manifest_file.read_text(encoding="utf-8"))
+        per_ticker, batched = {}, {}
+        for symbol in manifest['symbols']:
+            for mode, store in (("per_ticker", per_ticker), ("batch", batched)):
+                csv_file = fixture_path / mode / f"{symbol}.csv"
+                store[symbol] = pd.read_csv(csv_file, index_col=0, parse_dates=True) if csv_file.exists() else pd.DataFrame()
+        per_ticker_sec = manifest['per_ticker_sec']
+        batch_sec = manifest['batch_sec']
+        print(f"🎞️ 使用錄製的 fixtures 重播 ({fixture_path})")
+    else:
+        stocks = get_tw_stock_list()[:sample_size]
+        db_dates = get_db_last_dates()
+
+        started = time.time()
+        per_ticker = {}
+        for stock in stocks:
+            symbol = get_stock_symbol(stock)
+            per_ticker[symbol] = fetch_price_history(symbol, db_dates.get(stock['id']))
+            time.sleep(0.2)
+        per_ticker_sec = time.time() - started
+
+        started = time.time()
+        batched = prefetch_price_history(stocks, db_dates)
+        batch_sec = time.time() - started
+
+        if fixture_path:
+            for mode, store in (("per_ticker", per_ticker), ("batch", batched)):
+                (fixture_path / mode).mkdir(parents=True, exist_ok=True)
+                for symbol, df in store.items():
+                    df.to_csv(fixture_path / mode / f"{symbol}.csv")
+            manifest_file.write_text(json.dumps({
+                'symbols': list(per_ticker.keys()),
+                'per_ticker_sec': per_ticker_sec,
+                'batch_sec': batch_sec,
+                'recorded_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            }, ensure_ascii=False, indent=2), encoding="utf-8")
+            print(f"💾 已錄製 fixtures 到 {fixture_path}")
+
+    mismatched = []
+    for symbol, df in per_ticker.items():
+        other = batched.get(symbol, pd.DataFrame())
+        if df.empty and other.empty:
+            continue
+        try:
+            left = df['Close'].copy()
+            right = other['Close'].copy()
+            left.index = pd.to_datetime(left.index).tz_localize(None) if getattr(left.index, 'tz', None) else pd.to_datetime(left.index)
+            right.index = pd.to_datetime(right.index).tz_localize(None) if getattr(right.index, 'tz', None) else pd.to_datetime(right.index)
+            left.index = left.index.normalize()
+            right.index = right.index.normalize()
+            if not np.allclose(left.sort_index().values, right.reindex(left.sort_index().index).values, equal_nan=True):
+                mismatched.append(symbol)
+        except Exception:
+            mismatched.append(symbol)
+
+    print(f"⏱️ 逐檔: {per_ticker_sec:.1f} 秒 | 批次: {batch_sec:.1f} 秒 | 加速 {per_ticker_sec / max(batch_sec, 1e-6):.1f} 倍")
+    print(f"🔍 {len(per_ticker)} 檔中有 {len(mismatched)} 檔資料不一致" + (f": {', '.join(mismatched[:10])}" if mismatched else ""))
+    return {'per_ticker_sec': per_ticker_sec, 'batch_sec': batch_sec, 'mismatched': mismatched}
+
+# --- 5-2. 並行抓取 + 單一寫入執行緒 ---
+DEFAULT_FETCH_WORKERS = 8     # 抓取執行緒數 (--workers)
+DEFAULT_QUEUE_DEPTH = 64      # 待寫入佇列上限 (--queue-size)
+DEFAULT_COMMIT_EVERY = 50     # 每幾檔 commit 一次 (--commit-every)
+FINMIND_CALL_LIMIT = 580      # FinMind 免費額度安全值
+
+def get_cli_int(flag, default):
+    """讀取 `--flag N` 形式的啟動參數"""
+    import sys
+    if flag in sys.argv:
+        try:
+            return max(1, int(sys.argv[sys.argv.index(flag) + 1]))
+        except (IndexError, ValueError):
+            print(f"⚠️ {flag} 參數格式錯誤，使用預設值 {default}")
+    return default
+
+def reserve_finmind_quota(ctx, stock_id):
+    """多執行緒共用 FinMind 額度：先登記再呼叫，超過安全值就不抓"""
+    with ctx['lock']:
+        if ctx['finmind_api_calls'] > FINMIND_CALL_LIMIT:
+            return False
+        ctx['finmind_api_calls'] += 2  # 每個 stock 呼叫兩次 API (財報+股利)
+        return True
+
+def compute_indicators_full(stock_id, new_hist, last_date_str, ctx):
+    """
+    全量路徑：把資料庫近 600 筆歷史接上新資料後重算全部技術指標
+    回傳 {'values', 'daily_rows', 'close_price', 'state'}，沒有任何資料時回傳 None
+    """
+    last_vol_ma5 = 0
+    last_vol_ma20 = 0
+
+    # --- 資料拼接 ---
+    if last_date_str:
+        history_store = ctx.get('history_store')
+        if history_store is not None:
+            old_df = history_store.get_frame(stock_id)
+        else:
+            old_df = get_db_history_data(stock_id, days=600)
+        if not new_hist.empty:
+            combined_close = pd.concat([old_df['close'] if not old_df.empty else pd.Series(dtype=float), new_hist['Close']])
+            if not old_df.empty and 'volume' in old_df.columns:
+                combined_volume = pd.concat([old_df['volume'], new_hist['Volume']])
+            else:
+                combined_volume = new_hist['Volume']
+        else:
+            combined_close = old_df['close'] if not old_df.empty else pd.Series(dtype=float)
+            combined_volume = old_df['volume'] if not old_df.empty and 'volume' in old_df.columns else pd.Series(dtype=float)
+
+        combined_close = combined_close[~combined_close.index.duplicated(keep='last')]
+        combined_volume = combined_volume[~combined_volume.index.duplicated(keep='last')]
+    else:
+        if new_hist.empty: return None
+        combined_close = new_hist['Close']
+        combined_volume = new_hist['Volume']
+
+    # --- 計算指標 ---
+    if combined_close.empty: return None
+
+    # 均量
+    if not combined_volume.empty:
+        vol_ma5 = combined_volume.rolling(window=5).mean()
+        vol_ma20 = combined_volume.rolling(window=20).mean()
+        last_vol_ma5 = vol_ma5.iloc[-1] if not pd.isna(vol_ma5.iloc[-1]) else 0
+        last_vol_ma20 = vol_ma20.iloc[-1] if not pd.isna(vol_ma20.iloc[-1]) else 0
+
+    # 位階
+    past_2year = combined_close.tail(500)
+    year_high = combined_close.tail(250).max() if not combined_close.empty else 0
+    year_low = combined_close.tail(250).min() if not combined_close.empty else 0
+    year_high_2y = past_2year.max() if not past_2year.empty else year_high
+    year_low_2y = past_2year.min() if not past_2year.empty else year_low
+
+    # 盤整天數不在這裡算：Part A-2 的 consolidation.refresh_consolidation 對本次有新 K 棒的股票整批計算 (連同門檻斷點)
+
+    # 填回 new_hist，整理待寫入資料 (daily_prices)
+    daily_rows = []
+    if not new_hist.empty:
+        full_ma5 = combined_close.rolling(window=5).mean()
+        full_ma20 = combined_close.rolling(window=20).mean()
+        full_ma60 = combined_close.rolling(window=60).mean()
+        new_hist['MA5'] = full_ma5.loc[new_hist.index]
+        new_hist['MA20'] = full_ma20.loc[new_hist.index]
+        new_hist['MA60'] = full_ma60.loc[new_hist.index]
+        new_hist['Change_Pct'] = new_hist['Close'].pct_change(fill_method=None) * 100
+
+        for date, row in new_hist.iterrows():
+            date_str = date.strftime('%Y-%m-%d')
+            ma5 = row['MA5'] if pd.notna(row['MA5']) else None
+            ma20 = row['MA20'] if pd.notna(row['MA20']) else None
+            ma60 = row['MA60'] if pd.notna(row['MA60']) else None
+            change = row['Change_Pct'] if pd.notna(row['Change_Pct']) else 0
+
+            daily_rows.append((stock_id, date_str, row['Open'], row['High'], row['Low'], row['Close'], row['Volume'], change, ma5, ma20, ma60))
+
+    # 順便建立增量狀態，下次更新就能走增量路徑
+    state = indicator_state.build_state(
+        combined_close.index[-1].strftime('%Y-%m-%d'),
+        combined_close.to_numpy(dtype=float),
+        combined_volume.to_numpy(dtype=float),
+    )
+
+    return {
+        'values': {
+            'year_high': year_high, 'year_low': year_low,
+            'year_high_2y': year_high_2y, 'year_low_2y': year_low_2y,
+            'vol_ma_5': last_vol_ma5, 'vol_ma_20': last_vol_ma20,
+        },
+        'daily_rows': daily_rows,
+        'close_price': combined_close.iloc[-1],
+        'state': state,
+        'state_is_new': True,
+    }
+
+def compute_indicators_incremental(stock_id, new_hist, state):
+    """
+    增量路徑：只把晚於 state['last_date'] 的新 K 棒套進滾動和與視窗緩衝
+    與資料庫重疊的前幾天 (往回多抓的 5 天) 不會重寫
+    """
+    bars = []
+    ohlc = {}
+    for date, row in new_hist.iterrows():
+        date_str = date.strftime('%Y-%m-%d')
+        if date_str <= state['last_date']:
+            continue
+        bars.append((date_str, row['Close'], row['Volume']))
+        ohlc[date_str] = row
+
+    applied = indicator_state.apply_new_bars(state, bars)
+    summary = indicator_state.summarize_state(state)
+    if summary is None: return None
+
+    daily_rows = []
+    for date_str, ma5, ma20, ma60, change in applied:
+        row = ohlc[date_str]
+        daily_rows.append((stock_id, date_str, row['Open'], row['High'], row['Low'], row['Close'], row['Volume'], change, ma5, ma20, ma60))
+
+    close_price = summary.pop('close')
+    return {
+        'values': summary,
+        'daily_rows': daily_rows,
+        'close_price': close_price,
+        'state': state,
+        'state_is_new': False,
+    }
+
+def process_stock_update(stock, ctx):
+    """
+    抓取執行緒：抓股價、算指標、抓基本面，回傳待寫入的資料 (不碰寫入連線)
+    回傳 None 代表這檔沒有資料可寫
+    """
+    stock_id = stock['id']
+    symbol = get_stock_symbol(stock)
+    force_financials = ctx['force_financials']
+
+    try:
+        # 1. 抓股價 (批次已下載就直接拿，否則逐檔抓)
+        last_date_str = ctx['db_dates'].get(stock_id)
+        with ctx['lock']:
+            new_hist = ctx['prefetched_prices'].pop(symbol, None)
+        from_batch = new_hist is not None
+        ticker = yf.Ticker(symbol)
+        if not from_batch:
+            new_hist = fetch_price_history(symbol, last_date_str)
+            time.sleep(0.2)
+
+        if not new_hist.empty:
+            try:
+                if new_hist.index.tz is not None:
+                    new_hist.index = new_hist.index.tz_localize(None)
+            except: pass
+
+        # 2. 技術指標：狀態與資料庫同步時只套用新 K 棒，否則用預載歷史全量重算
+        state = ctx.get('indicator_states', {}).get(stock_id)
+        if state is not None and last_date_str and state['last_date'] == last_date_str:
+            tech = compute_indicators_incremental(stock_id, new_hist, state)
+        else:
+            tech = compute_indicators_full(stock_id, new_hist, last_date_str, ctx)
+        if tech is None: return None
+
+        # --- 抓取基本面 (FinMind 核心替換版) ---
+        # 💡 防護網:取得最新收盤價 (沒有新資料時就是資料庫最後一筆收盤價)
+        close_price = tech['close_price']
+
+        # 🚀 智慧快取機制 + 流量控管
+        curr_existing = ctx['existing_funds'].get(stock_id, {})
+        db_eps = curr_existing.get('eps', 0)
+        is_etf = str(stock_id).startswith('00')
+
+        # 判斷是否需要 Call FinMind:
+        if force_financials:
+            needs_update = not (str(stock_id) in ctx['forced_done'])
+        else:
+            needs_update = (db_eps == 0)       # 日常模式：EPS 是空值才抓！
+
+        # 綜合判斷：不是 ETF + 需要更新 + 額度還夠 (安全值 580)
+        need_finmind = (not is_etf) and needs_update and reserve_finmind_quota(ctx, stock_id)
+
+        if force_financials and not need_finmind:
+            # 財報加班車額度用完：這檔留給下一班車
+            return None
+
+        if need_finmind:
+            finmind_data = fetch_fundamentals_finmind(stock_id, close_price)
+
+            # 📝 把抓過的股票寫進記憶卡，下個小時的排程就會自動跳過它！
+            if force_financials:
+                with ctx['lock']:
+                    with open(ctx['done_file'], 'a') as f:
+                        f.write(f"{stock_id}\n")
+        else:
+            # 🛡️ 防護網：沿用資料庫舊數據，絕對不洗白！
+            finmind_data = {
+                'eps': db_eps,
+                'eps_growth': curr_existing.get('eps_growth', 0),
+                'gross_margin': curr_existing.get('gross_margin', 0),
+                'operating_margin': curr_existing.get('operating_margin', 0),
+                'pretax_margin': curr_existing.get('pretax_margin', 0),
+                'net_margin': curr_existing.get('net_margin', 0),
+                'revenue_growth': curr_existing.get('revenue_growth', 0),
+                'yield_rate': curr_existing.get('yield_rate', 0),
+                'pe_ratio': (close_price / db_eps) if db_eps > 0 and close_price > 0 else 0
+            }
+
+        eps = finmind_data.get('eps', 0)
+        pe = finmind_data.get('pe_ratio', 0)
+        yield_rate = finmind_data.get('yield_rate', 0)
+        gross_margin_pct = finmind_data.get('gross_margin', 0)
+        operating_margin_pct = finmind_data.get('operating_margin', 0)
+        pretax_margin_pct = finmind_data.get('pretax_margin', 0)
+        net_margin_pct = finmind_data.get('net_margin', 0)
+        eps_growth_pct = finmind_data.get('eps_growth', 0)
+        revenue_growth_pct = finmind_data.get('revenue_growth', 0)
+
+        revenue_ttm = revenue_growth_pct
+
+        if force_financials or needs_update:
+            try:
+                info = ticker.info
+            except:
+                info = {}
+            pb = info.get('priceToBook', 0) or 0
+            beta = info.get('beta', 0) or 0
+            market_cap = info.get('marketCap', 0) or 0
+            revenue_streak = calculate_revenue_streak(ticker)
+            shares = info.get('sharesOutstanding', 0)
+            capital_billion = shares / 10000000 if shares else curr_existing.get('capital', 0)
+        else:
+            pb = curr_existing.get('pb_ratio', 0)
+            beta = curr_existing.get('beta', 0)
+            market_cap = curr_existing.get('market_cap', 0)
+            revenue_streak = curr_existing.get('revenue_streak', 0)
+            capital_billion = curr_existing.get('capital', 0)
+
+        values = {
+            'eps': eps, 'pe_ratio': pe, 'pb_ratio': pb, 'yield_rate': yield_rate,
+            'beta': beta, 'market_cap': market_cap,
+            'revenue_growth': revenue_growth_pct, 'revenue_ttm': revenue_ttm,
+            'revenue_streak': revenue_streak, 'eps_growth': eps_growth_pct,
+            'capital': capital_billion,
+            'gross_margin': gross_margin_pct, 'operating_margin': operating_margin_pct,
+            'pretax_margin': pretax_margin_pct, 'net_margin': net_margin_pct,
+            **tech['values'],
+        }
+
+        # 異動判斷：有晚於資料庫最後日期的 K 棒 → prices；基本面數值有變 → fundamentals
+        new_dates = sorted({row[1] for row in tech['daily_rows'] if not last_date_str or row[1] > last_date_str})
+        changes = []
+        if new_dates: changes.append('prices')
+        if fundamentals_changed(values, ctx['existing_funds'].get(stock_id)): changes.append('fundamentals')
+
+        return {
+            'stock': stock,
+            'symbol': symbol,
+            'values': values,
+            'daily_rows': tech['daily_rows'],
+            'indicator_state': tech['state'],
+            'state_is_new': tech['state_is_new'],
+            'changes': changes,
+            'new_dates': new_dates,
+        }
+
+    except Exception as e:
+        print(f"\n❌ {stock_id} 發生錯誤: {e}")
+        return None
+
+FUNDAMENTAL_COLUMNS = [
+    'eps', 'pe_ratio', 'yield_rate', 'gross_margin', 'operating_margin', 'pretax_margin',
+    'net_margin', 'eps_growth', 'revenue_growth', 'pb_ratio', 'beta', 'market_cap',
+    'revenue_streak', 'capital',
+]
+
+def fundamentals_changed(values, existing):
+    """與更新前 stocks 表的基本面比較 (existing 為 None 代表新股票)"""
+    if existing is None:
+        return True
+    for col in FUNDAMENTAL_COLUMNS:
+        new_val = values.get(col) or 0
+        old_val = existing.get(col) or 0
+        try:
+            if not np.isclose(float(new_val), float(old_val), rtol=1e-9, atol=1e-12):
+                return True
+        except (TypeError, ValueError):
+            if new_val != old_val:
+                return True
+    return False
+
+STOCK_VALUE_COLUMNS = [
+    'eps', 'pe_ratio', 'pb_ratio', 'yield_rate', 'beta', 'market_cap',
+    'revenue_growth', 'revenue_ttm', 'revenue_streak', 'eps_growth',
+    'year_high', 'year_low', 'capital', 'vol_ma_5', 'vol_ma_20',
+    'year_high_2y', 'year_low_2y', 'gross_margin',
+    'operating_margin', 'pretax_margin', 'net_margin',
+]
+
+def write_stock_update(cursor, update, run_id=None):
+    """寫入執行緒：把一檔股票的結果寫進 stocks / daily_prices，並記錄本次異動"""
+    stock = update['stock']
+    stock_id = stock['id']
+    values = [update['values'][col] for col in STOCK_VALUE_COLUMNS]
+    now_str = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+    # --- 寫入資料庫 (stocks) ---
+    set_clause = ", ".join(f"{col}=?" for col in STOCK_VALUE_COLUMNS)
+    cursor.execute(f"UPDATE stocks SET {set_clause}, last_updated=? WHERE stock_id=?",
+                   values + [now_str, stock_id])
+
+    if cursor.rowcount == 0:
+        columns = ['stock_id', 'name', 'industry', 'market_type', 'yahoo_symbol'] + STOCK_VALUE_COLUMNS + ['last_updated']
+        placeholders = ", ".join(["?"] * len(columns))
+        cursor.execute(f"INSERT INTO stocks ({', '.join(columns)}) VALUES ({placeholders})",
+                       [stock_id, stock['name'], stock['industry'], stock['market'], update['symbol']] + values + [now_str])
+
+    # 預先計算指標改由 Part D 批次引擎一次處理 (fetch_precompute.update_precomputed_metrics)
+
+    # --- 寫入增量指標狀態 ---
+    if update.get('indicator_state') is not None:
+        indicator_state.save_indicator_states(cursor, [(stock_id, update['indicator_state'])])
+
+    # --- 寫入資料庫 (daily_prices) ---
+    if update['daily_rows']:
+        cursor.executemany('''
+            INSERT OR REPLACE INTO daily_prices
+            (stock_id, date, open, high, low, close, volume, change_pct, ma_5, ma_20, ma_60)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', update['daily_rows'])
+
+    # --- 異動紀錄 (與資料同一個交易提交) ---
+    if run_id:
+        for kind in update.get('changes', []):
+            database.record_stock_changes(cursor, run_id, [stock_id], kind)
+
+def enqueue_update(write_queue, writer, update):
+    """佇列滿時會卡住抓取端 (避免記憶體無限成長)，但寫入執行緒掛掉時要能脫身"""
+    while True:
+        try:
+            write_queue.put(update, timeout=5)
+            return
+        except queue.Full:
+            if not writer.is_alive():
+                raise RuntimeError("寫入執行緒已停止，無法繼續寫入")
+
+def stock_writer_loop(write_queue, commit_every, stats, run_id=None):
+    """
+    唯一的寫入執行緒：自己持有 SQLite 連線、從佇列取資料、批次 commit
+    所有寫入都走這條線，就不會有多條連線互搶而出現 database is locked
+    """
+    conn = database.get_connection()
+    cursor = conn.cursor()
+    pending = 0
+    try:
+        while True:
+            try:
+                update = write_queue.get(timeout=5)
+            except queue.Empty:
+                # 抓取端暫時沒東西進來，先把手上的寫進去
+                if pending:
+                    conn.commit()
+                    pending = 0
+                continue
+
+            if update is None:
+                break
+
+            try:
+                write_stock_update(cursor, update, run_id)
+                stats['written'] += 1
+                for kind in update.get('changes', []):
+                    stats['changed'].setdefault(kind, set()).add(update['stock']['id'])
+                stats['dates'].update(update.get('new_dates', []))
+                if update['daily_rows']:
+                    # 實際寫入的 K 棒範圍 (可能包含重抓的舊日期)，差異檔要從這裡開始帶
+                    first_date = min(row[1] for row in update['daily_rows'])
+                    stats['rows'].add(update['stock']['id'])
+                    stats['rows_since'] = min(stats['rows_since'] or first_date, first_date)
+                pending += 1
+            except Exception as e:
+                stats['failed'] += 1
+                print(f"\n❌ {update['stock']['id']} 寫入失敗: {e}")
+
+            if pending >= commit_every:
+                conn.commit()
+                pending = 0
+    finally:
+        conn.commit()
+        conn.close()
+
 # --- 6. 主更新邏輯 ---
-def update_stock_data(progress_bar=None, status_text=None):
+def update_stock_data(progress_bar=None, status_text=None, full_base=False):
     conn = database.get_connection()
     cursor = conn.cursor()
+    # 本次更新的識別碼 (同時作為「本次寫入」的時間下限)
+    run_id = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
     # 0. 自動修補新欄位 (consolidation_days_20)
     try:
@@ -304,10 +836,7 @@ def update_stock_data(progress_bar=None, status_text=None):
             'revenue_streak': r[13] or 0, 'capital': r[14] or 0
         }
 
-    total_to_update = total_stocks
-    finmind_api_calls = 0  # 追蹤 API 使用量 (每檔股票用掉 2 次請求)
-
-    print(f"🚀 開始全面更新 {total_to_update} 檔股票每日股價...")
+    print(f"🚀 開始全面更新 {total_stocks} 檔股票每日股價...")
     if force_financials:
         print("⚠️ [財報季加班模式] 已啟用 --force-financials，將強制更新所有基本面！")
     else:
@@ -330,328 +859,116 @@ def update_stock_data(progress_bar=None, status_text=None):
                 with open(done_file, 'r') as f:
                     forced_done = set(f.read().splitlines())
 
-    # --- Part A: 逐檔更新股票 ---
-    for i, stock in enumerate(all_stocks):
-        stock_id = stock['id']
-
-        # 股票清單已經包含正確上市/上櫃後綴，避免每檔都多打一輪 Yahoo 測試請求。
-        symbol = stock.get("symbol") or (f"{stock_id}.TWO" if stock.get("market") == "otc" else f"{stock_id}.TW")
-
-        # ==========================================
-        # 🚀 財報加班車「極速通關」機制
-        # ==========================================
-        if force_financials:
-            is_etf = str(stock_id).startswith('00')
-            has_been_forced = str(stock_id) in forced_done
-
-            # 判斷這檔需不需要呼叫 FinMind
-            need_finmind_now = (not is_etf) and (not has_been_forced) and (finmind_api_calls <= 580)
-
-            # 如果這班車是來補財報的，但這檔股票根本不用補 (或 API 額度已滿)
-            if not need_finmind_now:
-                continue
-
-        if progress_bar: progress_bar.progress((i + 1) / total_to_update)
-        if status_text: status_text.text(f"處理中 [{i+1}/{total_to_update}]: {stock['name']}")
-        if i % 10 == 0: print(f"[{i+1}/{total_to_update}] {stock['name']}...", end="\r")
-
-        capital_billion = 0
-        revenue_streak = 0
-        revenue_growth_pct = 0
-        revenue_ttm = 0
-        last_vol_ma5 = 0
-        last_vol_ma20 = 0
-        year_high_2y = 0
-        year_low_2y = 0
-
-        try:
-            # 1. 抓股價
-            last_date_str = db_dates.get(stock_id)
-            ticker = yf.Ticker(symbol)
-            new_hist = pd.DataFrame()
+    # 財報加班車「極速通關」：不用補財報的股票 (ETF 或已補過) 直接不排進工作
+    if force_financials:
+        work_stocks = [s for s in all_stocks
+                       if not str(s['id']).startswith('00') and str(s['id']) not in forced_done]
+    else:
+        work_stocks = all_stocks
+    total_to_update = len(work_stocks)
+
+    # 💡 批次下載模式 (預設)：同起始日的股票一次抓一組，--per-ticker 可切回逐檔抓取
+    prefetched_prices = {}
+    if '--per-ticker' not in sys.argv:
+        prefetched_prices = prefetch_price_history(work_stocks, db_dates)
+
+    # --- Part A: 並行抓取 + 單一寫入執行緒 ---
+    workers = get_cli_int('--workers', DEFAULT_FETCH_WORKERS)
+    queue_depth = get_cli_int('--queue-size', DEFAULT_QUEUE_DEPTH)
+    commit_every = get_cli_int('--commit-every', DEFAULT_COMMIT_EVERY)
+    print(f"🧵 抓取執行緒 {workers} 條 | 寫入佇列 {queue_depth} | 每 {commit_every} 檔 commit 一次")
+
+    # 💡 一次預載全市場近 600 筆歷史，主迴圈直接切陣列，不再逐檔查 SQLite
+    history_store = load_price_history_store(conn, days=600)
+    history_store.report()
+
+    # 💡 滾動指標增量狀態：與資料庫最後日期一致的股票只需套用新 K 棒
+    indicator_states = indicator_state.load_indicator_states(conn)
+    print(f"📐 已載入 {len(indicator_states)} 檔增量指標狀態")
+
+    ctx = {
+        'history_store': history_store,
+        'indicator_states': indicator_states,
+        'db_dates': db_dates,
+        'existing_funds': existing_funds,
+        'force_financials': force_financials,
+        'forced_done': forced_done,
+        'done_file': done_file,
+        'prefetched_prices': prefetched_prices,
+        'finmind_api_calls': 0,  # 追蹤 API 使用量 (每檔股票用掉 2 次請求)
+        'lock': threading.Lock(),
+    }
 
+    write_queue = queue.Queue(maxsize=queue_depth)
+    writer_stats = {'written': 0, 'failed': 0, 'unchanged': 0, 'changed': {}, 'dates': set(), 'rows': set(), 'rows_since': None}
+    writer = threading.Thread(
+        target=stock_writer_loop, args=(write_queue, commit_every, writer_stats, run_id),
+        name="stock-writer", daemon=True
+    )
+    writer.start()
+
+    def fetch_and_enqueue(stock):
+        update = process_stock_update(stock, ctx)
+        if update is None:
+            return stock
+        if update['changes'] or update['state_is_new']:
+            enqueue_update(write_queue, writer, update)
+        else:
+            # 沒有新 K 棒、基本面也沒變：不必寫入
+            with ctx['lock']:
+                writer_stats['unchanged'] += 1
+        return stock
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(fetch_and_enqueue, stock) for stock in work_stocks]
+        for i, future in enumerate(as_completed(futures)):
             try:
-                if last_date_str:
-                    last_dt = datetime.strptime(last_date_str, '%Y-%m-%d')
-                    start_dt = last_dt - timedelta(days=5)
-                    start_arg = start_dt.strftime('%Y-%m-%d')
-                    new_hist = ticker.history(start=start_arg, auto_adjust=False)
-                else:
-                    new_hist = ticker.history(period="10y", auto_adjust=False)
-            except:
-                new_hist = pd.DataFrame()
-
-            # --- 資料拼接 ---
-            if last_date_str:
-                old_df = get_db_history_data(stock_id, days=600)
-                if not new_hist.empty:
-                    try:
-                        if new_hist.index.tz is not None:
-                            new_hist.index = new_hist.index.tz_localize(None)
-                    except: pass
-
-                    combined_close = pd.concat([old_df['close'] if not old_df.empty else pd.Series(dtype=float), new_hist['Close']])
-                    if not old_df.empty and 'volume' in old_df.columns:
-                        combined_volume = pd.concat([old_df['volume'], new_hist['Volume']])
-                    else:
-                        combined_volume = new_hist['Volume']
-                else:
-                    combined_close = old_df['close'] if not old_df.empty else pd.Series(dtype=float)
-                    combined_volume = old_df['volume'] if not old_df.empty and 'volume' in old_df.columns else pd.Series(dtype=float)
-
-                combined_close = combined_close[~combined_close.index.duplicated(keep='last')]
-                combined_volume = combined_volume[~combined_volume.index.duplicated(keep='last')]
-            else:
-                if new_hist.empty: continue
-                combined_close = new_hist['Close']
-                combined_volume = new_hist['Volume']
-
-            # --- 計算指標 ---
-            if combined_close.empty: continue
-
-            # 均量
-            if not combined_volume.empty:
-                vol_ma5 = combined_volume.rolling(window=5).mean()
-                vol_ma20 = combined_volume.rolling(window=20).mean()
-                last_vol_ma5 = vol_ma5.iloc[-1] if not pd.isna(vol_ma5.iloc[-1]) else 0
-                last_vol_ma20 = vol_ma20.iloc[-1] if not pd.isna(vol_ma20.iloc[-1]) else 0
-
-            # 位階
-            past_2year = combined_close.tail(500)
-            year_high = combined_close.tail(250).max() if not combined_close.empty else 0
-            year_low = combined_close.tail(250).min() if not combined_close.empty else 0
-            year_high_2y = past_2year.max() if not past_2year.empty else year_high
-            year_low_2y = past_2year.min() if not past_2year.empty else year_low
-
-            # ★ 計算盤整天數
-            consolidation_days = 0
-            consolidation_days_20 = 0
-            if not combined_close.empty:
-                consolidation_days = calculate_consolidation_days(combined_close, threshold=0.10)
-                consolidation_days_20 = calculate_consolidation_days(combined_close, threshold=0.20)
-
-            # 填回 new_hist
-            if not new_hist.empty:
-                full_ma5 = combined_close.rolling(window=5).mean()
-                full_ma20 = combined_close.rolling(window=20).mean()
-                full_ma60 = combined_close.rolling(window=60).mean()
-                new_hist['MA5'] = full_ma5.loc[new_hist.index]
-                new_hist['MA20'] = full_ma20.loc[new_hist.index]
-                new_hist['MA60'] = full_ma60.loc[new_hist.index]
-                new_hist['Change_Pct'] = new_hist['Close'].pct_change(fill_method=None) * 100
-
-            # --- 抓取基本面 (FinMind 核心替換版) ---
-            # 💡 防護網:取得最新收盤價,若無則從資料庫撈取舊價或設為 0
-            if not new_hist.empty:
-                close_price = new_hist['Close'].iloc[-1]
-            else:
-                try:
-                    cursor.execute("SELECT close FROM daily_prices WHERE stock_id = ? ORDER BY date DESC LIMIT 1", (stock_id,))
-                    last_price_row = cursor.fetchone()
-                    close_price = last_price_row[0] if last_price_row else 0
-                except:
-                    close_price = 0
-
-            # 🚀 智慧快取機制 + 流量控管
-            curr_existing = existing_funds.get(stock_id, {})
-            db_eps = curr_existing.get('eps', 0)
-            is_etf = str(stock_id).startswith('00')
-
-            # ==========================================
-            # 💡 [新增] 財報季記憶卡機制 (防止強制模式無限重複)
-            # ==========================================
-            import os, time
-            done_file = "finmind_done.txt"
-            forced_done = set()
-
-            if force_financials:
-                # 如果記憶卡存在，檢查是不是上個季度的舊檔案 (超過 30 天)
-                if os.path.exists(done_file):
-                    file_age_days = (time.time() - os.path.getmtime(done_file)) / (24 * 3600)
-                    if file_age_days > 30:
-                        os.remove(done_file) # 太舊了，撕掉重來
-                    else:
-                        with open(done_file, 'r') as f:
-                            forced_done = set(f.read().splitlines())
-
-            has_been_forced = str(stock_id) in forced_done
-
-            # 判斷是否需要 Call FinMind:
-            if force_financials:
-                needs_update = not (str(stock_id) in forced_done)
-            else:
-                needs_update = (db_eps == 0)       # 日常模式：EPS 是空值才抓！
+                stock = future.result()
+            except Exception as e:
+                print(f"\n❌ 抓取工作失敗: {e}")
+                continue
+            if progress_bar: progress_bar.progress((i + 1) / total_to_update)
+            if status_text: status_text.text(f"處理中 [{i+1}/{total_to_update}]: {stock['name']}")
+            if i % 10 == 0: print(f"[{i+1}/{total_to_update}] {stock['name']}...", end="\r")
 
-            # 綜合判斷：不是 ETF + 需要更新 + 額度還夠 (安全值 580)
-            need_finmind = (not is_etf) and needs_update and (finmind_api_calls <= 580)
+    enqueue_update(write_queue, writer, None)
+    writer.join()
+    print(f"\n💾 寫入完成：{writer_stats['written']} 檔成功，{writer_stats['failed']} 檔失敗，{writer_stats['unchanged']} 檔無異動")
 
-            if need_finmind:
-                finmind_data = fetch_fundamentals_finmind(stock_id, close_price)
-                finmind_api_calls += 2 # 每個 stock 呼叫兩次 API (財報+股利)
+    # 🧾 本次異動集合：後續每個階段只處理這些股票
+    price_ids = sorted(writer_stats['changed'].get('prices', set()))
+    fundamental_ids = sorted(writer_stats['changed'].get('fundamentals', set()))
+    new_bar_dates = sorted(writer_stats['dates'])
+    print(f"🧾 本次異動：新 K 棒 {len(price_ids)} 檔 / 基本面 {len(fundamental_ids)} 檔 / 交易日 {len(new_bar_dates)} 天 (run_id {run_id})")
 
-                # 📝 把抓過的股票寫進記憶卡，下個小時的排程就會自動跳過它！
-                if force_financials:
-                    with open(done_file, 'a') as f:
-                        f.write(f"{stock_id}\n")
-            else:
-                # 🛡️ 防護網：沿用資料庫舊數據，絕對不洗白！
-                finmind_data = {
-                    'eps': db_eps,
-                    'eps_growth': curr_existing.get('eps_growth', 0),
-                    'gross_margin': curr_existing.get('gross_margin', 0),
-                    'operating_margin': curr_existing.get('operating_margin', 0),
-                    'pretax_margin': curr_existing.get('pretax_margin', 0),
-                    'net_margin': curr_existing.get('net_margin', 0),
-                    'revenue_growth': curr_existing.get('revenue_growth', 0),
-                    'yield_rate': curr_existing.get('yield_rate', 0),
-                    'pe_ratio': (close_price / db_eps) if db_eps > 0 and close_price > 0 else 0
-                }
-
-            eps = finmind_data.get('eps', 0)
-            pe = finmind_data.get('pe_ratio', 0)
-            yield_rate = finmind_data.get('yield_rate', 0)
-            gross_margin_pct = finmind_data.get('gross_margin', 0)
-            operating_margin_pct = finmind_data.get('operating_margin', 0)
-            pretax_margin_pct = finmind_data.get('pretax_margin', 0)
-            net_margin_pct = finmind_data.get('net_margin', 0)
-            eps_growth_pct = finmind_data.get('eps_growth', 0)
-            revenue_growth_pct = finmind_data.get('revenue_growth', 0)
-
-            revenue_ttm = revenue_growth_pct
-
-            if force_financials or needs_update:
-                try:
-                    info = yf.Ticker(symbol).info
-                except:
-                    info = {}
-                pb = info.get('priceToBook', 0) or 0
-                beta = info.get('beta', 0) or 0
-                market_cap = info.get('marketCap', 0) or 0
-                revenue_streak = calculate_revenue_streak(ticker)
-                shares = info.get('sharesOutstanding', 0)
-                capital_billion = shares / 10000000 if shares else curr_existing.get('capital', 0)
-            else:
-                pb = curr_existing.get('pb_ratio', 0)
-                beta = curr_existing.get('beta', 0)
-                market_cap = curr_existing.get('market_cap', 0)
-                revenue_streak = curr_existing.get('revenue_streak', 0)
-                capital_billion = curr_existing.get('capital', 0)
-
-            # --- 寫入資料庫 (stocks) ---
-            cursor.execute('''
-                UPDATE stocks
-                SET eps=?, pe_ratio=?, pb_ratio=?, yield_rate=?, beta=?, market_cap=?,
-                    revenue_growth=?, revenue_ttm=?, revenue_streak=?, eps_growth=?,
-                    year_high=?, year_low=?, capital=?, vol_ma_5=?, vol_ma_20=?,
-                    year_high_2y=?, year_low_2y=?, gross_margin=?,
-                    operating_margin=?, pretax_margin=?, net_margin=?,
-                    consolidation_days=?, consolidation_days_20=?,
-                    last_updated=?
-                WHERE stock_id=?
-            ''', (eps, pe, pb, yield_rate, beta, market_cap,
-                  revenue_growth_pct, revenue_ttm, revenue_streak, eps_growth_pct,
-                  year_high, year_low, capital_billion, last_vol_ma5, last_vol_ma20,
-                  year_high_2y, year_low_2y, gross_margin_pct,
-                  operating_margin_pct, pretax_margin_pct, net_margin_pct,
-                  consolidation_days, consolidation_days_20,
-                  datetime.now().strftime('%Y-%m-%d %H:%M:%S'), stock_id))
-
-            if cursor.rowcount == 0:
-                 cursor.execute('''
-                    INSERT INTO stocks (stock_id, name, industry, market_type, yahoo_symbol,
-                    eps, pe_ratio, pb_ratio, yield_rate, beta, market_cap,
-                    revenue_growth, revenue_ttm, revenue_streak, eps_growth,
-                    year_high, year_low, capital, vol_ma_5, vol_ma_20,
-                    year_high_2y, year_low_2y, gross_margin,
-                    operating_margin, pretax_margin, net_margin, consolidation_days, consolidation_days_20, last_updated)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (stock_id, stock['name'], stock['industry'], stock['market'], symbol,
-                      eps, pe, pb, yield_rate, beta, market_cap,
-                      revenue_growth_pct, revenue_ttm, revenue_streak, eps_growth_pct,
-                      year_high, year_low, capital_billion, last_vol_ma5, last_vol_ma20,
-                      year_high_2y, year_low_2y, gross_margin_pct,
-                      operating_margin_pct, pretax_margin_pct, net_margin_pct, consolidation_days, consolidation_days_20,
-                      datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
-
-            # --- ★★★ 預先計算指標 (每次更新後立即計算) ★★★
-            calculate_precompute_for_stock(cursor, stock_id)
-
-            # --- 寫入資料庫 (daily_prices) ---
-            if not new_hist.empty:
-                data_to_insert = []
-                for date, row in new_hist.iterrows():
-                    date_str = date.strftime('%Y-%m-%d')
-                    ma5 = row['MA5'] if pd.notna(row['MA5']) else None
-                    ma20 = row['MA20'] if pd.notna(row['MA20']) else None
-                    ma60 = row['MA60'] if pd.notna(row['MA60']) else None
-                    change = row['Change_Pct'] if pd.notna(row['Change_Pct']) else 0
-
-                    data_to_insert.append((stock_id, date_str, row['Open'], row['High'], row['Low'], row['Close'], row['Volume'], change, ma5, ma20, ma60))
-
-                cursor.executemany('''
-                    INSERT OR REPLACE INTO daily_prices
-                    (stock_id, date, open, high, low, close, volume, change_pct, ma_5, ma_20, ma_60)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                ''', data_to_insert)
-
-            conn.commit()
-
-        except Exception as e:
-            print(f"\n❌ {stock_id} 發生錯誤: {e}")
-            continue
+    # --- Part A-2: 全市場盤整天數 + 門檻斷點 (向量化) ---
+    try:
+        if price_ids:
+            consolidation.refresh_consolidation(conn, stock_ids=price_ids)
+        else:
+            print("⏭️ 沒有新 K 棒，盤整天數不需重算")
+    except Exception as e:
+        print(f"⚠️ 盤整天數計算失敗: {e}")
 
-        time.sleep(0.2)
+    # --- Part A-3: 滾動高低點索引 (任意回看天數位階) ---
+    try:
+        if price_ids:
+            extrema_index.refresh_extrema_index(conn, stock_ids=price_ids)
+    except Exception as e:
+        print(f"⚠️ 高低點索引更新失敗: {e}")
 
     # --- Part B: 新增與補齊每日市場統計 ---
     print("\n📊 正在檢查並補齊大盤創新低家數...")
     try:
-        # 0. 確保表格存在
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS market_stats (
-                date TEXT PRIMARY KEY,
-                new_low_count INTEGER,
-                updated_at TEXT
-            )
-        ''')
-
-        # 1. 找出股價表有,但統計表沒有的「漏洞日期」(從2026開始查)
-        cursor.execute("""
-            SELECT DISTINCT date
-            FROM daily_prices
-            WHERE date >= '2026-01-01'
-            AND date NOT IN (SELECT date FROM market_stats)
-            ORDER BY date ASC
-        """)
-        missing_dates = [row[0] for row in cursor.fetchall()]
-
-        if not missing_dates:
+        # 重算本次有新 K 棒的交易日，加上所有缺漏的日期 (從2026開始查，上次中途失敗留下的破洞也一併補上)
+        # 高低點用當天往回 250 個交易日 (視窗函數，一次查詢)，不再拿今天的 year_high/year_low 套用到過去
+        market_stats.init_market_stats_table(cursor)
+        stats_dates = sorted(set(new_bar_dates) | set(market_stats.missing_dates(conn)))
+        written = market_stats.refresh_market_stats(conn, dates=stats_dates)
+
+        if not written:
             print("✅ 大盤統計已是最新,無破洞需補齊。")
         else:
-            print(f"🔍 發現 {len(missing_dates)} 天缺失的統計資料,開始自動補齊...")
-
-            # 2. 迴圈逐日計算並補齊
-            for target_date in missing_dates:
-                # 這裡使用當天收盤價與 stocks 表的年低點做計算
-                sql_stat_position = """
-                SELECT COUNT(*)
-                FROM stocks s
-                JOIN daily_prices d ON s.stock_id = d.stock_id
-                WHERE d.date = ?
-                AND (s.year_high - s.year_low) > 0
-                AND (d.close - s.year_low) / (s.year_high - s.year_low) <= 0.01
-                """
-                cursor.execute(sql_stat_position, (target_date,))
-                low_count = cursor.fetchone()[0]
-
-                # 寫入資料庫
-                cursor.execute('''
-                    INSERT OR REPLACE INTO market_stats (date, new_low_count, updated_at)
-                    VALUES (?, ?, ?)
-                ''', (target_date, low_count, datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
-
-                print(f"📅 補齊日期: {target_date} | 📉 創新低家數: {low_count}")
-
-            conn.commit()
             print("✅ 大盤統計資料補齊完成!")
 
     except Exception as e:
@@ -660,6 +977,8 @@ def update_stock_data(progress_bar=None, status_text=None):
 
     # ★★★ Part C: 月營收智能增量更新 ★★★
     # 只在第一次執行時更新月營收（避免每次重複）
+    # 這裡刻意掃全市場而不限 dirty set：新月營收本身就是異動來源 (下面的 revenue_ids)，
+    # 價量沒變的股票也可能公布新營收；已有預期月份的股票只做一次本機查詢就跳過，不打 API
     if REVENUE_AVAILABLE and len(all_stocks) > 100:
         print("\n📊 開始月營收智能增量更新...")
         try:
@@ -670,45 +989,98 @@ def update_stock_data(progress_bar=None, status_text=None):
     else:
         print("\n⏭️ 月營收更新跳過（已是最新或批次過小）")
 
+    # 本次寫入新月營收的股票也算異動 (營收 YOY 需要同步)
+    revenue_ids = set()
+    try:
+        cursor.execute("SELECT DISTINCT stock_id FROM monthly_revenue WHERE updated_at >= ?", (run_id,))
+        revenue_ids = {row[0] for row in cursor.fetchall()}
+        database.record_stock_changes(cursor, run_id, revenue_ids, 'revenue')
+        database.prune_change_log(cursor)
+        conn.commit()
+    except sqlite3.OperationalError:
+        pass
+
     # ★★★ Part D: 批次預先計算 ★★★
-    # 只預先計算本次更新的股票
-    update_ids_list = [s['id'] for s in all_stocks]
-    run_batch_precompute(stock_ids=update_ids_list)
+    # 只預先計算本次有異動的股票
+    dirty_ids = sorted(set(price_ids) | set(fundamental_ids) | revenue_ids)
+    run_batch_precompute(stock_ids=dirty_ids, price_ids=price_ids)
 
     conn.close()
 
     # ==========================================
     # ★★★ GitHub 版本專屬:自動瘦身與壓縮 (.xz) ★★★
     # ==========================================
+    if not dirty_ids and database.DB_XZ_PATH.exists():
+        print("\n⏭️ 本次沒有任何異動，壓縮檔維持原樣")
+        if not hot_db.HOT_XZ_PATH.exists():
+            hot_db.export_hot_database(database.reader_path())
+        return
+
     print("\n🧹 [GitHub Mode] 執行資料庫瘦身 (保留近 5 年)...")
+    # 1. 重新連線 (autocommit，ATTACH / VACUUM 不能在交易中執行)
+    clean_conn = sqlite3.connect(database.DB_NAME, isolation_level=None)
     try:
-        import lzma
-        import shutil
-        # 1. 重新連線進行 VACUUM
-        clean_conn = sqlite3.connect(database.DB_NAME, isolation_level=None)
         clean_cursor = clean_conn.cursor()
 
-        # 刪除 5 年前資料
-        clean_cursor.execute("DELETE FROM daily_prices WHERE date < date('now', '-5 years')")
-        print(f"   已清除 {clean_cursor.rowcount} 筆過期資料。")
-
-        # 重組資料庫 (VACUUM)
-        print("   正在執行資料庫重組 (VACUUM)...")
-        clean_cursor.execute("VACUUM")
-        clean_conn.close()
-
-        # 2. 執行 LZMA 強力壓縮
+        # 5 年前資料搬進分年封存檔 (截止日也寫進差異檔，套用端用同一天刪除)
+        # 封存檔只留在本機 (不發佈)，長期分析請在更新主機上用 archive_store.open_long_history
+        prune_before = clean_cursor.execute("SELECT date('now', ?)", (archive_store.RETENTION,)).fetchone()[0]
+        moved = archive_store.archive_expired_rows(clean_conn, prune_before)
+        print(f"   已封存 {sum(moved.values())} 筆過期資料。")
+
+        # 平常只發佈差異檔；base 過舊、差異檔累積過大或結構變動時才重新發佈完整資料庫
+        need_base, reason = db_delta.needs_full_base(clean_conn)
+        if full_base or not database.DB_XZ_PATH.exists():
+            need_base, reason = True, '指定 --full-base' if full_base else '尚未有壓縮檔'
+        if need_base:
+            print(f"🧱 發佈完整資料庫 ({reason})")
+
+        # 空頁分批歸還，成本只跟當天搬走的量有關；發佈 base 前全部歸還 (不再整檔 VACUUM 重寫；舊資料庫第一次會自動轉換成 INCREMENTAL)
+        freed, remaining = database.incremental_vacuum(
+            clean_conn, max_pages=None if need_base else database.INCREMENTAL_VACUUM_PAGES)
+        print(f"   incremental_vacuum 歸還 {freed} 頁，剩餘空頁 {remaining}")
+
+        # 2. 線上備份成一致的快照並做健康檢查，沒通過就拋出 RuntimeError，本次什麼都不發佈
+        #    通過後原子換上 stock_data.snapshot.db，本機 App 下次取連線時改讀新版
+        base_id = db_delta.new_base_id() if need_base else None
+        snapshot_path = db_snapshot.create_snapshot(base_id=base_id)
+
+        # 熱資料檔 (快照 / 大盤 / 策略) 每次都整份重新發佈，App 啟動只需解壓這個小檔
+        hot_db.export_hot_database(snapshot_path)
+
+        if not need_base:
+            db_delta.export_delta(clean_conn, run_id, sorted(set(dirty_ids) | writer_stats['rows']),
+                                  sorted(set(price_ids) | writer_stats['rows']),
+                                  since=writer_stats['rows_since'], prune_before=prune_before)
+            return
+
+        # 3. 執行 LZMA 強力壓縮 (多區塊平行壓縮，lzma.open 仍可直接讀取)
         print("📦 正在執行 LZMA 強力壓縮...")
-        if database.DB_PATH.exists():
-            with database.DB_PATH.open('rb') as f_in:
-                with lzma.open(database.DB_XZ_PATH, 'wb', preset=9) as f_out:
-                    shutil.copyfileobj(f_in, f_out)
-            print("✅ 壓縮完成:產生 stock_data.db.xz")
-        else:
-            print("❌ 找不到 stock_data.db,無法壓縮")
-
+        started = time.time()
+        blocks, size = xz_blocks.compress_file(snapshot_path, database.DB_XZ_PATH)
+        print(f"✅ 壓縮完成:產生 stock_data.db.xz ({blocks} 個區塊，{size / 1024 / 1024:.1f} MB，耗時 {time.time() - started:.1f} 秒)")
+        db_delta.finish_full_base(clean_conn, base_id, database.DB_XZ_PATH)
+
+    except RuntimeError:
+        # 快照檢查失敗：讓整次更新以非 0 結束，更新腳本就不會推送
+        raise
     except Exception as e:
         print(f"⚠️ 瘦身或壓縮失敗: {e}")
+    finally:
+        clean_conn.close()
 
 if __name__ == "__main__":
-    update_stock_data()
+    import sys
+    if '--benchmark-download' in sys.argv:
+        # 用法: python fetch_data.py --benchmark-download [樣本數] [--fixtures 目錄]
+        args = sys.argv[sys.argv.index('--benchmark-download') + 1:]
+        sample = int(args[0]) if args and args[0].isdigit() else 50
+        fixtures = args[args.index('--fixtures') + 1] if '--fixtures' in args else None
+        benchmark_download_modes(sample, fixtures)
+    else:
+        # --full-base: 不發佈差異檔，直接重新發佈完整的 stock_data.db.xz
+        try:
+            update_stock_data(full_base='--full-base' in sys.argv)
+        except RuntimeError as e:
+            print(f"🛑 {e}")
+            sys.exit(1)
@@ -16,9 +16,9 @@ def precompute_position(stock_id, conn):
     """
     cursor = conn.cursor()
     
-    # 取得最近一日收盤價
+    # 取得最近一日收盤價 (區間以該股最後一根 K 棒往回推，不隨執行日期漂移)
     cursor.execute('''
-        SELECT close FROM daily_prices 
+        SELECT close, date FROM daily_prices 
         WHERE stock_id = ? 
         ORDER BY date DESC LIMIT 1
     ''', (stock_id,))
@@ -27,14 +27,14 @@ def precompute_position(stock_id, conn):
     if not row:
         return None, None
     
-    current_close = row[0]
+    current_close, last_date = row
     
     # 計算近一年位階
     cursor.execute('''
         SELECT MAX(close) as year_high, MIN(close) as year_low
         FROM daily_prices 
-        WHERE stock_id = ? AND date >= date('now', '-250 days')
-    ''', (stock_id,))
+        WHERE stock_id = ? AND date >= date(?, '-250 days')
+    ''', (stock_id, last_date))
     
     row = cursor.fetchone()
     if row and row[0] and row[1]:
@@ -50,8 +50,8 @@ def precompute_position(stock_id, conn):
     cursor.execute('''
         SELECT MAX(close) as year_high_2y, MIN(close) as year_low_2y
         FROM daily_prices 
-        WHERE stock_id = ? AND date >= date('now', '-500 days')
-    ''', (stock_id,))
+        WHERE stock_id = ? AND date >= date(?, '-500 days')
+    ''', (stock_id, last_date))
     
     row = cursor.fetchone()
     if row and row[0] and row[1]:
@@ -148,16 +148,23 @@ def precompute_consolidation_log(stock_id, conn):
     return None
 
 
-def sync_revenue_yoy_to_stocks(conn):
+def sync_revenue_yoy_to_stocks(conn, stock_ids=None):
     """
     將 monthly_revenue 的最新 cumulative_yoy 同步到 stocks 表的 revenue_growth
+    stock_ids 有指定時只同步這些股票
     """
     cursor = conn.cursor()
     
     print("🔄 開始同步月營收 YOY 到 stocks 表...")
-    
+
+    stock_filter = ""
+    params = []
+    if stock_ids is not None:
+        stock_filter = f"AND m1.stock_id IN ({', '.join(['?'] * len(stock_ids))})"
+        params = list(stock_ids)
+
     # 取得每檔股票的最新 cumulative_yoy
-    cursor.execute('''
+    cursor.execute(f'''
         SELECT stock_id, cumulative_yoy
         FROM monthly_revenue m1
         WHERE (stock_id, year, month) = (
@@ -167,7 +174,8 @@ def sync_revenue_yoy_to_stocks(conn):
             ORDER BY year DESC, month DESC
             LIMIT 1
         )
-    ''')
+        {stock_filter}
+    ''', params)
     
     yoy_data = cursor.fetchall()
     updated = 0
@@ -188,9 +196,57 @@ def sync_revenue_yoy_to_stocks(conn):
     print(f"✅ YOY 同步完成！更新 {updated} 檔，跳過 {skipped} 檔")
 
 
-def refresh_latest_stock_snapshot(conn=None):
+SNAPSHOT_TABLE = "latest_stock_snapshot"
+SNAPSHOT_SHADOW_TABLE = "latest_stock_snapshot_shadow"
+
+SNAPSHOT_SELECT = '''
+    SELECT
+        s.stock_id, s.name, s.industry, s.market_type,
+        s.pe_ratio, s.yield_rate, s.pb_ratio, s.eps, s.beta, s.market_cap,
+        s.revenue_growth, s.revenue_streak, s.capital, s.vol_ma_5, s.vol_ma_20,
+        s.eps_growth, s.gross_margin,
+        s.operating_margin, s.pretax_margin, s.net_margin,
+        s.consolidation_days, s.consolidation_days_20,
+        s.position_1y, s.position_2y, s.bias_20, s.bias_60,
+        s.vol_spike, s.consolidation_log,
+        s.year_high, s.year_low, s.year_high_2y, s.year_low_2y,
+        d.date, d.close, d.change_pct, d.volume, d.ma_5, d.ma_20, d.ma_60
+    FROM stocks s
+    JOIN daily_prices d ON s.stock_id = d.stock_id
+    WHERE d.date = (
+        SELECT MAX(date)
+        FROM daily_prices dp
+        WHERE dp.stock_id = s.stock_id
+    )
+'''
+
+SNAPSHOT_INDEXES = [
+    ("idx_snapshot_stock_id", "stock_id"),
+    ("idx_snapshot_industry", "industry"),
+    ("idx_snapshot_position_1y", "position_1y"),
+    ("idx_snapshot_position_2y", "position_2y"),
+    ("idx_snapshot_revenue_growth", "revenue_growth"),
+    ("idx_snapshot_eps_growth", "eps_growth"),
+    ("idx_snapshot_gross_margin", "gross_margin"),
+    ("idx_snapshot_vol_spike", "vol_spike"),
+]
+
+
+def _snapshot_columns_match(cursor):
+    """現有快照欄位是否與 SNAPSHOT_SELECT 一致 (欄位有變動時必須全量重建)"""
+    cursor.execute(f"PRAGMA table_info({SNAPSHOT_TABLE})")
+    existing = [r[1] for r in cursor.fetchall()]
+    cursor.execute(f"SELECT * FROM ({SNAPSHOT_SELECT}) LIMIT 0")
+    expected = [c[0] for c in cursor.description]
+    return existing == expected
+
+
+def refresh_latest_stock_snapshot(conn=None, stock_ids=None):
     """
-    建立首頁篩選用快照表，避免 Streamlit 每次查詢都 JOIN 全量 daily_prices。
+    刷新首頁篩選用快照表，避免 Streamlit 每次查詢都 JOIN 全量 daily_prices。
+    - stock_ids 有指定且快照已存在：在單一交易內刪除並重新插入這些股票 (增量 upsert)
+    - 否則：先建影子表與索引，再於單一交易內換名上線
+    兩種方式讀取端都只會看到完整的舊版或新版快照，並記錄 data_versions['snapshot']。
     """
     should_close = False
     if conn is None:
@@ -198,191 +254,353 @@ def refresh_latest_stock_snapshot(conn=None):
         should_close = True
 
     cursor = conn.cursor()
-    print("📸 開始刷新 latest_stock_snapshot...")
+    conn.commit()  # 結束先前未提交的交易，以下自行控制交易範圍
+    started = datetime.now()
 
-    cursor.execute("DROP TABLE IF EXISTS latest_stock_snapshot")
-    cursor.execute('''
-        CREATE TABLE latest_stock_snapshot AS
-        SELECT
-            s.stock_id, s.name, s.industry, s.market_type,
-            s.pe_ratio, s.yield_rate, s.pb_ratio, s.eps, s.beta, s.market_cap,
-            s.revenue_growth, s.revenue_streak, s.capital, s.vol_ma_5, s.vol_ma_20,
-            s.eps_growth, s.gross_margin,
-            s.operating_margin, s.pretax_margin, s.net_margin,
-            s.consolidation_days, s.consolidation_days_20,
-            s.position_1y, s.position_2y, s.bias_20, s.bias_60,
-            s.vol_spike, s.consolidation_log,
-            s.year_high, s.year_low, s.year_high_2y, s.year_low_2y,
-            d.date, d.close, d.change_pct, d.volume, d.ma_5, d.ma_20, d.ma_60
-        FROM stocks s
-        JOIN daily_prices d ON s.stock_id = d.stock_id
-        WHERE d.date = (
-            SELECT MAX(date)
-            FROM daily_prices dp
-            WHERE dp.stock_id = s.stock_id
-        )
-    ''')
+    cursor.execute("SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name=?", (SNAPSHOT_TABLE,))
+    snapshot_exists = cursor.fetchone()[0] > 0
+    incremental = stock_ids is not None and snapshot_exists and _snapshot_columns_match(cursor)
 
-    indexes = [
-        "CREATE INDEX IF NOT EXISTS idx_snapshot_stock_id ON latest_stock_snapshot(stock_id)",
-        "CREATE INDEX IF NOT EXISTS idx_snapshot_industry ON latest_stock_snapshot(industry)",
-        "CREATE INDEX IF NOT EXISTS idx_snapshot_position_1y ON latest_stock_snapshot(position_1y)",
-        "CREATE INDEX IF NOT EXISTS idx_snapshot_position_2y ON latest_stock_snapshot(position_2y)",
-        "CREATE INDEX IF NOT EXISTS idx_snapshot_revenue_growth ON latest_stock_snapshot(revenue_growth)",
-        "CREATE INDEX IF NOT EXISTS idx_snapshot_eps_growth ON latest_stock_snapshot(eps_growth)",
-        "CREATE INDEX IF NOT EXISTS idx_snapshot_gross_margin ON latest_stock_snapshot(gross_margin)",
-        "CREATE INDEX IF NOT EXISTS idx_snapshot_vol_spike ON latest_stock_snapshot(vol_spike)",
-    ]
-    for sql in indexes:
-        cursor.execute(sql)
+    if incremental:
+        print(f"📸 增量刷新 latest_stock_snapshot ({len(stock_ids)} 檔)...")
+        placeholders = ", ".join(["?"] * len(stock_ids))
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            cursor.execute(f"DELETE FROM {SNAPSHOT_TABLE} WHERE stock_id IN ({placeholders})", list(stock_ids))
+            cursor.execute(f"INSERT INTO {SNAPSHOT_TABLE} {SNAPSHOT_SELECT} AND s.stock_id IN ({placeholders})", list(stock_ids))
+            changed = cursor.rowcount
+            version = database.bump_data_version(cursor, 'snapshot')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    else:
+        print("📸 開始重建 latest_stock_snapshot (影子表)...")
+        # 1. 影子表先建好 (此時讀取端仍使用舊快照)
+        cursor.execute(f"DROP TABLE IF EXISTS {SNAPSHOT_SHADOW_TABLE}")
+        cursor.execute(f"CREATE TABLE {SNAPSHOT_SHADOW_TABLE} AS {SNAPSHOT_SELECT}")
+        conn.commit()
 
-    cursor.execute("SELECT COUNT(*) FROM latest_stock_snapshot")
-    snapshot_count = cursor.fetchone()[0]
-    conn.commit()
+        # 2. 單一交易內換名 + 建索引，提交前讀取端看到的都是舊快照
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            cursor.execute(f"DROP TABLE IF EXISTS {SNAPSHOT_TABLE}")
+            cursor.execute(f"ALTER TABLE {SNAPSHOT_SHADOW_TABLE} RENAME TO {SNAPSHOT_TABLE}")
+            for name, column in SNAPSHOT_INDEXES:
+                cursor.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {SNAPSHOT_TABLE}({column})")
+            version = database.bump_data_version(cursor, 'snapshot')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        cursor.execute(f"SELECT COUNT(*) FROM {SNAPSHOT_TABLE}")
+        changed = cursor.fetchone()[0]
 
     if should_close:
         conn.close()
 
-    print(f"✅ latest_stock_snapshot 刷新完成，共 {snapshot_count} 檔")
-    return snapshot_count
+    elapsed = (datetime.now() - started).total_seconds()
+    print(f"✅ latest_stock_snapshot 刷新完成，共 {changed} 檔 (版本 {version}，耗時 {elapsed:.2f} 秒)")
+    return changed
+
 
+PRECOMPUTE_COLUMNS = ['position_1y', 'position_2y', 'bias_20', 'bias_60', 'vol_spike', 'consolidation_log']
 
-def update_precomputed_metrics():
+
+def load_precompute_inputs(conn, stock_ids=None):
     """
-    更新所有股票的預先計算指標
+    一次查詢取回全市場計算所需欄位：最新一筆日線 + 近 250/500 天高低點 + stocks 的均量與盤整天數
+    (日期區間定義與 precompute_position 相同：以各股最後交易日 last_date 往回 250 / 500 天，
+     沒有新 K 棒的股票區間不變，不會因為沒被重算而漂移)
+    """
+    stock_filter = ""
+    params = []
+    if stock_ids is not None:
+        stock_filter = f"WHERE s.stock_id IN ({', '.join(['?'] * len(stock_ids))})"
+        params = list(stock_ids)
+
+    # 每個子查詢都走 (stock_id, date) 主鍵索引做區間掃描，比 GROUP BY 全表掃描快
+    return pd.read_sql(f'''
+        WITH base AS (
+            SELECT s.stock_id, s.vol_ma_20, s.consolidation_days,
+                   (SELECT MAX(date) FROM daily_prices d WHERE d.stock_id = s.stock_id) AS last_date
+            FROM stocks s
+            {stock_filter}
+        ),
+        extremes AS (
+            SELECT b.*,
+                   (SELECT MAX(close) FROM daily_prices x WHERE x.stock_id = b.stock_id AND x.date >= date(b.last_date, '-250 days')) AS high_1y,
+                   (SELECT MIN(close) FROM daily_prices x WHERE x.stock_id = b.stock_id AND x.date >= date(b.last_date, '-250 days')) AS low_1y,
+                   (SELECT MAX(close) FROM daily_prices x WHERE x.stock_id = b.stock_id AND x.date >= date(b.last_date, '-500 days')) AS high_2y,
+                   (SELECT MIN(close) FROM daily_prices x WHERE x.stock_id = b.stock_id AND x.date >= date(b.last_date, '-500 days')) AS low_2y
+            FROM base b
+        )
+        SELECT e.stock_id, e.vol_ma_20, e.consolidation_days,
+               d.close, d.volume, d.ma_20, d.ma_60,
+               e.high_1y, e.low_1y, e.high_2y, e.low_2y
+        FROM extremes e
+        LEFT JOIN daily_prices d ON d.stock_id = e.stock_id AND d.date = e.last_date
+    ''', conn, params=params)
+
+
+def compute_precomputed_frame(inputs):
+    """
+    向量化計算全部預先指標，規則與 precompute_position / bias / vol_spike / consolidation_log 相同
+    (沒有資料的欄位為 NaN，寫入時轉成 NULL)
+    """
+    inputs = inputs.copy()
+    numeric_cols = [c for c in inputs.columns if c != 'stock_id']
+    inputs[numeric_cols] = inputs[numeric_cols].apply(pd.to_numeric, errors='coerce')
+
+    df = pd.DataFrame({'stock_id': inputs['stock_id']})
+    close = inputs['close']
+
+    for period, high_col, low_col in [('1y', 'high_1y', 'low_1y'), ('2y', 'high_2y', 'low_2y')]:
+        high, low = inputs[high_col], inputs[low_col]
+        has_range = high.fillna(0).ne(0) & low.fillna(0).ne(0) & close.notna()
+        position = np.where(high > low, (close - low) / (high - low), 0.5)
+        df[f'position_{period}'] = np.where(has_range, position, np.nan)
+
+    valid_close = close.fillna(0).ne(0)
+    for window in (20, 60):
+        ma = inputs[f'ma_{window}']
+        ok = valid_close & ma.fillna(0).ne(0)
+        df[f'bias_{window}'] = np.where(ok, (close - ma) / ma.where(ok, 1), np.nan)
+
+    vol_ma_20 = inputs['vol_ma_20']
+    ok = inputs['volume'].fillna(0).ne(0) & (vol_ma_20 > 0)
+    df['vol_spike'] = np.where(ok, inputs['volume'] / vol_ma_20.where(ok, 1), np.nan)
+
+    days = inputs['consolidation_days']
+    df['consolidation_log'] = np.where(days.fillna(0).ne(0), np.log1p(days.fillna(0)), np.nan)
+    return df
+
+
+def bulk_update_stocks(conn, frame, columns, touch_last_updated=True):
+    """
+    把 frame[stock_id + columns] 寫進暫存表，再用單一 UPDATE 套回 stocks
     """
-    conn = get_connection()
     cursor = conn.cursor()
-    
+    cursor.execute("DROP TABLE IF EXISTS temp.stock_updates")
+    cursor.execute(f"CREATE TEMP TABLE stock_updates (stock_id TEXT PRIMARY KEY, {', '.join(f'{c} REAL' for c in columns)})")
+
+    values = frame[['stock_id'] + columns].astype(object).where(frame[['stock_id'] + columns].notna(), None)
+    cursor.executemany(
+        f"INSERT INTO stock_updates VALUES ({', '.join(['?'] * (len(columns) + 1))})",
+        values.itertuples(index=False, name=None)
+    )
+
+    set_columns = ", ".join(columns)
+    extra = ", last_updated = ?" if touch_last_updated else ""
+    params = [datetime.now().strftime('%Y-%m-%d %H:%M:%S')] if touch_last_updated else []
+    cursor.execute(f'''
+        UPDATE stocks SET
+            ({set_columns}) = (SELECT {set_columns} FROM stock_updates u WHERE u.stock_id = stocks.stock_id)
+            {extra}
+        WHERE stock_id IN (SELECT stock_id FROM stock_updates)
+    ''', params)
+    updated = cursor.rowcount
+    cursor.execute("DROP TABLE temp.stock_updates")
+    return updated
+
+
+def update_precomputed_metrics(stock_ids=None):
+    """
+    更新預先計算指標 (一次查詢 + 向量化計算 + 單一 UPDATE)
+    參數:
+        stock_ids: 指定更新哪些股票，None 則更新全部
+    """
+    conn = get_connection()
+
     print("🚀 開始預先計算指標更新...")
-    
-    # 取得所有股票
-    cursor.execute("SELECT stock_id FROM stocks")
-    stocks = [row[0] for row in cursor.fetchall()]
-    
-    total = len(stocks)
-    updated = 0
-    
-    for i, stock_id in enumerate(stocks):
-        if i % 100 == 0:
-            print(f"  [{i+1}/{total}] 處理中...", end="\r")
-        
-        try:
-            # 計算各項指標
-            position_1y, position_2y = precompute_position(stock_id, conn)
-            bias_20, bias_60 = precompute_bias(stock_id, conn)
-            vol_spike = precompute_vol_spike(stock_id, conn)
-            consolidation_log = precompute_consolidation_log(stock_id, conn)
-            
-            # 更新 stocks 表
-            cursor.execute('''
-                UPDATE stocks SET
-                    position_1y = ?,
-                    position_2y = ?,
-                    bias_20 = ?,
-                    bias_60 = ?,
-                    vol_spike = ?,
-                    consolidation_log = ?,
-                    last_updated = ?
-                WHERE stock_id = ?
-            ''', (
-                position_1y, position_2y, bias_20, bias_60, 
-                vol_spike, consolidation_log,
-                datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                stock_id
-            ))
-            
-            updated += 1
-            
-        except Exception as e:
-            print(f"\n❌ {stock_id} 計算失敗: {e}")
-            continue
-    
+    started = datetime.now()
+
+    inputs = load_precompute_inputs(conn, stock_ids)
+    frame = compute_precomputed_frame(inputs)
+    updated = bulk_update_stocks(conn, frame, PRECOMPUTE_COLUMNS)
+    conn.commit()
+
     # 🔄 同步月營收 YOY
-    sync_revenue_yoy_to_stocks(conn)
-    
+    sync_revenue_yoy_to_stocks(conn, stock_ids)
+
     conn.commit()
     conn.close()
-    
-    print(f"\n🎉 預先計算完成！共更新 {updated}/{total} 檔股票")
+
+    elapsed = (datetime.now() - started).total_seconds()
+    print(f"🎉 預先計算完成！共更新 {updated}/{len(inputs)} 檔股票，耗時 {elapsed:.2f} 秒")
 
 
-def update_weekly_ma():
+def verify_precomputed_metrics(tolerance=1e-9):
     """
-    更新週線均線 (weekly_ma_5, weekly_ma_20)
+    以原本逐檔的 precompute_* 函數重算，比對批次引擎結果，回傳不一致筆數
     """
     conn = get_connection()
-    cursor = conn.cursor()
-    
-    print("\n🚀 開始更新週線均線...")
-    
-    cursor.execute("SELECT stock_id FROM stocks")
-    stocks = [row[0] for row in cursor.fetchall()]
-    
-    total = len(stocks)
-    updated = 0
-    
-    for i, stock_id in enumerate(stocks):
-        if i % 100 == 0:
-            print(f"  [{i+1}/{total}] 處理中...", end="\r")
-        
-        try:
-            # 取得日線資料
-            df = pd.read_sql('''
-                SELECT date, close, volume FROM daily_prices 
-                WHERE stock_id = ? ORDER BY date ASC
-            ''', conn, params=(stock_id,))
-            
-            if len(df) < 20:
+    frame = compute_precomputed_frame(load_precompute_inputs(conn)).set_index('stock_id')
+
+    mismatched = 0
+    for stock_id, row in frame.iterrows():
+        position_1y, position_2y = precompute_position(stock_id, conn)
+        bias_20, bias_60 = precompute_bias(stock_id, conn)
+        expected = {
+            'position_1y': position_1y, 'position_2y': position_2y,
+            'bias_20': bias_20, 'bias_60': bias_60,
+            'vol_spike': precompute_vol_spike(stock_id, conn),
+            'consolidation_log': precompute_consolidation_log(stock_id, conn),
+        }
+        for col, value in expected.items():
+            actual = row[col]
+            if value is None and pd.isna(actual):
                 continue
-            
-            df['date'] = pd.to_datetime(df['date'])
-            
-            # 轉換週線
-            logic = {
-                'open': 'first',
-                'high': 'max',
-                'low': 'min',
-                'close': 'last',
-                'volume': 'sum'
-            }
-            
-            # 需要完整日線才能計算週線
-            # 這裡簡化處理：直接用日線 close 計算週均線
-            # 更精確的做法是先轉週線再算均線
-            
-            # 計算週均線（近似值：5日 = 1週，20日 = 4週）
-            df['weekly_ma_5'] = df['close'].rolling(window=5).mean()
-            df['weekly_ma_20'] = df['close'].rolling(window=20).mean()
-            
-            # 更新 daily_prices 表
-            for _, row in df.iterrows():
-                if pd.notna(row['weekly_ma_5']) or pd.notna(row['weekly_ma_20']):
-                    cursor.execute('''
-                        UPDATE daily_prices 
-                        SET weekly_ma_5 = ?, weekly_ma_20 = ?
-                        WHERE stock_id = ? AND date = ?
-                    ''', (
-                        row['weekly_ma_5'] if pd.notna(row['weekly_ma_5']) else None,
-                        row['weekly_ma_20'] if pd.notna(row['weekly_ma_20']) else None,
-                        stock_id,
-                        row['date'].strftime('%Y-%m-%d')
-                    ))
-            
-            updated += 1
-            
-        except Exception as e:
-            print(f"\n❌ {stock_id} 週線計算失敗: {e}")
-            continue
-    
+            if value is None or pd.isna(actual) or not np.isclose(actual, value, rtol=tolerance):
+                mismatched += 1
+                print(f"   ⚠️ {stock_id} {col}: 逐檔 {value} / 批次 {actual}")
+    conn.close()
+
+    print(f"🔍 驗證 {len(frame)} 檔，{mismatched} 個欄位不一致")
+    return mismatched
+
+
+WEEKLY_MA_WINDOWS = (5, 20)
+
+
+def init_weekly_prices_table(cursor):
+    # date = 該週結算日 (週五，與 pandas resample('W-FRI') 的標籤相同)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS weekly_prices (
+            stock_id TEXT, date TEXT,
+            open REAL, high REAL, low REAL, close REAL, volume INTEGER,
+            ma_5 REAL, ma_20 REAL,
+            last_trade_date TEXT,   -- 這根週 K 最後一個交易日 (當週未結束時會持續更新)
+            PRIMARY KEY (stock_id, date)
+        )
+    ''')
+
+
+def build_weekly_bars(daily):
+    """
+    日線 (stock_id, date, open, high, low, close, volume) → 週五結算的週 K
+    規則與 app.resample_to_weekly 相同：first / max / min / last / sum，缺值的週剔除
+    """
+    daily = daily.copy()
+    daily['date'] = pd.to_datetime(daily['date'])
+    for c in ['open', 'high', 'low', 'close', 'volume']:
+        daily[c] = pd.to_numeric(daily[c], errors='coerce')
+    daily = daily.sort_values(['stock_id', 'date'])
+    # 往後推到當週週五 (週六、週日歸到下週五)
+    daily['week'] = daily['date'] + pd.to_timedelta((4 - daily['date'].dt.weekday) % 7, unit='D')
+
+    weekly = daily.groupby(['stock_id', 'week'], sort=True).agg(
+        open=('open', 'first'), high=('high', 'max'), low=('low', 'min'),
+        close=('close', 'last'), volume=('volume', 'sum'), last_trade_date=('date', 'max'),
+    ).dropna().reset_index()
+    return weekly.rename(columns={'week': 'date'})
+
+
+def update_weekly_ma(stock_ids=None, rebuild=False, refresh_snapshot=True):
+    """
+    增量維護 weekly_prices：每檔只重算「資料庫中最後一週 (可能尚未收完)」以及之後的新週，
+    週均線用前 19 根已存週收盤接續計算，最後一次批次寫入
+    參數:
+        stock_ids: 指定更新哪些股票，None 則更新全部
+        rebuild: True 時清空後全量重建
+        refresh_snapshot: 完成後是否順便刷新 latest_stock_snapshot
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+
+    print("\n🚀 開始更新週線 (weekly_prices)...")
+    started = datetime.now()
+    init_weekly_prices_table(cursor)
+    if rebuild:
+        cursor.execute("DELETE FROM weekly_prices" + (f" WHERE stock_id IN ({', '.join(['?'] * len(stock_ids))})" if stock_ids else ""),
+                       list(stock_ids) if stock_ids else [])
+
+    stock_filter = ""
+    params = []
+    if stock_ids:
+        stock_filter = f"WHERE s.stock_id IN ({', '.join(['?'] * len(stock_ids))})"
+        params = list(stock_ids)
+
+    # 1. 每檔最後一根已存週 K
+    cursor.execute("DROP TABLE IF EXISTS temp.weekly_start")
+    cursor.execute(f'''
+        CREATE TEMP TABLE weekly_start AS
+        SELECT s.stock_id,
+               (SELECT MAX(date) FROM weekly_prices w WHERE w.stock_id = s.stock_id) AS last_week
+        FROM stocks s
+        {stock_filter}
+    ''', params)
+
+    # 2. 只讀需要重算的日線 (最後一週的週六起；沒有週線的股票讀全部)
+    daily = pd.read_sql('''
+        SELECT d.stock_id, d.date, d.open, d.high, d.low, d.close, d.volume
+        FROM weekly_start ws
+        JOIN daily_prices d ON d.stock_id = ws.stock_id
+        WHERE ws.last_week IS NULL OR d.date >= date(ws.last_week, '-6 days')
+    ''', conn)
+
+    if daily.empty:
+        cursor.execute("DROP TABLE temp.weekly_start")
+        conn.commit()
+        if refresh_snapshot:
+            refresh_latest_stock_snapshot(conn, stock_ids)
+        conn.close()
+        print("✅ 週線已是最新")
+        return 0
+
+    weekly = build_weekly_bars(daily)
+
+    # 3. 接續均線需要的前 19 根週收盤 (重算區段之前)
+    prior = pd.read_sql('''
+        SELECT stock_id, date, close FROM (
+            SELECT w.stock_id, w.date, w.close,
+                   ROW_NUMBER() OVER (PARTITION BY w.stock_id ORDER BY w.date DESC) AS rn
+            FROM weekly_start ws
+            JOIN weekly_prices w ON w.stock_id = ws.stock_id AND w.date < ws.last_week
+        )
+        WHERE rn < ?
+    ''', conn, params=(max(WEEKLY_MA_WINDOWS),))
+    cursor.execute("DROP TABLE temp.weekly_start")
+
+    prior['date'] = pd.to_datetime(prior['date'])
+    prior['is_new'] = False
+    weekly['is_new'] = True
+    combined = pd.concat([prior, weekly], ignore_index=True).sort_values(['stock_id', 'date'])
+    closes = combined.groupby('stock_id')['close']
+    for w in WEEKLY_MA_WINDOWS:
+        combined[f'ma_{w}'] = closes.transform(lambda c, w=w: c.rolling(w).mean())
+    weekly = combined[combined['is_new']]
+
+    # 4. 批次寫入
+    rows = [
+        (r.stock_id, r.date.strftime('%Y-%m-%d'), r.open, r.high, r.low, r.close, int(r.volume),
+         None if pd.isna(r.ma_5) else r.ma_5, None if pd.isna(r.ma_20) else r.ma_20,
+         r.last_trade_date.strftime('%Y-%m-%d'))
+        for r in weekly.itertuples(index=False)
+    ]
+    cursor.executemany('''
+        INSERT OR REPLACE INTO weekly_prices
+        (stock_id, date, open, high, low, close, volume, ma_5, ma_20, last_trade_date)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', rows)
     conn.commit()
-    refresh_latest_stock_snapshot(conn)
+
+    if refresh_snapshot:
+        refresh_latest_stock_snapshot(conn, stock_ids)
     conn.close()
-    
-    print(f"\n🎉 週線均線更新完成！共更新 {updated}/{total} 檔股票")
+
+    elapsed = (datetime.now() - started).total_seconds()
+    print(f"🎉 週線更新完成！{weekly['stock_id'].nunique()} 檔 / {len(rows):,} 根週 K，耗時 {elapsed:.2f} 秒")
+    return len(rows)
 
 
 if __name__ == "__main__":
+    import sys
+    if '--verify' in sys.argv:
+        # 與逐檔計算結果比對
+        sys.exit(1 if verify_precomputed_metrics() else 0)
+
     # 執行預先計算
     update_precomputed_metrics()
-    update_weekly_ma()
+    # --rebuild-weekly: 清空 weekly_prices 全量重建
+    update_weekly_ma(rebuild='--rebuild-weekly' in sys.argv)
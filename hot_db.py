@@ -0,0 +1,199 @@
+# hot_db.py - 熱資料 / 冷資料分檔
+# 畫面第一屏只需要最新快照、大盤統計與策略設定，這些表另外發佈成很小的 stock_hot.db.xz；
+# 完整歷史 (stock_data.db.xz + deltas) 在背景執行緒還原，第一次看 K 線或相似股時才需要等它。
+#
+# 用法:
+#   python hot_db.py --export   由目前的 stock_data.db 匯出熱資料檔
+#   python hot_db.py            顯示熱資料檔資訊
+
+import sys
+import time
+import sqlite3
+import threading
+import database
+import xz_blocks
+import price_cube
+import chart_cache
+
+HOT_DB_PATH = database.PROJECT_DIR / "stock_hot.db"
+HOT_XZ_PATH = database.PROJECT_DIR / "stock_hot.db.xz"
+
+# 篩選器 / 家庭速覽 / 大盤健康度 / 策略清單 會用到的表
+HOT_TABLES = (
+    'stocks',
+    'latest_stock_snapshot',
+    'consolidation_breakpoints',
+    'market_stats',
+    'user_presets',
+    'watchlist',
+    'data_versions',
+)
+
+
+def export_hot_database(src_path=database.DB_NAME):
+    """把 HOT_TABLES (含索引) 複製成獨立的小資料庫並壓縮，回傳壓縮後大小"""
+    started = time.time()
+    tmp_path = HOT_DB_PATH.with_name(HOT_DB_PATH.name + '.export')
+    tmp_path.unlink(missing_ok=True)
+
+    conn = sqlite3.connect(tmp_path, isolation_level=None)
+    try:
+        conn.execute("ATTACH DATABASE ? AS src", (str(src_path),))
+        exported = []
+        # 同一個交易內複製，各表來自同一時間點 (更新程式同時在寫也不會拿到一半的資料)
+        conn.execute("BEGIN")
+        for table in HOT_TABLES:
+            row = conn.execute("SELECT sql FROM src.sqlite_master WHERE type='table' AND name=?", (table,)).fetchone()
+            if not row:
+                continue
+            conn.execute(row[0])
+            conn.execute(f"INSERT INTO main.{table} SELECT * FROM src.{table}")
+            for (index_sql,) in conn.execute(
+                    "SELECT sql FROM src.sqlite_master WHERE type='index' AND tbl_name=? AND sql IS NOT NULL",
+                    (table,)).fetchall():
+                conn.execute(index_sql)
+            exported.append(table)
+        conn.execute("COMMIT")
+        conn.execute("DETACH DATABASE src")
+        conn.execute("VACUUM")
+    finally:
+        conn.close()
+
+    _, size = xz_blocks.compress_file(tmp_path, HOT_XZ_PATH)
+    tmp_path.unlink(missing_ok=True)
+    print(f"🔥 熱資料檔：{len(exported)} 張表，stock_hot.db.xz {size / 1024:.0f} KB，耗時 {time.time() - started:.2f} 秒")
+    return size
+
+
+def ensure_hot_database():
+    """
+    完整資料庫已在本機就不需要熱資料檔；否則解壓 stock_hot.db.xz (壓縮檔較新才重新解壓)
+    兩者都沒有時拋出 FileNotFoundError
+    """
+    if database.DB_PATH.exists():
+        return
+    if HOT_XZ_PATH.exists():
+        if not HOT_DB_PATH.exists() or HOT_DB_PATH.stat().st_mtime < HOT_XZ_PATH.stat().st_mtime:
+            xz_blocks.decompress_file(HOT_XZ_PATH, HOT_DB_PATH)
+        return
+    if not database.DB_XZ_PATH.exists():
+        raise FileNotFoundError(f"找不到資料庫：{database.DB_PATH}、{HOT_XZ_PATH} 或 {database.DB_XZ_PATH}")
+
+
+# --- 冷資料 (完整歷史) 背景還原 ---
+_cold_lock = threading.Lock()
+_cold_thread = None
+_cold_done = threading.Event()
+_cold_error = None
+_cold_seconds = None
+
+
+def _restore_cold():
+    global _cold_error, _cold_seconds
+    started = time.time()
+    try:
+        database.ensure_database()
+        _cold_seconds = time.time() - started
+        print(f"🧊 完整歷史資料庫就緒，耗時 {_cold_seconds:.1f} 秒")
+    except Exception as e:
+        _cold_error = e
+        print(f"⚠️ 完整歷史資料庫還原失敗: {e}")
+    finally:
+        _cold_done.set()
+
+
+def start_cold_restore():
+    """在背景執行緒還原完整資料庫 (整個行程只會啟動一次)"""
+    global _cold_thread
+    with _cold_lock:
+        if _cold_thread is None:
+            _cold_thread = threading.Thread(target=_restore_cold, name="cold-restore", daemon=True)
+            _cold_thread.start()
+
+
+def cold_ready():
+    return _cold_done.is_set() and _cold_error is None
+
+
+def wait_for_cold(timeout=None):
+    """等候背景還原完成 (尚未啟動則先啟動)；還原失敗時拋出原本的例外"""
+    start_cold_restore()
+    _cold_done.wait(timeout)
+    if _cold_error is not None:
+        raise _cold_error
+    return _cold_done.is_set()
+
+
+def cold_status():
+    """(狀態, 還原秒數)：'ready' / 'loading' / 'failed'"""
+    if not _cold_done.is_set():
+        return 'loading', None
+    return ('failed' if _cold_error is not None else 'ready'), _cold_seconds
+
+
+# --- 本機衍生檔 (價格立方體 / 圖表快取) 不隨資料庫發佈，由 App 依資料版本在背景自行更新 ---
+_derived_lock = threading.Lock()
+_derived_thread = None
+_derived_token = None
+
+
+def _refresh_derived():
+    conn = database.get_connection(read_only=True)
+    try:
+        try:
+            price_cube.sync_price_cube(conn)
+        except Exception as e:
+            print(f"⚠️ 價格立方體同步失敗: {e}")
+        try:
+            chart_cache.prewarm(conn)
+        except Exception as e:
+            print(f"⚠️ 圖表快取預熱失敗: {e}")
+    finally:
+        conn.close()
+
+
+def schedule_derived_refresh(token):
+    """
+    完整資料庫就緒且 data_versions (token) 跟上次不同時，啟動背景執行緒更新衍生檔
+    同時只跑一條；正在跑的時候版本又變了，下次呼叫會再排一次
+    """
+    global _derived_thread, _derived_token
+    if token == _derived_token or not cold_ready():
+        return
+    with _derived_lock:
+        if token == _derived_token or (_derived_thread is not None and _derived_thread.is_alive()):
+            return
+        _derived_token = token
+        _derived_thread = threading.Thread(target=_refresh_derived, name="derived-refresh", daemon=True)
+        _derived_thread.start()
+
+
+def get_hot_connection():
+    """
+    熱資料讀取用：完整資料庫就緒後直接用它 (共用連線)，否則唯讀開啟 stock_hot.db
+    兩者都沒有 (例如只發佈了完整資料庫) 時等候背景還原
+    """
+    if cold_ready():
+        return database.get_connection(read_only=True, reuse=True)
+    if HOT_DB_PATH.exists() and not database.DB_PATH.exists():
+        return database._open_connection(read_only=True, path=HOT_DB_PATH)
+    wait_for_cold()
+    return database.get_connection(read_only=True, reuse=True)
+
+
+if __name__ == "__main__":
+    if '--export' in sys.argv:
+        export_hot_database()
+    if HOT_XZ_PATH.exists():
+        xz_blocks.decompress_file(HOT_XZ_PATH, HOT_DB_PATH)
+        conn = database._open_connection(read_only=True, path=HOT_DB_PATH)
+        for table in HOT_TABLES:
+            try:
+                count = conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+            except sqlite3.OperationalError:
+                count = '-'
+            print(f"   {table:<28}{count:>10}")
+        conn.close()
+        print(f"🔥 stock_hot.db.xz {HOT_XZ_PATH.stat().st_size / 1024:.0f} KB")
+    else:
+        print("⚠️ 尚未產生熱資料檔，請執行: python hot_db.py --export")
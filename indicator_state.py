@@ -0,0 +1,255 @@
+# indicator_state.py - 滾動指標增量狀態 (MA / 均量 / 高低點)
+# 每檔股票保存滾動和與視窗緩衝，每日更新只要套用新 K 棒，不必重讀 600 筆歷史
+# 盤整天數不在這裡：由 consolidation.refresh_consolidation 對有新 K 棒的股票整批計算
+#
+# 用法:
+#   python indicator_state.py --rebuild   從 daily_prices 全量重建狀態表
+#   python indicator_state.py --verify    比對狀態推導值與全量重算結果
+
+import sys
+import time
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import database
+
+CLOSE_BUFFER_SIZE = 500     # 2 年高低點需要 500 筆
+VOLUME_BUFFER_SIZE = 20     # 20 日均量
+MA_WINDOWS = (5, 20, 60)
+VOL_MA_WINDOWS = (5, 20)
+
+
+def init_indicator_state_table(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS indicator_state (
+            stock_id TEXT PRIMARY KEY,
+            last_date TEXT,
+            close_buf BLOB,        -- 最近 500 筆收盤 (float64, 舊 → 新)
+            volume_buf BLOB,       -- 最近 20 筆成交量
+            sum_5 REAL, sum_20 REAL, sum_60 REAL,
+            vol_sum_5 REAL, vol_sum_20 REAL,
+            updated_at TEXT
+        )
+    ''')
+
+
+def _window_sum(buf, window):
+    if len(buf) < window:
+        return None
+    return float(np.sum(buf[-window:]))
+
+
+def build_state(last_date, closes, volumes):
+    """由一段完整歷史 (舊 → 新) 建立狀態"""
+    closes = np.asarray(closes, dtype=np.float64)[-CLOSE_BUFFER_SIZE:]
+    volumes = np.asarray(volumes, dtype=np.float64)[-VOLUME_BUFFER_SIZE:]
+    state = {'last_date': last_date, 'closes': closes, 'volumes': volumes}
+    for w in MA_WINDOWS:
+        state[f'sum_{w}'] = _window_sum(closes, w)
+    for w in VOL_MA_WINDOWS:
+        state[f'vol_sum_{w}'] = _window_sum(volumes, w)
+    return state
+
+
+def _roll_sum(current, buf, window, new_value):
+    """
+    O(1) 更新滾動和：加上新值、扣掉滑出視窗的值
+    視窗內有 NaN 時改用切片重算，避免 NaN 永久污染累計值
+    """
+    n = len(buf)
+    if n < window:
+        return None
+    dropped = buf[-window - 1] if n > window else None
+    if current is None or np.isnan(current) or np.isnan(new_value) or (dropped is not None and np.isnan(dropped)):
+        return float(np.sum(buf[-window:]))
+    if dropped is None:
+        return float(np.sum(buf[-window:]))
+    return current + new_value - dropped
+
+
+def _append(buf, value, size):
+    buf = np.append(buf, value)
+    return buf[-size:] if len(buf) > size + 1 else buf
+
+
+def apply_new_bars(state, bars):
+    """
+    套用日期晚於 state['last_date'] 的新 K 棒，bars 為 [(date_str, close, volume), ...] (舊 → 新)
+    回傳每根新 K 棒的 (date_str, ma5, ma20, ma60, change_pct)，並就地更新 state
+    """
+    results = []
+    closes = state['closes']
+    volumes = state['volumes']
+    for date_str, close, volume in bars:
+        if state['last_date'] and date_str <= state['last_date']:
+            continue
+        close = float(close) if close is not None else np.nan
+        volume = float(volume) if volume is not None else np.nan
+        prev_close = closes[-1] if len(closes) else np.nan
+
+        # 先多保留一格，讓 _roll_sum 能看到滑出視窗的舊值
+        closes = _append(closes, close, CLOSE_BUFFER_SIZE)
+        volumes = _append(volumes, volume, VOLUME_BUFFER_SIZE)
+        for w in MA_WINDOWS:
+            state[f'sum_{w}'] = _roll_sum(state[f'sum_{w}'], closes, w, close)
+        for w in VOL_MA_WINDOWS:
+            state[f'vol_sum_{w}'] = _roll_sum(state[f'vol_sum_{w}'], volumes, w, volume)
+        closes = closes[-CLOSE_BUFFER_SIZE:]
+        volumes = volumes[-VOLUME_BUFFER_SIZE:]
+
+        mas = []
+        for w in MA_WINDOWS:
+            s = state[f'sum_{w}']
+            mas.append(s / w if s is not None and not np.isnan(s) else None)
+        change = (close / prev_close - 1) * 100 if prev_close and not np.isnan(prev_close) and not np.isnan(close) else 0
+        results.append((date_str, mas[0], mas[1], mas[2], change))
+        state['last_date'] = date_str
+
+    state['closes'] = closes
+    state['volumes'] = volumes
+    return results
+
+
+def summarize_state(state):
+    """由狀態推導 stocks 表需要的技術面欄位"""
+    closes = state['closes']
+    if not len(closes):
+        return None
+
+    vol_ma = {}
+    for w in VOL_MA_WINDOWS:
+        s = state[f'vol_sum_{w}']
+        vol_ma[w] = s / w if s is not None and not np.isnan(s) else 0
+
+    last_1y = closes[-250:]
+    year_high = np.nanmax(last_1y)
+    year_low = np.nanmin(last_1y)
+    return {
+        'vol_ma_5': vol_ma[5],
+        'vol_ma_20': vol_ma[20],
+        'year_high': year_high,
+        'year_low': year_low,
+        'year_high_2y': np.nanmax(closes),
+        'year_low_2y': np.nanmin(closes),
+        'close': closes[-1],
+    }
+
+
+def load_indicator_states(conn):
+    """一次讀回全部股票的狀態: {stock_id: state}"""
+    cursor = conn.cursor()
+    init_indicator_state_table(cursor)
+    cursor.execute('''
+        SELECT stock_id, last_date, close_buf, volume_buf,
+               sum_5, sum_20, sum_60, vol_sum_5, vol_sum_20
+        FROM indicator_state
+    ''')
+    states = {}
+    for row in cursor.fetchall():
+        states[row[0]] = {
+            'last_date': row[1],
+            'closes': np.frombuffer(row[2], dtype=np.float64).copy() if row[2] else np.empty(0),
+            'volumes': np.frombuffer(row[3], dtype=np.float64).copy() if row[3] else np.empty(0),
+            'sum_5': row[4], 'sum_20': row[5], 'sum_60': row[6],
+            'vol_sum_5': row[7], 'vol_sum_20': row[8],
+        }
+    return states
+
+
+def save_indicator_states(cursor, items):
+    """items: [(stock_id, state), ...]，批次寫回"""
+    now_str = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    cursor.executemany('''
+        INSERT OR REPLACE INTO indicator_state
+        (stock_id, last_date, close_buf, volume_buf, sum_5, sum_20, sum_60, vol_sum_5, vol_sum_20, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', [
+        (stock_id, state['last_date'],
+         np.ascontiguousarray(state['closes'], dtype=np.float64).tobytes(),
+         np.ascontiguousarray(state['volumes'], dtype=np.float64).tobytes(),
+         state['sum_5'], state['sum_20'], state['sum_60'],
+         state['vol_sum_5'], state['vol_sum_20'], now_str)
+        for stock_id, state in items
+    ])
+
+
+def rebuild_indicator_state(conn=None):
+    """全量重建：由 daily_prices 最近 500 筆重算每檔狀態 (驗證用或狀態毀損時使用)"""
+    from price_store import load_price_history_store
+
+    should_close = False
+    if conn is None:
+        conn = database.get_connection()
+        should_close = True
+
+    print("🔧 開始全量重建 indicator_state...")
+    started = time.time()
+    store = load_price_history_store(conn, days=CLOSE_BUFFER_SIZE)
+    store.report()
+
+    cursor = conn.cursor()
+    init_indicator_state_table(cursor)
+    cursor.execute("DELETE FROM indicator_state")
+
+    items = []
+    for stock_id in store.stock_ids:
+        dates, closes, volumes = store.get_arrays(stock_id)
+        last_date = pd.Timestamp(dates[-1]).strftime('%Y-%m-%d')
+        items.append((stock_id, build_state(last_date, closes, volumes)))
+    save_indicator_states(cursor, items)
+    conn.commit()
+
+    if should_close:
+        conn.close()
+    print(f"✅ indicator_state 重建完成，共 {len(items)} 檔，耗時 {time.time() - started:.1f} 秒")
+    return len(items)
+
+
+def verify_indicator_state(conn=None, tolerance=1e-6):
+    """比對狀態推導值與 daily_prices 全量重算值，回傳不一致的股票清單"""
+    from price_store import load_price_history_store
+
+    should_close = False
+    if conn is None:
+        conn = database.get_connection()
+        should_close = True
+
+    states = load_indicator_states(conn)
+    store = load_price_history_store(conn, days=CLOSE_BUFFER_SIZE)
+    if should_close:
+        conn.close()
+
+    mismatched = []
+    for stock_id, state in states.items():
+        arrays = store.get_arrays(stock_id)
+        if arrays is None:
+            mismatched.append((stock_id, 'daily_prices 無資料'))
+            continue
+        dates, closes, volumes = arrays
+        expected = summarize_state(build_state(None, closes, volumes))
+        actual = summarize_state(state)
+        for key, value in expected.items():
+            if not np.isclose(actual[key], value, rtol=tolerance, equal_nan=True):
+                mismatched.append((stock_id, key))
+                break
+        # 均線累計和也要跟直接加總一致
+        for w in MA_WINDOWS:
+            direct = _window_sum(closes, w)
+            if (direct is None) != (state[f'sum_{w}'] is None) or (
+                    direct is not None and not np.isclose(direct, state[f'sum_{w}'], rtol=tolerance, equal_nan=True)):
+                mismatched.append((stock_id, f'sum_{w}'))
+                break
+
+    print(f"🔍 驗證 {len(states)} 檔，{len(mismatched)} 檔不一致")
+    for stock_id, key in mismatched[:20]:
+        print(f"   ⚠️ {stock_id}: {key}")
+    return mismatched
+
+
+if __name__ == "__main__":
+    if '--rebuild' in sys.argv:
+        rebuild_indicator_state()
+    if '--verify' in sys.argv:
+        sys.exit(1 if verify_indicator_state() else 0)
+    if '--rebuild' not in sys.argv and '--verify' not in sys.argv:
+        print("使用方式: python indicator_state.py --rebuild | --verify")
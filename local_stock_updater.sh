@@ -25,12 +25,12 @@ fi
 echo "========================================" >> $LOG_FILE
 echo "📈 股價更新開始 | $(date '+%Y-%m-%d %H:%M:%S')" >> $LOG_FILE
 
-# 1. 解壓縮資料庫（如果有 .xz）
+# 1. 解壓縮資料庫（如果有 .xz），並套用 deltas/ 裡的每日差異檔
 echo "📦 解壓縮資料庫..." >> $LOG_FILE
 if [ -f "stock_data.db.xz" ]; then
-    # 🛡️ 保留 .xz 備份（用 -k 參數）
-    rm -f stock_data.db 2>/dev/null
-    xz -d -k stock_data.db.xz 2>> $LOG_FILE
+    # 🛡️ .xz 保留不動，只重建 stock_data.db
+    rm -f stock_data.db stock_data.db-wal stock_data.db-shm 2>/dev/null
+    "$PYTHON_BIN" -c "import database; database.ensure_database()" >> $LOG_FILE 2>&1
     if [ $? -eq 0 ]; then
         echo "✅ 解壓縮完成" >> $LOG_FILE
     else
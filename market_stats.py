@@ -0,0 +1,103 @@
+# market_stats.py - 大盤寬度統計 (每日創新低家數)
+# 以視窗函數一次算出每檔股票「當天往回 250 個交易日」的高低點 (時點正確，不用今天的 year_high/year_low)，
+# 再用單一 GROUP BY 寫入所有缺漏日期
+#
+# 用法:
+#   python market_stats.py                    補齊 2026-01-01 起缺漏的日期
+#   python market_stats.py --rebuild [起始日]  重算起始日之後的全部日期
+
+import sys
+import time
+from datetime import datetime
+import database
+
+DEFAULT_START_DATE = '2026-01-01'
+EXTREME_WINDOW = 250          # 與 stocks.year_high / year_low 相同：最近 250 筆收盤 (含當天)
+NEW_LOW_POSITION = 0.01       # 位階 <= 1% 視為創新低
+LOOKBACK_CALENDAR_DAYS = 400  # 起始日之前要多讀的日曆天數，確保第一天也有完整 250 個交易日
+
+
+def init_market_stats_table(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS market_stats (
+            date TEXT PRIMARY KEY,
+            new_low_count INTEGER,
+            updated_at TEXT
+        )
+    ''')
+
+
+def missing_dates(conn, start_date=DEFAULT_START_DATE):
+    """daily_prices 有、market_stats 還沒有的交易日 (上次更新中途失敗留下的破洞也會在這裡出現)"""
+    rows = conn.execute('''
+        SELECT DISTINCT date FROM daily_prices WHERE date >= ?
+        EXCEPT
+        SELECT date FROM market_stats
+    ''', (start_date,)).fetchall()
+    return sorted(row[0] for row in rows)
+
+
+def refresh_market_stats(conn=None, dates=None, start_date=DEFAULT_START_DATE, only_missing=True):
+    """
+    dates: 指定要重算的日期 (例如本次有新 K 棒的交易日)；None 則處理 start_date 之後的日期
+    only_missing: dates 為 None 時，是否只補 market_stats 尚未有的日期
+    回傳寫入的日期數
+    """
+    should_close = False
+    if conn is None:
+        conn = database.get_connection()
+        should_close = True
+
+    cursor = conn.cursor()
+    init_market_stats_table(cursor)
+
+    if dates is not None:
+        dates = sorted(d for d in dates if d >= start_date)
+        if not dates:
+            if should_close:
+                conn.close()
+            return 0
+        target_filter = f"date IN ({', '.join(['?'] * len(dates))})"
+        target_params = list(dates)
+        first_date = dates[0]
+    else:
+        target_filter = "date >= ?"
+        target_params = [start_date]
+        if only_missing:
+            target_filter += " AND date NOT IN (SELECT date FROM market_stats)"
+        first_date = start_date
+
+    started = time.time()
+    cursor.execute(f'''
+        INSERT OR REPLACE INTO market_stats (date, new_low_count, updated_at)
+        SELECT date,
+               SUM(CASE WHEN high_250 - low_250 > 0
+                         AND (close - low_250) / (high_250 - low_250) <= ? THEN 1 ELSE 0 END),
+               ?
+        FROM (
+            SELECT stock_id, date, close,
+                   MAX(close) OVER w AS high_250,
+                   MIN(close) OVER w AS low_250
+            FROM daily_prices
+            WHERE date >= date(?, ?)
+            WINDOW w AS (PARTITION BY stock_id ORDER BY date ROWS BETWEEN {EXTREME_WINDOW - 1} PRECEDING AND CURRENT ROW)
+        )
+        WHERE {target_filter}
+        GROUP BY date
+    ''', [NEW_LOW_POSITION, datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+          first_date, f'-{LOOKBACK_CALENDAR_DAYS} days'] + target_params)
+    written = cursor.rowcount
+    conn.commit()
+
+    if should_close:
+        conn.close()
+    print(f"📊 大盤統計寫入 {written} 天，耗時 {time.time() - started:.2f} 秒")
+    return written
+
+
+if __name__ == "__main__":
+    if '--rebuild' in sys.argv:
+        args = sys.argv[sys.argv.index('--rebuild') + 1:]
+        refresh_market_stats(start_date=args[0] if args else DEFAULT_START_DATE, only_missing=False)
+    else:
+        refresh_market_stats()
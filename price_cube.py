@@ -0,0 +1,292 @@
+# price_cube.py - 日 K 價格立方體 (股票 × 交易日 × 欄位，記憶體映射 .npy)
+# daily_prices 的第二份儲存格式：分析 / 繪圖直接切 memmap，多個行程與 Streamlit session 共用同一份 OS page cache，
+# 不必每次 pd.read_sql + pivot
+# 立方體不隨資料庫發佈：App 端還原 / 套用差異檔後依 data_versions 在背景自行建立、增量補齊 (見 sync_price_cube)
+#
+# 檔案:
+#   price_cube_v{版本}.npy     float32，shape = (股票數, 交易日容量, 欄位數)，缺值為 NaN
+#   price_cube_index.json      stock_id / 日期 → 位置，以及目前使用中的 .npy 檔名
+#
+# 用法:
+#   python price_cube.py --rebuild   由 daily_prices 全量重建
+#   python price_cube.py --sync      依 data_versions 補齊 (沒有立方體時全量重建)
+#   python price_cube.py             顯示目前立方體資訊
+
+import os
+import sys
+import json
+import time
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import database
+
+CUBE_DIR = database.PROJECT_DIR
+CUBE_INDEX_PATH = CUBE_DIR / "price_cube_index.json"
+CUBE_FIELDS = ('open', 'high', 'low', 'close', 'volume', 'ma_5', 'ma_20', 'ma_60')
+DATE_SLACK = 60     # 交易日軸預留的空格，每天新增的 K 棒直接寫進去，用完才整個重建
+REBUILD_CHUNK_STOCKS = 200
+
+
+class PriceCube:
+    """
+    data[i, j, k] = 第 i 檔股票、第 j 個交易日、第 k 個欄位
+    所有取值都是 memmap 的切片 (零複製)，請勿寫入
+    """
+
+    def __init__(self, data, stock_ids, dates, fields=CUBE_FIELDS, version=0):
+        self.data = data
+        self.stock_ids = stock_ids
+        self.dates = dates
+        self.fields = list(fields)
+        self.version = version
+        self._stock_index = {sid: i for i, sid in enumerate(stock_ids)}
+
+    def __len__(self):
+        return len(self.stock_ids)
+
+    def __contains__(self, stock_id):
+        return stock_id in self._stock_index
+
+    def field_index(self, field):
+        return self.fields.index(field)
+
+    def series(self, stock_id, field='close', days=None):
+        """單一股票單一欄位 (舊 → 新)，找不到則回傳 None"""
+        i = self._stock_index.get(stock_id)
+        if i is None:
+            return None
+        start = max(len(self.dates) - days, 0) if days else 0
+        return self.data[i, start:, self.field_index(field)]
+
+    def frame(self, stock_id, days=None):
+        """單一股票的 OHLCV + 均線 DataFrame (date 為 index，去掉沒有交易的日期)"""
+        i = self._stock_index.get(stock_id)
+        if i is None:
+            return pd.DataFrame()
+        start = max(len(self.dates) - days, 0) if days else 0
+        df = pd.DataFrame(self.data[i, start:, :], columns=self.fields,
+                          index=pd.DatetimeIndex(self.dates[start:], name='date'))
+        return df[df['close'].notna()]
+
+    def panel(self, field='close', days=None, stock_ids=None):
+        """橫斷面矩陣：index 為日期、columns 為 stock_id (等同 pivot 後的結果)"""
+        start = max(len(self.dates) - days, 0) if days else 0
+        values = self.data[:, start:, self.field_index(field)]
+        columns = self.stock_ids
+        if stock_ids is not None:
+            rows = [self._stock_index[sid] for sid in stock_ids if sid in self._stock_index]
+            values = values[rows]
+            columns = [self.stock_ids[r] for r in rows]
+        return pd.DataFrame(values.T, index=pd.DatetimeIndex(self.dates[start:], name='date'), columns=columns)
+
+
+def _read_index():
+    try:
+        with CUBE_INDEX_PATH.open('r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def _write_index(index):
+    # 先寫暫存檔再 rename，讀取端不會讀到寫一半的索引
+    tmp_path = CUBE_INDEX_PATH.with_suffix('.json.tmp')
+    with tmp_path.open('w', encoding='utf-8') as f:
+        json.dump(index, f, ensure_ascii=False)
+    os.replace(tmp_path, CUBE_INDEX_PATH)
+
+
+def _remove_old_cubes(keep_file):
+    # Linux 上已映射舊檔的讀取端不受影響，檔案會在最後一個映射關閉後才真正釋放
+    for path in CUBE_DIR.glob("price_cube_v*.npy"):
+        if path.name != keep_file:
+            try:
+                path.unlink()
+            except OSError:
+                pass
+
+
+def _fill_cube(cube, df, stock_ids, dates):
+    rows = pd.Index(stock_ids).get_indexer(df['stock_id'])
+    cols = pd.Index(dates).get_indexer(df['date'])
+    values = df[list(CUBE_FIELDS)].apply(pd.to_numeric, errors='coerce').to_numpy(dtype=np.float32)
+    cube[rows, cols, :] = values
+
+
+def rebuild_price_cube(conn=None):
+    """全量重建：分批讀出 daily_prices 寫成新版本的 .npy，再切換索引"""
+    should_close = False
+    if conn is None:
+        conn = database.get_connection()
+        should_close = True
+
+    started = time.time()
+    old_index = _read_index()
+    version = (old_index['version'] + 1) if old_index else 1
+    cube_file = f"price_cube_v{version}.npy"
+    try:
+        stock_ids = [row[0] for row in conn.execute("SELECT DISTINCT stock_id FROM daily_prices ORDER BY stock_id")]
+        dates = [row[0] for row in conn.execute("SELECT DISTINCT date FROM daily_prices ORDER BY date")]
+
+        shape = (len(stock_ids), len(dates) + DATE_SLACK, len(CUBE_FIELDS))
+        cube = np.lib.format.open_memmap(CUBE_DIR / cube_file, mode='w+', dtype=np.float32, shape=shape)
+        cube[:] = np.nan
+        # 每次只讀 REBUILD_CHUNK_STOCKS 檔，App 端重建時記憶體用量有上限
+        for i in range(0, len(stock_ids), REBUILD_CHUNK_STOCKS):
+            chunk = stock_ids[i:i + REBUILD_CHUNK_STOCKS]
+            df = pd.read_sql(f'''
+                SELECT stock_id, date, {', '.join(CUBE_FIELDS)} FROM daily_prices
+                WHERE stock_id IN ({', '.join(['?'] * len(chunk))})
+            ''', conn, params=chunk)
+            _fill_cube(cube, df, stock_ids, dates)
+        cube.flush()
+        del cube
+    finally:
+        if should_close:
+            conn.close()
+
+    _write_index({
+        'version': version,
+        'cube_file': cube_file,
+        'fields': list(CUBE_FIELDS),
+        'stock_ids': stock_ids,
+        'dates': dates,
+        'updated_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+    })
+    _remove_old_cubes(cube_file)
+    print(f"🧊 價格立方體重建：{shape[0]} 檔 × {len(dates)} 日 × {shape[2]} 欄 "
+          f"({(CUBE_DIR / cube_file).stat().st_size / 1024 / 1024:.1f} MB)，耗時 {time.time() - started:.2f} 秒")
+    return version
+
+
+def refresh_price_cube(conn=None, stock_ids=None, dates=None):
+    """
+    增量更新：把 stock_ids 在 dates (本次新 K 棒的交易日) 之後的資料寫進現有立方體
+    新日期用預留的空格接在後面；遇到新股票、日期插在中間、或空格用完時改為全量重建
+    """
+    index = _read_index()
+    if index is None or stock_ids is None or not dates or not (CUBE_DIR / index['cube_file']).exists() \
+            or list(index['fields']) != list(CUBE_FIELDS):
+        return rebuild_price_cube(conn)
+    if not stock_ids:
+        return index['version']
+
+    should_close = False
+    if conn is None:
+        conn = database.get_connection()
+        should_close = True
+
+    started = time.time()
+    stock_ids = sorted(stock_ids)
+    try:
+        df = pd.read_sql(f'''
+            SELECT stock_id, date, {', '.join(CUBE_FIELDS)} FROM daily_prices
+            WHERE stock_id IN ({', '.join(['?'] * len(stock_ids))}) AND date >= ?
+        ''', conn, params=stock_ids + [min(dates)])
+    finally:
+        if should_close:
+            conn.close()
+
+    known_stocks = set(index['stock_ids'])
+    cube_dates = index['dates']
+    new_dates = sorted(set(df['date']) - set(cube_dates))
+    cube = np.load(CUBE_DIR / index['cube_file'], mmap_mode='r+')
+    if (not set(df['stock_id']) <= known_stocks
+            or (new_dates and cube_dates and new_dates[0] <= cube_dates[-1])
+            or len(cube_dates) + len(new_dates) > cube.shape[1]):
+        del cube
+        return rebuild_price_cube(conn if not should_close else None)
+
+    cube_dates = cube_dates + new_dates
+    if len(df):
+        _fill_cube(cube, df, index['stock_ids'], cube_dates)
+    cube.flush()
+    del cube
+
+    # 資料先寫好再發布索引：讀取端只看得到索引裡的日期，新日期要等索引替換後才出現
+    index['dates'] = cube_dates
+    index['version'] += 1
+    index['updated_at'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    _write_index(index)
+    print(f"🧊 價格立方體增量更新：{len(stock_ids)} 檔、新增 {len(new_dates)} 個交易日，耗時 {time.time() - started:.2f} 秒")
+    return index['version']
+
+
+def sync_price_cube(conn=None):
+    """
+    讓立方體跟上目前的資料庫 (App 端還原 base / 套用差異檔之後呼叫)，回傳版本
+    data_versions 與上次同步時相同就不動；沒有立方體時全量重建，否則只補最後一個交易日之後的 K 棒
+    """
+    should_close = False
+    if conn is None:
+        conn = database.get_connection(read_only=True)
+        should_close = True
+
+    try:
+        token = [list(item) for item in database.get_data_versions_token(conn)]
+        index = _read_index()
+        if index is not None and index.get('data_versions') == token and (CUBE_DIR / index['cube_file']).exists():
+            return index['version']
+        if index is None or not index['dates']:
+            version = rebuild_price_cube(conn)
+        else:
+            stock_ids = [row[0] for row in conn.execute("SELECT stock_id FROM stocks")]
+            version = refresh_price_cube(conn, stock_ids=stock_ids, dates=[index['dates'][-1]])
+        index = _read_index()
+        index['data_versions'] = token
+        _write_index(index)
+        return version
+    finally:
+        if should_close:
+            conn.close()
+
+
+_cached_cube = None
+_cached_stamp = None
+
+
+def load_price_cube():
+    """
+    以唯讀 memmap 開啟目前的立方體；索引檔有變動 (mtime) 才重新開啟，否則沿用同一個物件
+    尚未建立時回傳 None
+    """
+    global _cached_cube, _cached_stamp
+    try:
+        stamp = CUBE_INDEX_PATH.stat().st_mtime_ns
+    except FileNotFoundError:
+        return None
+    if _cached_cube is not None and stamp == _cached_stamp:
+        return _cached_cube
+
+    index = _read_index()
+    if index is None:
+        return None
+    try:
+        data = np.load(CUBE_DIR / index['cube_file'], mmap_mode='r')
+    except FileNotFoundError:
+        return None
+
+    dates = pd.to_datetime(index['dates']).to_numpy(dtype='datetime64[ns]')
+    _cached_cube = PriceCube(
+        data=data[:len(index['stock_ids']), :len(dates), :],
+        stock_ids=index['stock_ids'],
+        dates=dates,
+        fields=index['fields'],
+        version=index['version'],
+    )
+    _cached_stamp = stamp
+    return _cached_cube
+
+
+if __name__ == "__main__":
+    if '--rebuild' in sys.argv:
+        rebuild_price_cube()
+    if '--sync' in sys.argv:
+        sync_price_cube()
+    cube = load_price_cube()
+    if cube is None:
+        print("⚠️ 尚未建立價格立方體，請執行: python price_cube.py --rebuild")
+    else:
+        print(f"🧊 價格立方體 v{cube.version}：{len(cube)} 檔 × {len(cube.dates)} 日 × {len(cube.fields)} 欄，"
+              f"{str(cube.dates[0])[:10]} ~ {str(cube.dates[-1])[:10]}")
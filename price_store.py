@@ -0,0 +1,121 @@
+# price_store.py - 全市場近期股價一次預載 (NumPy 欄式記憶體儲存)
+# 取代每檔股票各自開連線查 600 筆歷史，主迴圈改為直接切陣列
+
+import time
+import numpy as np
+import pandas as pd
+import database
+
+DEFAULT_HISTORY_DAYS = 600
+
+
+class PriceHistoryStore:
+    """
+    依 stock_id 排序後把全部股票的 (date, close, volume) 串成一條長陣列，
+    offsets[i]:offsets[i+1] 就是第 i 檔股票的區段 (日期由舊到新)。
+    """
+
+    def __init__(self, stock_ids, offsets, dates, close, volume, load_seconds=0.0):
+        self.stock_ids = stock_ids
+        self.offsets = offsets
+        self.dates = dates
+        self.close = close
+        self.volume = volume
+        self.load_seconds = load_seconds
+        self._index = {sid: i for i, sid in enumerate(stock_ids)}
+
+    def __len__(self):
+        return len(self.stock_ids)
+
+    def __contains__(self, stock_id):
+        return stock_id in self._index
+
+    @property
+    def nbytes(self):
+        return self.offsets.nbytes + self.dates.nbytes + self.close.nbytes + self.volume.nbytes
+
+    def get_slice(self, stock_id):
+        i = self._index.get(stock_id)
+        if i is None:
+            return None
+        return slice(self.offsets[i], self.offsets[i + 1])
+
+    def get_arrays(self, stock_id):
+        """回傳 (dates, close, volume) 的唯讀切片，找不到則回傳 None"""
+        sl = self.get_slice(stock_id)
+        if sl is None:
+            return None
+        return self.dates[sl], self.close[sl], self.volume[sl]
+
+    def get_frame(self, stock_id):
+        """與 fetch_data.get_db_history_data 相同格式：date 為 index，欄位 close / volume"""
+        arrays = self.get_arrays(stock_id)
+        if arrays is None:
+            return pd.DataFrame()
+        dates, close, volume = arrays
+        df = pd.DataFrame({'close': close, 'volume': volume}, index=pd.DatetimeIndex(dates, name='date'))
+        return df
+
+    def report(self):
+        rows = len(self.close)
+        print(f"📚 股價預載：{len(self)} 檔 / {rows:,} 筆，"
+              f"記憶體 {self.nbytes / 1024 / 1024:.1f} MB，耗時 {self.load_seconds:.2f} 秒")
+
+
+def load_price_history_store(conn=None, days=DEFAULT_HISTORY_DAYS, stock_ids=None):
+    """
+    一次查詢讀出每檔股票最近 days 筆 (date, close, volume)
+    stock_ids 有指定時只讀這些股票
+    """
+    should_close = False
+    if conn is None:
+        conn = database.get_connection()
+        should_close = True
+
+    stock_filter = ""
+    params = []
+    if stock_ids is not None:
+        stock_filter = f"WHERE stock_id IN ({', '.join(['?'] * len(stock_ids))})"
+        params = list(stock_ids)
+
+    started = time.time()
+    try:
+        df = pd.read_sql(f'''
+            SELECT stock_id, date, close, volume
+            FROM (
+                SELECT stock_id, date, close, volume,
+                       ROW_NUMBER() OVER (PARTITION BY stock_id ORDER BY date DESC) AS rn
+                FROM daily_prices
+                {stock_filter}
+            )
+            WHERE rn <= ?
+            ORDER BY stock_id, date
+        ''', conn, params=params + [days])
+    finally:
+        if should_close:
+            conn.close()
+
+    stock_col = df['stock_id'].to_numpy()
+    if len(stock_col):
+        # 已依 stock_id 排序：找出每段的起點
+        starts = np.flatnonzero(np.r_[True, stock_col[1:] != stock_col[:-1]])
+        stock_ids = stock_col[starts].tolist()
+        offsets = np.append(starts, len(stock_col)).astype(np.int64)
+    else:
+        stock_ids = []
+        offsets = np.zeros(1, dtype=np.int64)
+
+    store = PriceHistoryStore(
+        stock_ids=stock_ids,
+        offsets=offsets,
+        dates=pd.to_datetime(df['date']).to_numpy(dtype='datetime64[ns]'),
+        close=pd.to_numeric(df['close'], errors='coerce').to_numpy(dtype=np.float64),
+        volume=pd.to_numeric(df['volume'], errors='coerce').to_numpy(dtype=np.float64),
+        load_seconds=time.time() - started,
+    )
+    return store
+
+
+if __name__ == "__main__":
+    store = load_price_history_store()
+    store.report()
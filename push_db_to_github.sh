@@ -41,13 +41,24 @@ else
 fi
 
 cp "$DB_XZ_FILE" "$PUSH_REPO_DIR/stock_data.db.xz"
+# 熱資料檔 (App 啟動時先讀)
+if [ -f "$PROJECT_DIR/stock_hot.db.xz" ]; then
+    cp "$PROJECT_DIR/stock_hot.db.xz" "$PUSH_REPO_DIR/stock_hot.db.xz"
+fi
+# 每日差異檔：整個目錄同步 (發佈新 base 時舊差異檔會被刪除)
+rm -rf "$PUSH_REPO_DIR/deltas"
+if [ -d "$PROJECT_DIR/deltas" ]; then
+    cp -r "$PROJECT_DIR/deltas" "$PUSH_REPO_DIR/deltas"
+fi
 
-if git -C "$PUSH_REPO_DIR" diff --quiet -- stock_data.db.xz; then
-    echo "ℹ️ stock_data.db.xz 沒有變更，不需要推送" >> "$LOG_FILE"
+git -C "$PUSH_REPO_DIR" add -A stock_data.db.xz
+git -C "$PUSH_REPO_DIR" add -A stock_hot.db.xz 2>/dev/null
+git -C "$PUSH_REPO_DIR" add -A deltas 2>/dev/null
+if git -C "$PUSH_REPO_DIR" diff --cached --quiet; then
+    echo "ℹ️ stock_data.db.xz / stock_hot.db.xz / deltas 沒有變更，不需要推送" >> "$LOG_FILE"
     exit 0
 fi
 
-git -C "$PUSH_REPO_DIR" add stock_data.db.xz
 git -C "$PUSH_REPO_DIR" commit -m "📈 本地更新資料庫: $(date '+%Y-%m-%d %H:%M')" >> "$LOG_FILE" 2>&1
 if [ $? -ne 0 ]; then
     echo "ℹ️ 沒有可提交的資料庫變更" >> "$LOG_FILE"
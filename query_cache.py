@@ -0,0 +1,89 @@
+# query_cache.py - 行程內共用的 LRU 查詢快取 (Streamlit 所有 session 共用同一個 Python 行程)
+# key 由呼叫端組成 (通常是 正規化後的參數 + 資料版本)，資料版本一變舊 key 就不會再被命中，
+# 自然被 LRU 擠掉，不需要另外清除。命中率 / 延遲統計給 App 的除錯面板使用。
+
+import time
+import threading
+from collections import OrderedDict
+
+
+def freeze(value):
+    """把 dict / list / set 轉成可雜湊且與順序無關的 tuple (dict 依 key 排序、None 值略過)"""
+    if isinstance(value, dict):
+        return tuple(sorted((k, freeze(v)) for k, v in value.items() if v is not None))
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(v) for v in value)
+    if isinstance(value, (set, frozenset)):
+        return tuple(sorted(freeze(v) for v in value))
+    return value
+
+
+class LRUCache:
+    def __init__(self, name, max_entries=64):
+        self.name = name
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.hit_seconds = 0.0
+        self.miss_seconds = 0.0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get_or_compute(self, key, compute):
+        """命中就回傳快取值；否則呼叫 compute() 存入 (計算在鎖外進行，同 key 併發時可能重複計算一次)"""
+        started = time.perf_counter()
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                value = self._data[key]
+                self.hits += 1
+                self.hit_seconds += time.perf_counter() - started
+                return value
+
+        value = compute()
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+            self.misses += 1
+            self.miss_seconds += time.perf_counter() - started
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'name': self.name,
+            'entries': len(self._data),
+            'max_entries': self.max_entries,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'avg_hit_ms': self.hit_seconds * 1000 / self.hits if self.hits else 0.0,
+            'avg_miss_ms': self.miss_seconds * 1000 / self.misses if self.misses else 0.0,
+        }
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache(name, max_entries=64):
+    """依名稱取得共用快取 (第一次呼叫時建立)"""
+    with _caches_lock:
+        if name not in _caches:
+            _caches[name] = LRUCache(name, max_entries)
+        return _caches[name]
+
+
+def all_stats():
+    with _caches_lock:
+        caches = list(_caches.values())
+    return [cache.stats() for cache in caches]
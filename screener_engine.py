@@ -0,0 +1,271 @@
+# screener_engine.py - 記憶體內的向量化選股引擎
+# latest_stock_snapshot 每個資料版本只讀一次，轉成「欄位 → NumPy 陣列」；
+# 之後每次調整篩選條件都只是幾個布林遮罩 AND 起來，不必重組 SQL、也不必再查資料庫。
+# 篩選語意與 app.query_data 的 SQL 相同 (NULL / NaN 比較一律不成立)。
+# 篩選畫面的選項都是固定的桶 (例如 PE 20 倍以下)，載入時就為每個桶、每個產業建好 bitmap
+# (每檔股票 1 bit，打包成 uint64)，一次查詢只是幾個 bitwise AND；所有策略也能一次算完。
+
+import time
+import numpy as np
+import pandas as pd
+
+# App 顯示用的欄位 (與 app.query_data 的 SELECT 相同順序；year_high / year_low 依 period 取 1 年或 2 年)
+OUTPUT_COLUMNS = (
+    'stock_id', 'name', 'industry', 'market_type',
+    'pe_ratio', 'yield_rate', 'pb_ratio', 'eps', 'beta', 'market_cap',
+    'revenue_growth', 'revenue_streak', 'capital', 'vol_ma_5', 'vol_ma_20',
+    'eps_growth', 'gross_margin',
+    'operating_margin', 'pretax_margin', 'net_margin', 'consolidation_days', 'consolidation_days_20',
+    'position_1y', 'position_2y', 'bias_20', 'bias_60', 'vol_spike', 'consolidation_log',
+    'year_high', 'year_low',
+    'date', 'close', 'change_pct', 'volume', 'ma_5', 'ma_20', 'ma_60',
+)
+TEXT_COLUMNS = ('stock_id', 'name', 'industry', 'market_type', 'consolidation_log', 'date')
+
+# (欄位, 下限 key, 上限 key)：SQL 與向量化兩條路徑共用
+NUMERIC_FILTERS = (
+    ('pe_ratio', 'pe_min', 'pe_max'),
+    ('yield_rate', 'yield_min', 'yield_max'),
+    ('pb_ratio', 'pb_min', 'pb_max'),
+    ('eps', 'eps_min', 'eps_max'),
+    ('beta', 'beta_min', 'beta_max'),
+    ('revenue_growth', 'rev_min', 'rev_max'),
+    ('capital', 'cap_min', 'cap_max'),
+    ('gross_margin', 'gross_min', 'gross_max'),
+    ('close', 'price_min', 'price_max'),
+    ('change_pct', 'change_min', 'change_max'),
+    ('volume', 'vol_min', 'vol_max'),
+    ('vol_ma_5', 'vol_ma_min', 'vol_ma_max'),
+    ('vol_ma_20', 'vol_ma20_min', 'vol_ma20_max'),
+    ('eps_growth', 'eps_growth_min', 'eps_growth_max'),
+)
+# 舊資料庫沒有快照時這些欄位來自 daily_prices
+PRICE_COLUMNS = ('date', 'close', 'change_pct', 'volume', 'ma_5', 'ma_20', 'ma_60')
+
+FINANCIAL_CLIP_RANGES = {
+    'revenue_growth': (-100, 300),
+    'eps_growth': (-300, 300),
+    'gross_margin': (-100, 100),
+    'operating_margin': (-100, 100),
+    'pretax_margin': (-100, 100),
+    'net_margin': (-100, 100),
+}
+
+
+def clip_financial_outliers(df):
+    for col, (lower, upper) in FINANCIAL_CLIP_RANGES.items():
+        if col in df.columns:
+            df[col] = pd.to_numeric(df[col], errors='coerce').clip(lower, upper)
+    return df
+
+
+def pack_bits(mask):
+    """布林陣列 → uint64 bitset (不足 64 的尾端補 0)"""
+    packed = np.packbits(mask, bitorder='little')
+    return np.pad(packed, (0, -len(packed) % 8)).view(np.uint64)
+
+
+def unpack_bits(bits, size):
+    return np.unpackbits(bits.view(np.uint8), count=size, bitorder='little').astype(bool)
+
+
+def popcount(bits):
+    """bitset (最後一維) 的 1 的個數"""
+    return np.unpackbits(bits.view(np.uint8), axis=-1).sum(axis=-1)
+
+
+def position_column(period):
+    if period == '2y':
+        return 'position_2y'
+    if period in ('1y', None):
+        return 'position_1y'
+    return f'position_{period}'
+
+
+class ScreenerEngine:
+    """
+    snapshot: latest_stock_snapshot (含 year_high_2y / year_low_2y) 的 DataFrame
+    breakpoints: consolidation_breakpoints (stock_id, threshold, days)，沒有這張表時為 None
+    buckets: (區間桶 [(欄位, 下限, 上限)], 盤整桶 [(天數, 門檻)])，預先建好 bitmap
+    """
+
+    def __init__(self, snapshot, breakpoints=None, version=None, buckets=None):
+        self.version = version
+        snapshot = snapshot.reset_index(drop=True)
+        self.size = len(snapshot)
+        self.stock_ids = snapshot['stock_id'].astype(str).to_numpy()
+
+        # 篩選用的原始數值 (裁切前)，全部轉成 float64，NULL → NaN
+        numeric = [c for c in snapshot.columns if c not in TEXT_COLUMNS]
+        self.columns = {c: pd.to_numeric(snapshot[c], errors='coerce').to_numpy(dtype=np.float64) for c in numeric}
+
+        industry = pd.Categorical(snapshot['industry'])
+        self.industry_codes = industry.codes
+        self.industry_index = {name: code for code, name in enumerate(industry.categories)}
+        self.search_keys = (snapshot['stock_id'].astype(str) + ' ' + snapshot['name'].fillna('').astype(str)).to_numpy(dtype=str)
+
+        # 輸出用的 DataFrame：1 年 / 2 年高低點各準備一份，篩選時只做列選取
+        self.frames = {}
+        for period, (high, low) in {'1y': ('year_high', 'year_low'), '2y': ('year_high_2y', 'year_low_2y')}.items():
+            frame = snapshot.copy()
+            frame['year_high'] = snapshot[high] if high in snapshot else np.nan
+            frame['year_low'] = snapshot[low] if low in snapshot else np.nan
+            self.frames[period] = clip_financial_outliers(frame[[c for c in OUTPUT_COLUMNS if c in frame.columns]])
+
+        self.breakpoints = None
+        if breakpoints is not None and len(breakpoints):
+            rows = pd.Index(self.stock_ids).get_indexer(breakpoints['stock_id'].astype(str))
+            keep = rows >= 0
+            self.breakpoints = (
+                rows[keep],
+                pd.to_numeric(breakpoints['threshold'], errors='coerce').to_numpy(dtype=np.float64)[keep],
+                pd.to_numeric(breakpoints['days'], errors='coerce').to_numpy(dtype=np.float64)[keep],
+            )
+        self._positions = {}
+
+        self.all_bits = pack_bits(np.ones(self.size, dtype=bool))
+        self.industry_bits = {name: pack_bits(self.industry_codes == code) for name, code in self.industry_index.items()}
+        self.bitmaps = {}
+        if buckets:
+            self.build_bitmaps(*buckets)
+
+    def build_bitmaps(self, ranges=(), consolidation=()):
+        started = time.perf_counter()
+        for column, low, high in ranges:
+            if (low is not None or high is not None) and column in self.columns:
+                self.bitmaps[(column, low, high)] = pack_bits(self._range_mask(self.columns[column], low, high))
+        for days, threshold in consolidation:
+            self.bitmaps[('consolidation', days, threshold)] = pack_bits(self._consolidation_mask(days, threshold))
+        return time.perf_counter() - started
+
+    def __len__(self):
+        return self.size
+
+    def _range_mask(self, values, low, high):
+        mask = np.ones(self.size, dtype=bool)
+        if low is not None:
+            mask &= values >= low
+        if high is not None:
+            mask &= values <= high
+        return mask
+
+    def _index_position(self, period, position_lookup):
+        # 其他回看區間的位階：同一個引擎 (同一資料版本) 每個 period 只查一次
+        if period not in self._positions:
+            mapping = position_lookup(period) if position_lookup else {}
+            self._positions[period] = pd.Series(mapping, dtype=np.float64).reindex(self.stock_ids).to_numpy()
+        return self._positions[period]
+
+    def _consolidation_mask(self, days, threshold):
+        if threshold == 0.1:
+            return self.columns['consolidation_days'] >= days
+        if threshold == 0.2:
+            return self.columns['consolidation_days_20'] >= days
+        if self.breakpoints is None:
+            # 舊資料庫還沒有斷點表：退回最接近的固定門檻欄位
+            return self.columns['consolidation_days' if threshold <= 0.15 else 'consolidation_days_20'] >= days
+        # 門檻 <= X 的斷點中，取每檔最長天數
+        rows, thresholds, bp_days = self.breakpoints
+        usable = thresholds <= threshold
+        best = np.zeros(self.size, dtype=np.float64)
+        np.maximum.at(best, rows[usable], bp_days[usable])
+        return best >= days
+
+    def _range_bits(self, column, low, high, values=None):
+        # 預先建好的桶直接取用；自訂數值才即時計算
+        bits = self.bitmaps.get((column, low, high))
+        if bits is None:
+            bits = pack_bits(self._range_mask(self.columns[column] if values is None else values, low, high))
+            if values is not None:
+                # 索引位階 (3m / 6m ...) 同一版本內不會變，算過就留著
+                self.bitmaps[(column, low, high)] = bits
+        return bits
+
+    def predicate_bits(self, filters, position_lookup=None):
+        """filters 裡每個條件各一個 bitset (沒有條件時為空 list)，以及 額外位階欄位 (名稱, 值) 或 None"""
+        bits = []
+
+        industries = filters.get('industry')
+        if industries and "全部" not in industries:
+            selected = [self.industry_bits[i] for i in industries if i in self.industry_bits]
+            bits.append(np.bitwise_or.reduce(selected) if selected else np.zeros_like(self.all_bits))
+
+        for col, low_key, high_key in NUMERIC_FILTERS:
+            low, high = filters.get(low_key), filters.get(high_key)
+            if (low is not None or high is not None) and col in self.columns:
+                bits.append(self._range_bits(col, low, high))
+
+        if filters.get('streak_min') is not None:
+            bits.append(self._range_bits('revenue_streak', filters['streak_min'], None))
+
+        period = filters.get('period', '1y')
+        extra = None
+        positions = None
+        if period not in ('1y', '2y'):
+            positions = self._index_position(period, position_lookup)
+            extra = (position_column(period), positions)
+        if filters.get('pos_min') is not None or filters.get('pos_max') is not None:
+            bits.append(self._range_bits(position_column(period), filters.get('pos_min'), filters.get('pos_max'), positions))
+
+        if filters.get('consolidation_days') is not None:
+            days, threshold = filters['consolidation_days']
+            cached = self.bitmaps.get(('consolidation', days, threshold))
+            bits.append(cached if cached is not None else pack_bits(self._consolidation_mask(days, threshold)))
+
+        if filters.get('vol_spike_min'):
+            bits.append(self._range_bits('vol_spike', filters['vol_spike_min'], None))
+
+        if filters.get('search'):
+            bits.append(pack_bits(np.char.find(self.search_keys, filters['search']) >= 0))
+        return bits, extra
+
+    def mask(self, filters, position_lookup=None):
+        """回傳 (布林遮罩, 額外位階欄位名稱與值 或 None)"""
+        bits, extra = self.predicate_bits(filters, position_lookup)
+        combined = np.bitwise_and.reduce(bits) if bits else self.all_bits
+        return unpack_bits(combined, self.size), extra
+
+    def count_strategies(self, filters_by_name, position_lookup=None):
+        """
+        一次算出多個策略各自符合幾檔：{名稱: 檔數}
+        所有策略的 bitset 疊成 (策略數, 條件數, words) 的陣列，沿條件軸 AND 後再 popcount
+        """
+        if not filters_by_name:
+            return {}
+        names = list(filters_by_name)
+        predicates = [self.predicate_bits(filters_by_name[name], position_lookup)[0] for name in names]
+        depth = max(1, max(len(p) for p in predicates))
+        stack = np.empty((len(names), depth, len(self.all_bits)), dtype=np.uint64)
+        stack[:] = self.all_bits
+        for i, bits in enumerate(predicates):
+            if bits:
+                stack[i, :len(bits)] = bits
+        counts = popcount(np.bitwise_and.reduce(stack, axis=1))
+        return dict(zip(names, counts.tolist()))
+
+    def screen(self, filters, position_lookup=None):
+        """
+        依 filters (與 app.load_data 相同的 dict) 篩選，回傳新的 DataFrame
+        position_lookup(period) → {stock_id: 位階}，period 不是 1y / 2y 時才會呼叫
+        """
+        mask, extra = self.mask(filters, position_lookup)
+        frame = self.frames['2y' if filters.get('period') == '2y' else '1y']
+        df = frame[mask].reset_index(drop=True)
+        if extra is not None:
+            df[extra[0]] = extra[1][mask]
+        return df
+
+
+def load_screener_engine(conn, version=None, buckets=None):
+    """由 latest_stock_snapshot 建立引擎 (含各桶 bitmap)；舊資料庫沒有快照表時回傳 None"""
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='latest_stock_snapshot'").fetchone():
+        return None
+    started = time.time()
+    snapshot = pd.read_sql("SELECT * FROM latest_stock_snapshot", conn)
+    try:
+        breakpoints = pd.read_sql("SELECT stock_id, threshold, days FROM consolidation_breakpoints", conn)
+    except Exception:
+        breakpoints = None
+    engine = ScreenerEngine(snapshot, breakpoints, version, buckets)
+    print(f"⚡ 選股引擎載入：{len(engine)} 檔、{len(engine.bitmaps)} 個 bitmap，耗時 {time.time() - started:.2f} 秒")
+    return engine
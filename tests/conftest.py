@@ -0,0 +1,5 @@
+# 測試直接 import 專案根目錄下的模組 (專案是平鋪的單層模組，沒有套件)
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
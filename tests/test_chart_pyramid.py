@@ -0,0 +1,47 @@
+# 圖表金字塔：LTTB 降採樣與各層級 K 棒
+import numpy as np
+import pandas as pd
+import pytest
+import chart_pyramid
+
+
+@pytest.mark.parametrize('n, threshold', [(1000, 100), (1000, 3), (101, 100), (50, 49)])
+def test_lttb_keeps_endpoints_and_size(n, threshold):
+    rng = np.random.default_rng(n + threshold)
+    x = np.arange(n, dtype=np.float64)
+    y = np.cumsum(rng.normal(0, 1, n))
+    keep = chart_pyramid.lttb_indices(x, y, threshold)
+
+    assert len(keep) == threshold
+    assert keep[0] == 0 and keep[-1] == n - 1
+    assert (np.diff(keep) > 0).all()
+
+
+@pytest.mark.parametrize('threshold', [2, 0, 10, 20])
+def test_lttb_returns_everything_when_not_reducing(threshold):
+    x = np.arange(10, dtype=np.float64)
+    np.testing.assert_array_equal(chart_pyramid.lttb_indices(x, x ** 2, threshold), np.arange(10))
+
+
+def test_lttb_keeps_extreme_spike():
+    n = 500
+    y = np.zeros(n)
+    y[321] = 100.0
+    keep = chart_pyramid.lttb_indices(np.arange(n, dtype=np.float64), y, 50)
+    assert 321 in keep
+
+
+def test_build_pyramid_levels():
+    dates = pd.bdate_range('2020-01-01', periods=800)
+    close = np.linspace(10, 50, len(dates))
+    daily = pd.DataFrame({'date': dates, 'open': close, 'high': close + 1, 'low': close - 1,
+                          'close': close, 'volume': np.full(len(dates), 1000.0)})
+    pyramid = chart_pyramid.build_pyramid(daily)
+
+    assert set(pyramid) == {'日線', '週線', '月線', '總覽'}
+    assert len(pyramid['日線']) == min(chart_pyramid.DAILY_BARS, len(daily))
+    assert pyramid['日線']['date'].iloc[-1] == dates[-1]
+    assert len(pyramid['總覽']) == min(chart_pyramid.OVERVIEW_POINTS, len(daily))
+    assert pyramid['總覽']['date'].iloc[0] == dates[0] and pyramid['總覽']['date'].iloc[-1] == dates[-1]
+    assert (pyramid['週線']['date'].dt.weekday == 4).all()
+    assert chart_pyramid.build_pyramid(daily.iloc[:0]) == {}
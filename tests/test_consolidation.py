@@ -0,0 +1,73 @@
+# consolidation 矩陣版本 / 斷點查表 → 必須與逐筆迴圈版本一致
+import numpy as np
+import pytest
+import consolidation
+from price_store import PriceHistoryStore
+
+THRESHOLDS = (0.02, 0.05, 0.10, 0.15, 0.20, 0.30)
+
+
+def _loop_days(closes, threshold):
+    # 原始逐筆迴圈寫法 (與 verify_consolidation 相同)
+    if len(closes) < consolidation.MIN_HISTORY:
+        return 0
+    current = closes[-1]
+    days = 0
+    for price in closes[:-1][-consolidation.CONSOLIDATION_LOOKBACK:][::-1]:
+        if abs(price - current) / current <= threshold:
+            days += 1
+        else:
+            break
+    return days
+
+
+def _store(series):
+    stock_ids = list(series)
+    lengths = [len(series[s]) for s in stock_ids]
+    offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    close = np.concatenate([series[s] for s in stock_ids]).astype(np.float64)
+    dates = np.zeros(len(close), dtype='datetime64[D]')
+    return PriceHistoryStore(stock_ids, offsets, dates, close, np.ones_like(close))
+
+
+@pytest.fixture
+def series():
+    rng = np.random.default_rng(42)
+    return {
+        'trend': 100 * np.cumprod(1 + rng.normal(0.001, 0.02, 450)),   # 超過 400 天回看上限
+        'flat': 50 + rng.normal(0, 0.3, 120),
+        'jump': np.concatenate([np.full(30, 10.0), np.full(20, 20.0)]),
+        'short': np.array([10.0, 10.1, 10.2, 10.0]),                  # 不足 5 筆
+        'exact': np.array([10.0, 11.0, 9.0, 10.5, 10.0, 10.0]),       # 偏離剛好落在門檻上
+    }
+
+
+def test_compute_consolidation_matches_loop(series):
+    days, _ = consolidation.compute_consolidation(_store(series), THRESHOLDS)
+    for i, (sid, closes) in enumerate(series.items()):
+        for t in THRESHOLDS:
+            assert days[t][i] == _loop_days(closes, t), (sid, t)
+
+
+def test_breakpoints_lookup_matches_loop(series):
+    _, breakpoints = consolidation.compute_consolidation(_store(series), THRESHOLDS)
+    for sid, closes in series.items():
+        points = [(t, d) for s, t, d in breakpoints if s == sid]
+        for t in THRESHOLDS + (0.0, 0.07, 1.0):
+            from_table = max([d for bt, d in points if bt <= t], default=0)
+            assert from_table == _loop_days(closes, t), (sid, t)
+
+
+def test_consolidation_days_single_series_matches_loop(series):
+    for closes in series.values():
+        for t in THRESHOLDS:
+            assert consolidation.consolidation_days(closes, t) == _loop_days(closes, t)
+
+
+def test_running_max_deviation_invalid_values_break_the_run():
+    current = np.array([10.0, 0.0])
+    past = np.array([[10.5, np.nan, 10.0], [1.0, 1.0, 1.0]])
+    max_dev = consolidation.running_max_deviation(current, past)
+    np.testing.assert_allclose(max_dev[0, :1], [0.05])
+    assert np.isinf(max_dev[0, 1:]).all()
+    assert np.isinf(max_dev[1]).all()
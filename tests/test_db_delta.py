@@ -0,0 +1,83 @@
+# 差異檔：發佈端 export_delta → 套用端 apply_delta 後資料要與發佈端相同，重複套用結果不變
+import shutil
+import sqlite3
+import pytest
+import db_delta
+
+TABLES = ('stocks', 'daily_prices', 'consolidation_breakpoints')
+
+
+def _dump(path):
+    conn = sqlite3.connect(path)
+    try:
+        return {t: sorted(conn.execute(f"SELECT * FROM {t}").fetchall()) for t in TABLES}
+    finally:
+        conn.close()
+
+
+@pytest.fixture
+def publisher(tmp_path, monkeypatch):
+    monkeypatch.setattr(db_delta, 'DELTA_DIR', tmp_path / 'deltas')
+    monkeypatch.setattr(db_delta, 'MANIFEST_PATH', tmp_path / 'deltas' / 'manifest.json')
+
+    pub_path, sub_path = tmp_path / 'pub.db', tmp_path / 'sub.db'
+    conn = sqlite3.connect(pub_path, isolation_level=None)
+    conn.executescript('''
+        CREATE TABLE stocks (stock_id TEXT PRIMARY KEY, name TEXT, pe_ratio REAL);
+        CREATE TABLE daily_prices (stock_id TEXT, date TEXT, close REAL, PRIMARY KEY (stock_id, date));
+        CREATE TABLE consolidation_breakpoints (stock_id TEXT, threshold REAL, days INTEGER, PRIMARY KEY (stock_id, threshold));
+        INSERT INTO stocks VALUES ('2330', '台積電', 20.0), ('1101', '台泥', 12.0);
+        INSERT INTO daily_prices VALUES ('2330', '2023-12-01', 560), ('2330', '2024-01-02', 590),
+                                        ('1101', '2023-12-01', 33), ('1101', '2024-01-02', 34);
+        INSERT INTO consolidation_breakpoints VALUES ('2330', 0.01, 1), ('2330', 0.05, 3), ('1101', 0.02, 4);
+    ''')
+    conn.close()
+    shutil.copy(pub_path, sub_path)     # 套用端：從上一版 base 還原的資料庫
+
+    conn = sqlite3.connect(pub_path, isolation_level=None)
+    conn.executescript('''
+        UPDATE stocks SET pe_ratio = 21.5 WHERE stock_id = '2330';
+        INSERT INTO daily_prices VALUES ('2330', '2024-01-03', 600);
+        DELETE FROM daily_prices WHERE date < '2024-01-01';
+        DELETE FROM consolidation_breakpoints WHERE stock_id = '2330';
+        INSERT INTO consolidation_breakpoints VALUES ('2330', 0.03, 1);
+    ''')
+    xz_path = db_delta.export_delta(conn, '2024-01-03 18:00:00', dirty_ids=['2330'], price_ids=['2330'],
+                                    since='2024-01-03', prune_before='2024-01-01')
+    conn.close()
+    return pub_path, sub_path, xz_path
+
+
+def test_apply_delta_reproduces_publisher(publisher):
+    pub_path, sub_path, xz_path = publisher
+    assert db_delta.apply_delta(sub_path, xz_path) == 'delta_20240103_180000'
+    assert _dump(sub_path) == _dump(pub_path)
+
+    on_base, pending = db_delta.pending_deltas(sub_path)
+    assert on_base and pending == []
+
+
+def test_apply_delta_is_idempotent(publisher):
+    pub_path, sub_path, xz_path = publisher
+    db_delta.apply_delta(sub_path, xz_path)
+    once = _dump(sub_path)
+    db_delta.apply_delta(sub_path, xz_path)
+    assert _dump(sub_path) == once == _dump(pub_path)
+
+
+def test_failed_delta_rolls_back(publisher):
+    _, sub_path, xz_path = publisher
+    before = _dump(sub_path)
+    conn = sqlite3.connect(sub_path)
+    conn.execute("DROP TABLE consolidation_breakpoints")    # 套用到一半會失敗
+    conn.commit()
+    conn.close()
+
+    with pytest.raises(sqlite3.OperationalError):
+        db_delta.apply_delta(sub_path, xz_path)
+    conn = sqlite3.connect(sub_path)
+    try:
+        assert sorted(conn.execute("SELECT * FROM stocks").fetchall()) == before['stocks']
+        assert sorted(conn.execute("SELECT * FROM daily_prices").fetchall()) == before['daily_prices']
+    finally:
+        conn.close()
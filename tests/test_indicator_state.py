@@ -0,0 +1,58 @@
+# indicator_state 增量套用新 K 棒 → 必須與全量重建一致
+import numpy as np
+import pandas as pd
+import pytest
+import indicator_state
+
+
+def _history(n, seed=0):
+    rng = np.random.default_rng(seed)
+    dates = [d.strftime('%Y-%m-%d') for d in pd.bdate_range('2024-01-01', periods=n)]
+    closes = 100 * np.cumprod(1 + rng.normal(0, 0.02, n))
+    volumes = rng.integers(1_000, 100_000, n).astype(np.float64)
+    return dates, closes, volumes
+
+
+@pytest.mark.parametrize('split', [3, 30, 499, 520])
+def test_apply_new_bars_matches_full_rebuild(split):
+    dates, closes, volumes = _history(600)
+    state = indicator_state.build_state(dates[split - 1], closes[:split], volumes[:split])
+    bars = list(zip(dates[split:], closes[split:], volumes[split:]))
+    results = indicator_state.apply_new_bars(state, bars)
+
+    expected = indicator_state.build_state(dates[-1], closes, volumes)
+    assert state['last_date'] == dates[-1]
+    np.testing.assert_array_equal(state['closes'], expected['closes'])
+    np.testing.assert_array_equal(state['volumes'], expected['volumes'])
+    for key in ('sum_5', 'sum_20', 'sum_60', 'vol_sum_5', 'vol_sum_20'):
+        assert state[key] == pytest.approx(expected[key], rel=1e-9)
+    actual, full = indicator_state.summarize_state(state), indicator_state.summarize_state(expected)
+    for key, value in full.items():
+        assert actual[key] == pytest.approx(value, rel=1e-9)
+
+    # 每根新 K 棒回傳的均線要等於直接滾動平均
+    mas = pd.Series(closes)
+    for offset, (date_str, ma5, ma20, ma60, change) in enumerate(results):
+        i = split + offset
+        assert date_str == dates[i]
+        for window, value in ((5, ma5), (20, ma20), (60, ma60)):
+            if i + 1 < window:
+                assert value is None
+            else:
+                assert value == pytest.approx(mas[i - window + 1:i + 1].mean(), rel=1e-9)
+        assert change == pytest.approx((closes[i] / closes[i - 1] - 1) * 100)
+
+
+def test_apply_new_bars_skips_old_dates_and_recovers_from_nan():
+    dates, closes, volumes = _history(80, seed=1)
+    closes[50] = np.nan
+    state = indicator_state.build_state(dates[39], closes[:40], volumes[:40])
+    # 重複送已套用過的日期不應重複累加
+    indicator_state.apply_new_bars(state, list(zip(dates[30:60], closes[30:60], volumes[30:60])))
+    indicator_state.apply_new_bars(state, list(zip(dates[60:], closes[60:], volumes[60:])))
+
+    expected = indicator_state.build_state(dates[-1], closes, volumes)
+    # NaN 已滑出 5 / 20 日視窗，累計和必須恢復成有限值
+    assert state['sum_5'] == pytest.approx(expected['sum_5'])
+    assert state['sum_20'] == pytest.approx(expected['sum_20'])
+    assert np.isnan(state['sum_60']) and np.isnan(expected['sum_60'])
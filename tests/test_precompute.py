@@ -0,0 +1,60 @@
+# 預先計算指標：整批向量化版本 → 必須與逐檔參考版本一致，且位階區間跟著各股最後一根 K 棒走
+import sqlite3
+import numpy as np
+import pandas as pd
+import pytest
+import fetch_precompute
+
+
+@pytest.fixture
+def conn():
+    conn = sqlite3.connect(':memory:')
+    conn.execute("CREATE TABLE stocks (stock_id TEXT PRIMARY KEY, vol_ma_20 REAL, consolidation_days INTEGER)")
+    conn.execute('''
+        CREATE TABLE daily_prices (stock_id TEXT, date TEXT, close REAL, volume REAL, ma_20 REAL, ma_60 REAL,
+                                   PRIMARY KEY (stock_id, date))
+    ''')
+    rng = np.random.default_rng(7)
+    # 2330 資料到最近；1101 早已停止交易 (最後一根 K 棒在一年多前)，flat 收盤都一樣
+    for stock_id, end, closes in (
+        ('2330', pd.Timestamp.today().normalize(), 100 * np.cumprod(1 + rng.normal(0, 0.02, 700))),
+        ('1101', pd.Timestamp.today().normalize() - pd.Timedelta(days=420), 30 * np.cumprod(1 + rng.normal(0, 0.02, 700))),
+        ('flat', pd.Timestamp.today().normalize(), np.full(30, 12.0)),
+    ):
+        dates = pd.date_range(end=end, periods=len(closes), freq='D').strftime('%Y-%m-%d')
+        ma = pd.Series(closes)
+        conn.executemany("INSERT INTO daily_prices VALUES (?, ?, ?, ?, ?, ?)", zip(
+            [stock_id] * len(closes), dates, closes, rng.integers(1_000, 9_000, len(closes)).astype(float),
+            ma.rolling(20).mean(), ma.rolling(60).mean()))
+        conn.execute("INSERT INTO stocks VALUES (?, ?, ?)", (stock_id, 5_000.0, int(rng.integers(0, 40))))
+    conn.execute("INSERT INTO stocks VALUES ('empty', NULL, NULL)")   # 沒有任何日線
+    conn.commit()
+    yield conn
+    conn.close()
+
+
+def test_vectorized_matches_per_stock_reference(conn):
+    frame = fetch_precompute.compute_precomputed_frame(fetch_precompute.load_precompute_inputs(conn)).set_index('stock_id')
+    for stock_id in frame.index:
+        expected = dict(zip(('position_1y', 'position_2y'), fetch_precompute.precompute_position(stock_id, conn)))
+        expected.update(zip(('bias_20', 'bias_60'), fetch_precompute.precompute_bias(stock_id, conn)))
+        expected['vol_spike'] = fetch_precompute.precompute_vol_spike(stock_id, conn)
+        expected['consolidation_log'] = fetch_precompute.precompute_consolidation_log(stock_id, conn)
+        for column, value in expected.items():
+            actual = frame.loc[stock_id, column]
+            if value is None:
+                assert np.isnan(actual), (stock_id, column)
+            else:
+                assert actual == pytest.approx(value, rel=1e-12), (stock_id, column)
+
+
+def test_position_window_anchored_on_last_bar(conn):
+    # 停止交易的股票不會被重算，位階仍必須是「最後一根 K 棒往回 250 / 500 天」的區間
+    closes = pd.read_sql("SELECT date, close FROM daily_prices WHERE stock_id = '1101' ORDER BY date", conn)
+    closes['date'] = pd.to_datetime(closes['date'])
+    last_date, last_close = closes['date'].iloc[-1], closes['close'].iloc[-1]
+    frame = fetch_precompute.compute_precomputed_frame(fetch_precompute.load_precompute_inputs(conn, ['1101']))
+    for column, days in (('position_1y', 250), ('position_2y', 500)):
+        window = closes.loc[closes['date'] >= last_date - pd.Timedelta(days=days), 'close']
+        expected = (last_close - window.min()) / (window.max() - window.min())
+        assert frame[column].iloc[0] == pytest.approx(expected)
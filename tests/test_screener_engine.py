@@ -0,0 +1,160 @@
+# 記憶體選股引擎 → 篩選結果必須與 SQL 版本 (app.query_data 使用快照時的條件) 相同
+import sqlite3
+import numpy as np
+import pandas as pd
+import pytest
+import screener_engine
+
+N = 300
+INDUSTRIES = ['半導體業', '水泥工業', '航運業', '金融保險業']
+
+
+def _reference_ids(conn, filters):
+    """與 app.query_data 相同的 WHERE 條件 (NULL 比較一律不成立)"""
+    conditions, params = [], []
+    if filters.get('industry') and "全部" not in filters['industry']:
+        conditions.append(f"industry IN ({','.join(['?'] * len(filters['industry']))})")
+        params.extend(filters['industry'])
+    for col, low_key, high_key in screener_engine.NUMERIC_FILTERS:
+        if filters.get(low_key) is not None:
+            conditions.append(f"{col} >= ?")
+            params.append(filters[low_key])
+        if filters.get(high_key) is not None:
+            conditions.append(f"{col} <= ?")
+            params.append(filters[high_key])
+    if filters.get('streak_min') is not None:
+        conditions.append("revenue_streak >= ?")
+        params.append(filters['streak_min'])
+    pos_col = 'position_2y' if filters.get('period') == '2y' else 'position_1y'
+    for key, op in (('pos_min', '>='), ('pos_max', '<=')):
+        if filters.get(key) is not None:
+            conditions.append(f"{pos_col} {op} ?")
+            params.append(filters[key])
+    if filters.get('consolidation_days') is not None:
+        days, threshold = filters['consolidation_days']
+        if threshold == 0.1:
+            conditions.append("consolidation_days >= ?")
+            params.append(days)
+        elif threshold == 0.2:
+            conditions.append("consolidation_days_20 >= ?")
+            params.append(days)
+        else:
+            conditions.append("stock_id IN (SELECT stock_id FROM consolidation_breakpoints WHERE threshold <= ? AND days >= ?)")
+            params.extend([threshold, days])
+    if filters.get('vol_spike_min'):
+        conditions.append("vol_spike >= ?")
+        params.append(filters['vol_spike_min'])
+    if filters.get('search'):
+        conditions.append("(instr(stock_id, ?) > 0 OR instr(name, ?) > 0)")
+        params.extend([filters['search'], filters['search']])
+    where = " AND ".join(conditions) or "1 = 1"
+    return sorted(r[0] for r in conn.execute(f"SELECT stock_id FROM latest_stock_snapshot WHERE {where}", params))
+
+
+@pytest.fixture(scope='module')
+def conn():
+    rng = np.random.default_rng(3)
+
+    def column(scale, offset=0.0, null_ratio=0.1):
+        values = rng.normal(offset, scale, N).round(2)
+        values[rng.random(N) < null_ratio] = np.nan
+        return values
+
+    snapshot = pd.DataFrame({
+        'stock_id': [str(1000 + i) for i in range(N)],
+        'name': [f'公司{i}' for i in range(N)],
+        'industry': rng.choice(INDUSTRIES + [None], N),
+        'market_type': rng.choice(['上市', '上櫃'], N),
+        'pe_ratio': column(10, 15), 'yield_rate': column(2, 3), 'pb_ratio': column(1, 2), 'eps': column(3, 2),
+        'beta': column(0.3, 1), 'market_cap': column(1e9, 5e9), 'revenue_growth': column(40, 5),
+        'revenue_streak': rng.integers(0, 6, N).astype(float), 'capital': column(3e8, 1e9),
+        'vol_ma_5': column(2000, 3000), 'vol_ma_20': column(2000, 3000), 'eps_growth': column(50),
+        'gross_margin': column(15, 25), 'operating_margin': column(10, 10), 'pretax_margin': column(10, 10),
+        'net_margin': column(10, 8), 'consolidation_days': rng.integers(0, 60, N).astype(float),
+        'consolidation_days_20': rng.integers(0, 120, N).astype(float),
+        'position_1y': column(0.3, 0.5), 'position_2y': column(0.3, 0.5), 'bias_20': column(0.05),
+        'bias_60': column(0.1), 'vol_spike': column(1, 1.5), 'consolidation_log': None,
+        'year_high': column(20, 110), 'year_low': column(20, 60),
+        'year_high_2y': column(20, 120), 'year_low_2y': column(20, 50),
+        'date': '2024-01-03', 'close': column(30, 80), 'change_pct': column(3), 'volume': column(3000, 5000),
+        'ma_5': column(30, 80), 'ma_20': column(30, 80), 'ma_60': column(30, 80),
+    })
+    rows = [(sid, round(float(t), 3), int(d)) for sid in snapshot['stock_id']
+            for t, d in zip(np.sort(rng.random(3) * 0.3), np.sort(rng.integers(1, 90, 3)))]
+    conn = sqlite3.connect(':memory:')
+    snapshot.to_sql('latest_stock_snapshot', conn, index=False)
+    conn.execute("CREATE TABLE consolidation_breakpoints (stock_id TEXT, threshold REAL, days INTEGER)")
+    conn.executemany("INSERT INTO consolidation_breakpoints VALUES (?, ?, ?)", rows)
+    yield conn
+    conn.close()
+
+
+FILTER_CASES = {
+    '無條件': {},
+    '低本益比高殖利率': {'pe_min': 0, 'pe_max': 15, 'yield_min': 4},
+    '產業 + 價格': {'industry': ['半導體業', '航運業'], 'price_min': 50, 'price_max': 120},
+    '全部產業': {'industry': ['全部'], 'eps_min': 1},
+    '不存在的產業': {'industry': ['不存在']},
+    '2 年低位階': {'period': '2y', 'pos_max': 0.3, 'vol_ma_min': 1000},
+    '營收連增': {'streak_min': 3, 'rev_min': 10, 'gross_min': 20},
+    '盤整 10%': {'consolidation_days': (20, 0.1)},
+    '盤整 20%': {'consolidation_days': (40, 0.2)},
+    '盤整任意門檻': {'consolidation_days': (30, 0.07)},
+    '爆量': {'vol_spike_min': 2, 'change_min': 0},
+    '搜尋': {'search': '12'},
+    '搜尋名稱': {'search': '公司2', 'eps_growth_min': 0, 'vol_ma20_max': 4000},
+}
+BUCKETS = (
+    [('pe_ratio', 0, 15), ('yield_rate', 4, None), ('close', 50, 120), ('revenue_streak', 3, None)],
+    [(20, 0.1), (30, 0.07)],
+)
+
+
+@pytest.mark.parametrize('buckets', [None, BUCKETS], ids=['即時計算', '預建 bitmap'])
+@pytest.mark.parametrize('name', list(FILTER_CASES))
+def test_screen_matches_sql(conn, name, buckets):
+    engine = screener_engine.load_screener_engine(conn, buckets=buckets)
+    filters = FILTER_CASES[name]
+    assert sorted(engine.screen(filters)['stock_id']) == _reference_ids(conn, filters)
+
+
+def test_screen_uses_period_high_low(conn):
+    engine = screener_engine.load_screener_engine(conn)
+    df = engine.screen({'period': '2y'})
+    expected = pd.read_sql("SELECT stock_id, year_high_2y FROM latest_stock_snapshot", conn)
+    merged = df.merge(expected, on='stock_id')
+    np.testing.assert_array_equal(merged['year_high'].to_numpy(), merged['year_high_2y'].to_numpy())
+
+
+def test_count_strategies_matches_screen(conn):
+    engine = screener_engine.load_screener_engine(conn, buckets=BUCKETS)
+    counts = engine.count_strategies(FILTER_CASES)
+    assert counts == {name: len(_reference_ids(conn, f)) for name, f in FILTER_CASES.items()}
+    assert engine.count_strategies({}) == {}
+
+
+def test_index_position_lookup(conn):
+    engine = screener_engine.load_screener_engine(conn)
+    positions = {str(1000 + i): i / N for i in range(0, N, 2)}     # 奇數列沒有資料 → 不成立
+    calls = []
+
+    def lookup(period):
+        calls.append(period)
+        return positions
+
+    df = engine.screen({'period': '3m', 'pos_min': 0.25, 'pos_max': 0.5}, lookup)
+    expected = sorted(sid for sid, p in positions.items() if 0.25 <= p <= 0.5)
+    assert sorted(df['stock_id']) == expected
+    assert df['position_3m'].between(0.25, 0.5).all()
+    assert engine.count_strategies({'a': {'period': '3m', 'pos_max': 0.25}}, lookup) == {'a': sum(p <= 0.25 for p in positions.values())}
+    assert calls == ['3m']      # 同一版本每個 period 只查一次
+
+
+def test_pack_bits_round_trip():
+    rng = np.random.default_rng(0)
+    for size in (1, 63, 64, 65, 200):
+        mask = rng.random(size) < 0.5
+        bits = screener_engine.pack_bits(mask)
+        assert bits.dtype == np.uint64 and len(bits) == -(-size // 64)
+        np.testing.assert_array_equal(screener_engine.unpack_bits(bits, size), mask)
+        assert screener_engine.popcount(bits) == mask.sum()
@@ -0,0 +1,39 @@
+# build_weekly_bars 全市場一次聚合 → 必須與 App 逐檔 resample('W-FRI') 的週 K 相同
+import numpy as np
+import pandas as pd
+import chart_pyramid
+from fetch_precompute import build_weekly_bars
+
+
+def _daily(stock_id, start, n, seed):
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range(start, periods=n, freq='D')
+    # 週末偶有交易資料 (補班日)，應歸到下一個週五
+    dates = dates[(dates.weekday < 5) | (np.arange(n) % 17 == 0)]
+    close = 50 * np.cumprod(1 + rng.normal(0, 0.02, len(dates)))
+    return pd.DataFrame({
+        'stock_id': stock_id,
+        'date': dates.strftime('%Y-%m-%d'),
+        'open': close * 0.99, 'high': close * 1.02, 'low': close * 0.97, 'close': close,
+        'volume': rng.integers(1_000, 50_000, len(dates)).astype(float),
+    })
+
+
+def test_build_weekly_bars_matches_resample():
+    daily = pd.concat([_daily('2330', '2024-01-03', 120, 0), _daily('1101', '2024-02-10', 60, 1)])
+    daily.loc[daily.index[5], 'close'] = np.nan       # 單日缺值不應讓整週消失
+    weekly = build_weekly_bars(daily.sample(frac=1, random_state=0))   # 輸入順序不影響結果
+
+    for stock_id, group in daily.groupby('stock_id'):
+        frame = group.drop(columns='stock_id').copy()
+        frame['date'] = pd.to_datetime(frame['date'])
+        expected = chart_pyramid.resample_bars(frame, 'W-FRI')
+        actual = weekly[weekly['stock_id'] == stock_id].reset_index(drop=True)
+
+        assert (actual['date'].dt.weekday == 4).all()
+        pd.testing.assert_series_equal(actual['date'], expected['date'], check_names=False)
+        for col in ('open', 'high', 'low', 'close', 'volume'):
+            np.testing.assert_allclose(actual[col].to_numpy(), expected[col].to_numpy(), err_msg=col)
+        # last_trade_date 是該週 (上週六 ~ 週五) 的最後一個交易日
+        gap = actual['date'] - actual['last_trade_date']
+        assert ((gap >= pd.Timedelta(0)) & (gap < pd.Timedelta(days=7))).all()
@@ -0,0 +1,61 @@
+# 多區塊 .xz：壓縮 / 解壓縮往返、舊版單一 stream 相容、區段隨機讀取
+import lzma
+import os
+import pytest
+import xz_blocks
+
+BLOCK = 64 * 1024
+
+
+@pytest.fixture
+def payload():
+    # 一半可壓縮、一半隨機，長度刻意不是區塊大小的整數倍
+    return (b'2330,2024-01-02,593.0\n' * 8000) + os.urandom(3 * BLOCK + 1234)
+
+
+def test_round_trip_multi_stream(tmp_path, payload):
+    src, packed, out = tmp_path / 'src.db', tmp_path / 'src.db.xz', tmp_path / 'out.db'
+    src.write_bytes(payload)
+    blocks, size = xz_blocks.compress_file(src, packed, block_size=BLOCK, preset=1, workers=2)
+
+    assert blocks == -(-len(payload) // BLOCK)
+    assert size == packed.stat().st_size
+    assert not (tmp_path / 'src.db.xz.tmp').exists()
+    streams = xz_blocks.read_stream_index(packed)
+    assert len(streams) == blocks
+    assert sum(s['usize'] for s in streams) == len(payload)
+
+    assert xz_blocks.decompress_file(packed, out, workers=2) == blocks
+    assert out.read_bytes() == payload
+    # 串接的 stream 仍是合法 .xz，一般工具照常可讀
+    assert lzma.decompress(packed.read_bytes()) == payload
+
+
+def test_legacy_single_stream_file(tmp_path, payload):
+    legacy, out = tmp_path / 'legacy.db.xz', tmp_path / 'out.db'
+    with lzma.open(legacy, 'wb', preset=1) as f:
+        f.write(payload)
+
+    assert len(xz_blocks.read_stream_index(legacy)) == 1
+    assert xz_blocks.decompress_file(legacy, out) == 1
+    assert out.read_bytes() == payload
+
+
+def test_empty_file_round_trip(tmp_path):
+    src, packed, out = tmp_path / 'empty', tmp_path / 'empty.xz', tmp_path / 'out'
+    src.write_bytes(b'')
+    assert xz_blocks.compress_file(src, packed, block_size=BLOCK)[0] == 1
+    assert lzma.decompress(packed.read_bytes()) == b''
+    xz_blocks.decompress_file(packed, out)
+    assert out.read_bytes() == b''
+
+
+def test_block_reader_reads_ranges_across_streams(tmp_path, payload):
+    src, packed = tmp_path / 'src.db', tmp_path / 'src.db.xz'
+    src.write_bytes(payload)
+    xz_blocks.compress_file(src, packed, block_size=BLOCK, preset=1)
+
+    reader = xz_blocks.XZBlockReader(packed)
+    assert reader.size == len(payload)
+    for start, length in ((0, 10), (BLOCK - 5, 10), (BLOCK * 2 - 1, BLOCK + 2), (len(payload) - 3, 100)):
+        assert reader.read_range(start, length) == payload[start:start + length]
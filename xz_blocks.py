@@ -0,0 +1,247 @@
+# xz_blocks.py - 多區塊 (multi-stream) .xz：多核心平行壓縮 / 解壓縮，並可只解開指定區段
+# 把檔案切成固定大小的區塊，每塊各自壓成一個完整的 xz stream 後依序串接。
+# 串接的 xz stream 本來就是合法的 .xz，lzma.open / xz -d 照常可讀；
+# 每個 stream 結尾都有 footer + index 記錄大小，從檔尾往回解析就能得到每塊的位置，不需要額外的索引檔。
+#
+# 用法:
+#   python xz_blocks.py --benchmark [db 路徑]   比較單一 stream 與多區塊的壓縮 / 解壓縮 / 首次查詢時間
+
+import os
+import sys
+import time
+import lzma
+import shutil
+import struct
+import sqlite3
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+BLOCK_SIZE = 16 * 1024 * 1024       # 每塊未壓縮 16 MB
+XZ_PRESET = 9
+# liblzma 壓縮 / 解壓縮時會釋放 GIL，用執行緒就能吃滿多核心
+MAX_WORKERS = os.cpu_count() or 1
+
+
+def _filters(block_size, preset=XZ_PRESET):
+    # preset 9 預設 64 MB 字典，每塊只有 block_size，字典開到區塊大小即可 (省下每條執行緒數百 MB 記憶體)
+    return [{'id': lzma.FILTER_LZMA2, 'preset': preset, 'dict_size': max(block_size, 1024 * 1024)}]
+
+
+def _compress_block(data, block_size, preset):
+    return lzma.compress(data, format=lzma.FORMAT_XZ, check=lzma.CHECK_CRC64, filters=_filters(block_size, preset))
+
+
+def compress_file(src_path, dst_path, block_size=BLOCK_SIZE, preset=XZ_PRESET, workers=MAX_WORKERS):
+    """
+    平行壓縮成多區塊 .xz，先寫暫存檔再 rename (中途失敗不會留下半個檔案)
+    回傳 (區塊數, 壓縮後大小)
+    """
+    dst_path = Path(dst_path)
+    tmp_path = dst_path.with_name(dst_path.name + '.tmp')
+    blocks = 0
+    with open(src_path, 'rb') as f_in, open(tmp_path, 'wb') as f_out, ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = []
+        while True:
+            data = f_in.read(block_size)
+            if data:
+                pending.append(pool.submit(_compress_block, data, block_size, preset))
+            # 最多同時保留 workers * 2 塊在記憶體，依序寫出
+            while pending and (len(pending) >= workers * 2 or not data):
+                f_out.write(pending.pop(0).result())
+                blocks += 1
+            if not data:
+                break
+        if not blocks:
+            # 空檔也要寫出一個空的 stream，否則 0 byte 的檔案不是合法的 .xz
+            f_out.write(_compress_block(b'', block_size, preset))
+            blocks = 1
+    os.replace(tmp_path, dst_path)
+    return blocks, dst_path.stat().st_size
+
+
+def _read_varint(buf, pos):
+    value = shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+
+
+def read_stream_index(path):
+    """
+    從檔尾往回解析每個 xz stream 的 footer / index
+    回傳 [{'offset', 'length', 'uoffset', 'usize'}, ...] (依檔案順序；uoffset 為解壓後的起始位置)
+    """
+    streams = []
+    with open(path, 'rb') as f:
+        end = f.seek(0, os.SEEK_END)
+        while end > 0:
+            # stream 之間可能有 4 bytes 對齊的 0 padding
+            f.seek(end - 4)
+            while end >= 4 and f.read(4) == b'\0\0\0\0':
+                end -= 4
+                f.seek(end - 4)
+
+            f.seek(end - 12)
+            footer = f.read(12)
+            if footer[10:12] != b'YZ':
+                raise ValueError(f"不是合法的 xz 檔案：{path}")
+            index_size = (struct.unpack('<I', footer[4:8])[0] + 1) * 4
+            f.seek(end - 12 - index_size)
+            index = f.read(index_size)
+
+            count, pos = _read_varint(index, 1)
+            blocks_size = usize = 0
+            for _ in range(count):
+                unpadded, pos = _read_varint(index, pos)
+                size, pos = _read_varint(index, pos)
+                blocks_size += (unpadded + 3) // 4 * 4
+                usize += size
+
+            start = end - 12 - index_size - blocks_size - 12
+            streams.append({'offset': start, 'length': end - start, 'usize': usize})
+            end = start
+
+    streams.reverse()
+    uoffset = 0
+    for stream in streams:
+        stream['uoffset'] = uoffset
+        uoffset += stream['usize']
+    return streams
+
+
+def decompress_file(src_path, dst_path, workers=MAX_WORKERS):
+    """
+    平行解壓縮到 dst_path (先寫暫存檔再 rename)
+    單一 stream 的舊檔無法切開，直接用 lzma.open 串流解壓 (相容原本的 .xz)
+    回傳 stream 數
+    """
+    dst_path = Path(dst_path)
+    tmp_path = dst_path.with_name(dst_path.name + '.tmp')
+    streams = read_stream_index(src_path)
+
+    if len(streams) <= 1:
+        with lzma.open(src_path, 'rb') as f_in, open(tmp_path, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+    else:
+        def inflate(stream):
+            with open(src_path, 'rb') as f:
+                f.seek(stream['offset'])
+                return lzma.decompress(f.read(stream['length']), format=lzma.FORMAT_XZ)
+
+        with open(tmp_path, 'wb') as f_out, ThreadPoolExecutor(max_workers=workers) as pool:
+            # 分批送出，避免整個資料庫同時攤在記憶體
+            for i in range(0, len(streams), workers * 2):
+                for data in pool.map(inflate, streams[i:i + workers * 2]):
+                    f_out.write(data)
+    os.replace(tmp_path, dst_path)
+    return len(streams)
+
+
+class XZBlockReader:
+    """
+    隨機讀取多區塊 .xz：只解壓縮涵蓋所需區段的 stream
+    例如只讀 SQLite 檔頭或某幾頁，不必先還原整個資料庫
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.streams = read_stream_index(path)
+        self.size = sum(s['usize'] for s in self.streams)
+        self._cache = (None, None)      # 最近一次解開的 stream
+
+    def _stream_data(self, i):
+        if self._cache[0] != i:
+            stream = self.streams[i]
+            with open(self.path, 'rb') as f:
+                f.seek(stream['offset'])
+                self._cache = (i, lzma.decompress(f.read(stream['length']), format=lzma.FORMAT_XZ))
+        return self._cache[1]
+
+    def read_range(self, start, length):
+        """解壓後檔案的 [start, start + length) 區段"""
+        end = min(start + length, self.size)
+        chunks = []
+        for i, stream in enumerate(self.streams):
+            s_start, s_end = stream['uoffset'], stream['uoffset'] + stream['usize']
+            if s_end <= start or s_start >= end:
+                continue
+            data = self._stream_data(i)
+            chunks.append(data[max(start - s_start, 0):min(end, s_end) - s_start])
+        return b''.join(chunks)
+
+    def page_size(self):
+        # SQLite 檔頭第 16~17 byte 為頁大小，1 代表 65536
+        size = struct.unpack('>H', self.read_range(16, 2))[0]
+        return 65536 if size == 1 else size
+
+    def read_pages(self, first_page, count=1):
+        """讀取 SQLite 第 first_page 頁起 (1 起算) 的 count 頁"""
+        page_size = self.page_size()
+        return self.read_range((first_page - 1) * page_size, count * page_size)
+
+
+def benchmark(db_path, block_size=BLOCK_SIZE, preset=XZ_PRESET):
+    """單一 stream (原本做法) vs 多區塊：壓縮、解壓縮、解壓後第一次查詢、只讀檔頭"""
+    db_path = Path(db_path)
+    work_dir = db_path.parent
+    single_xz = work_dir / (db_path.name + '.single.xz')
+    multi_xz = work_dir / (db_path.name + '.multi.xz')
+    restored = work_dir / (db_path.name + '.restored')
+    results = {}
+
+    started = time.time()
+    with open(db_path, 'rb') as f_in, lzma.open(single_xz, 'wb', preset=preset) as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    results['single'] = {'compress': time.time() - started, 'size': single_xz.stat().st_size, 'streams': 1}
+
+    started = time.time()
+    blocks, size = compress_file(db_path, multi_xz, block_size, preset)
+    results['multi'] = {'compress': time.time() - started, 'size': size, 'streams': blocks}
+
+    for name, xz_path in (('single', single_xz), ('multi', multi_xz)):
+        started = time.time()
+        decompress_file(xz_path, restored)
+        results[name]['decompress'] = time.time() - started
+        conn = sqlite3.connect(restored)
+        conn.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+        conn.close()
+        results[name]['first_query'] = time.time() - started
+
+        started = time.time()
+        if name == 'multi':
+            XZBlockReader(xz_path).read_pages(1)
+        else:
+            with lzma.open(xz_path, 'rb') as f:
+                f.read(4096)
+        results[name]['header'] = time.time() - started
+
+    # 兩種格式都必須能被 lzma.open 讀回並與原檔一致
+    with open(db_path, 'rb') as f:
+        original = f.read()
+    with lzma.open(multi_xz, 'rb') as f:
+        compatible = f.read() == original
+
+    for path in (single_xz, multi_xz, restored):
+        path.unlink(missing_ok=True)
+
+    print(f"🗜️ {db_path.name} {len(original) / 1024 / 1024:.1f} MB，區塊 {block_size // 1024 // 1024} MB，"
+          f"preset={preset}，{MAX_WORKERS} 核心")
+    print(f"{'格式':<10}{'stream 數':>10}{'大小 (MB)':>12}{'壓縮 (秒)':>12}{'解壓 (秒)':>12}{'首次查詢 (秒)':>16}{'讀檔頭 (秒)':>14}")
+    for name, label in (('single', '單一 stream'), ('multi', '多區塊')):
+        r = results[name]
+        print(f"{label:<10}{r['streams']:>10}{r['size'] / 1024 / 1024:>12.2f}{r['compress']:>12.2f}"
+              f"{r['decompress']:>12.2f}{r['first_query']:>16.2f}{r['header']:>14.3f}")
+    print(f"🔍 lzma.open 讀取多區塊檔{'與原檔一致' if compatible else '不一致 ⚠️'}")
+    return results
+
+
+if __name__ == "__main__":
+    if '--benchmark' in sys.argv:
+        args = sys.argv[sys.argv.index('--benchmark') + 1:]
+        benchmark(args[0] if args else Path(__file__).resolve().parent / "stock_data.db")
+    else:
+        print("使用方式: python xz_blocks.py --benchmark [db 路徑]")